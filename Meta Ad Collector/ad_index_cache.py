@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+In-process page and ad-existence cache used by SQLInserter.
+
+SQLInserter used to ask the database, for every ad, whether its page name changed and
+whether the ad already exists. This cache answers both questions from memory:
+
+    pages:  page_id -> page_name
+    ads:    a sorted array of int64 ad ids (8 bytes per ad) plus a small set of ids
+            added since the last merge
+
+It can be warmed from the database in one streaming (server-side cursor) pass. Writes are
+recorded as *pending* and only become visible after the transaction that made them commits,
+so a rollback never leaves the cache claiming rows the database does not have.
+
+Both maps are bounded (SQL_CACHE_MAX_ADS / SQL_CACHE_MAX_PAGES). Once a bound is hit that
+map stops growing and is no longer authoritative: hits are still trusted, misses fall back
+to the database.
+
+One cache can be shared by several SQLInserters (one per country in a multi-country run):
+pending writes are kept per thread, so each writer thread commits or rolls back only its own.
+"""
+
+import os
+import heapq
+import threading
+from array import array
+from bisect import bisect_left
+
+MAX_CACHED_ADS = int(os.environ.get("SQL_CACHE_MAX_ADS", "10000000"))
+MAX_CACHED_PAGES = int(os.environ.get("SQL_CACHE_MAX_PAGES", "1000000"))
+RECENT_MERGE_SIZE = 100000
+WARM_FETCH_SIZE = 50000
+
+
+class AdIndexCache:
+    def __init__(self, max_ads=MAX_CACHED_ADS, max_pages=MAX_CACHED_PAGES):
+        self.max_ads = max_ads
+        self.max_pages = max_pages
+        self.ad_ids = array('q')
+        self.recent_ad_ids = set()
+        self.pages = {}
+        # Pending writes of the calling thread's current transaction
+        self._local = threading.local()
+        self.lock = threading.Lock()
+        # True once warmed completely: a miss then means "not in the database"
+        self.complete = False
+
+    @property
+    def pending_ad_ids(self):
+        if not hasattr(self._local, "ad_ids"):
+            self._local.ad_ids = set()
+        return self._local.ad_ids
+
+    @property
+    def pending_pages(self):
+        if not hasattr(self._local, "pages"):
+            self._local.pages = {}
+        return self._local.pages
+
+    def __len__(self):
+        return len(self.ad_ids) + len(self.recent_ad_ids)
+
+    def warm(self, connection):
+        """Load every ad id and page name in one streaming pass each."""
+        self.ad_ids = array('q')
+        self.recent_ad_ids = set()
+        self.pages = {}
+        complete = True
+        pages_complete = True
+
+        cursor = connection.cursor(name="ad_index_cache_ads")
+        cursor.itersize = WARM_FETCH_SIZE
+        try:
+            cursor.execute("SELECT id FROM meta_ads.ads ORDER BY id")
+            for (ad_id,) in cursor:
+                if len(self.ad_ids) >= self.max_ads:
+                    complete = False
+                    break
+                self.ad_ids.append(ad_id)
+        finally:
+            cursor.close()
+
+        cursor = connection.cursor(name="ad_index_cache_pages")
+        cursor.itersize = WARM_FETCH_SIZE
+        try:
+            cursor.execute("SELECT page_id, page_name FROM meta_ads.pages")
+            for page_id, page_name in cursor:
+                if len(self.pages) >= self.max_pages:
+                    pages_complete = False
+                    break
+                self.pages[str(page_id)] = page_name
+        finally:
+            cursor.close()
+        # End the read transaction the named cursors ran in
+        connection.commit()
+
+        self.complete = complete
+        print(f"Ad index cache warmed: {len(self.ad_ids)} ads, {len(self.pages)} pages"
+              + ("" if complete and pages_complete else " (size limit reached, misses will query the database)"))
+
+    def has_ad(self, ad_id):
+        """True/False when the cache knows, None when the database has to be asked."""
+        ad_id = int(ad_id)
+        # Recent set first: a concurrent merge publishes the merged array before emptying it
+        if ad_id in self.recent_ad_ids:
+            return True
+        ad_ids = self.ad_ids
+        i = bisect_left(ad_ids, ad_id)
+        if i < len(ad_ids) and ad_ids[i] == ad_id:
+            return True
+        return False if self.complete else None
+
+    def page_name(self, page_id):
+        """Cached page name, or None when the page is not cached."""
+        return self.pages.get(str(page_id))
+
+    def remember_ad(self, ad_id):
+        """Record an ad already known to be committed (e.g. found by a query)."""
+        self._add_ads([ad_id])
+
+    def remember_page(self, page_id, page_name):
+        self._set_pages({str(page_id): page_name})
+
+    def add_ad(self, ad_id):
+        """Record an ad written in the current, uncommitted transaction."""
+        self.pending_ad_ids.add(int(ad_id))
+
+    def set_page(self, page_id, page_name):
+        self.pending_pages[str(page_id)] = page_name
+
+    def commit(self):
+        """Make pending writes visible; call right after the transaction commits."""
+        if self.pending_ad_ids:
+            self._add_ads(self.pending_ad_ids)
+        if self.pending_pages:
+            self._set_pages(self.pending_pages)
+        self.rollback()
+
+    def rollback(self):
+        self._local.ad_ids = set()
+        self._local.pages = {}
+
+    def _add_ads(self, ad_ids):
+        with self.lock:
+            for ad_id in ad_ids:
+                if self.has_ad(ad_id):
+                    continue
+                if len(self) >= self.max_ads:
+                    self.complete = False
+                    break
+                self.recent_ad_ids.add(int(ad_id))
+            if len(self.recent_ad_ids) >= RECENT_MERGE_SIZE:
+                self._merge_recent()
+
+    def _merge_recent(self):
+        # Both inputs are sorted, so this is a linear merge
+        merged = array('q')
+        last = None
+        for ad_id in heapq.merge(self.ad_ids, sorted(self.recent_ad_ids)):
+            if ad_id != last:
+                merged.append(ad_id)
+                last = ad_id
+        # Publish the merged array before dropping the recent set, so readers never miss an id
+        self.ad_ids = merged
+        self.recent_ad_ids = set()
+
+    def _set_pages(self, pages):
+        with self.lock:
+            for page_id, page_name in pages.items():
+                if page_id not in self.pages and len(self.pages) >= self.max_pages:
+                    continue
+                self.pages[page_id] = page_name
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Refresh a list of ads by id (collect_rds.py / collect_local.py --ad-id and --ad-ids-file).
+
+Ids are deduplicated and looked up in chunks. Every lookup of a chunk is submitted to one
+GraphBatchTransport at once, so they go out as Graph API batch calls under the API key's
+shared RateGovernor. While a chunk's ads and snapshots are written in one insert_ads_bulk
+transaction, the next chunk's lookups are already in flight.
+"""
+
+import sys
+import json
+from time import time
+from datetime import date, timedelta
+
+from graph_batch import GraphBatchTransport
+from collection_pipeline import snapshot_row
+
+FIELDS = "id,ad_creation_time,ad_creative_bodies,ad_creative_link_captions,ad_creative_link_descriptions,ad_creative_link_titles,ad_delivery_start_time,ad_delivery_stop_time,ad_snapshot_url,currency,delivery_by_region,demographic_distribution,bylines,impressions,languages,page_id,page_name,publisher_platforms,spend,target_locations,target_gender,target_ages,estimated_audience_size"
+API_VERSION = "v23.0"
+CHUNK_SIZE = 500  # Ids looked up (and written) together
+
+
+def read_ad_ids(path):
+    """
+    Ad ids from a file ("-" for stdin): separated by newlines, commas or spaces, blank lines
+    and # comments ignored. Duplicates are dropped, first occurrence order is kept.
+    """
+    handle = sys.stdin if path == "-" else open(path)
+    try:
+        ad_ids = []
+        for line in handle:
+            line = line.split("#", 1)[0]
+            ad_ids.extend(token for token in line.replace(",", " ").split() if token)
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+    return list(dict.fromkeys(ad_ids))
+
+
+def lookup_url(ad_id, country, api_key):
+    # Using the search_terms parameter for a direct ID lookup.
+    return (
+        f"https://graph.facebook.com/{API_VERSION}/ads_archive?"
+        f"search_terms={ad_id}&"
+        f"ad_type=POLITICAL_AND_ISSUE_ADS&"
+        # Without it only ACTIVE ads come back, and stopped ones would never be found
+        f"ad_active_status=ALL&"
+        f"ad_reached_countries=['{country}']&"
+        f"fields={FIELDS}&"
+        f"access_token={api_key}"
+    )
+
+
+def refresh_ads(sql_inserter, api_key, country, ad_ids, chunk_size=CHUNK_SIZE, snapshot_date=None):
+    """
+    Fetch and write the given ads. Returns {'written', 'not_found', 'errors'}, where
+    not_found is a list of ids and errors maps ids to the API (or write) error.
+    """
+    ad_ids = list(dict.fromkeys(str(ad_id) for ad_id in ad_ids))
+    # Use yesterday's date since we run this at 1-2AM and collect previous day's data
+    snapshot_date = snapshot_date or (date.today() - timedelta(days=1))
+    chunks = [ad_ids[i:i + chunk_size] for i in range(0, len(ad_ids), chunk_size)]
+    result = {'written': 0, 'not_found': [], 'errors': {}}
+    started = time()
+
+    transport = GraphBatchTransport(api_key)
+
+    def submit(chunk):
+        return [(ad_id, transport.submit(lookup_url(ad_id, country, api_key))) for ad_id in chunk]
+
+    try:
+        in_flight = submit(chunks[0]) if chunks else []
+        for index in range(len(chunks)):
+            found_ads = []
+            for ad_id, future in in_flight:
+                try:
+                    data = future.result()
+                except Exception as e:
+                    result['errors'][ad_id] = str(e)[:200]
+                    continue
+                if data.get('error'):
+                    result['errors'][ad_id] = json.dumps(data['error'])[:200]
+                else:
+                    # Only the exact id; search_terms can match other ads too
+                    ad = next((ad for ad in data.get('data') or [] if ad.get('id') == ad_id), None)
+                    if ad:
+                        found_ads.append(ad)
+                    else:
+                        result['not_found'].append(ad_id)
+
+            # Start on the next chunk's lookups before writing this one
+            in_flight = submit(chunks[index + 1]) if index + 1 < len(chunks) else []
+
+            if found_ads:
+                # One transaction for the whole chunk: ads, child rows and snapshots
+                try:
+                    written, new_ads = sql_inserter.insert_ads_bulk(
+                        found_ads, [snapshot_row(ad, snapshot_date) for ad in found_ads]
+                    )
+                    result['written'] += written
+                except Exception as e:
+                    for ad in found_ads:
+                        result['errors'][ad['id']] = f"database write failed: {str(e)[:150]}"
+            done = sum(len(chunk) for chunk in chunks[:index + 1])
+            elapsed = max(time() - started, 1e-6)
+            print(f"  → Chunk {index + 1}/{len(chunks)}: {len(found_ads)} ads written. "
+                  f"{done}/{len(ad_ids)} ids done ({done / elapsed:.1f} ids/s)")
+    finally:
+        transport.close()
+
+    elapsed = max(time() - started, 1e-6)
+    unresolved = len(result['not_found']) + len(result['errors'])
+    print(f"\n{'='*60}")
+    print("AD REFRESH SUMMARY")
+    print(f"{'='*60}")
+    print(f"Ids requested:       {len(ad_ids):,}")
+    print(f"Ads written:         {result['written']:,}")
+    print(f"Unresolved ids:      {unresolved:,}")
+    print(f"Graph API calls:     {transport.batches_sent:,} batch calls ({transport.subrequests_sent:,} lookups)")
+    print(f"Duration:            {elapsed:.1f}s ({len(ad_ids) / elapsed:.1f} ids/s, {result['written'] / elapsed:.1f} ads written/s)")
+    if result['not_found']:
+        print("\nNo data returned for:")
+        for ad_id in result['not_found']:
+            print(f"  {ad_id}")
+    if result['errors']:
+        print("\nErrors for:")
+        for ad_id, error in result['errors'].items():
+            print(f"  {ad_id}: {error}")
+    return result
@@ -4,6 +4,13 @@ Calculate daily spend for a specific snapshot date and populate pre-calculated t
 
 Usage:
     python calculate_daily_spend.py 2025-11-10
+    python calculate_daily_spend.py --backfill                                  # every date
+    python calculate_daily_spend.py --backfill --from 2025-11-01 --to 2025-11-10
+    python calculate_daily_spend.py --backfill --jobs 8                         # 8 connections in parallel
+    python calculate_daily_spend.py --dirty      # only dates whose snapshots changed (dirty_dates.py)
+    python calculate_daily_spend.py --incremental   # only the ads whose snapshots changed
+    python calculate_daily_spend.py --partition     # one-off: daily partitions (daily_spend_partitions.py)
+    python calculate_daily_spend.py --prune-older-than 400 [--archive-schema archive]
 
 This should be called AFTER pushing snapshot data to the database.
 If you push data on 2025-11-11, the snapshots contain data for 2025-11-10,
@@ -12,14 +19,55 @@ so you should run: python calculate_daily_spend.py 2025-11-10
 
 import os
 import sys
+import argparse
 import psycopg2
 from psycopg2.extras import execute_batch
+from time import time, sleep
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
+import dirty_dates
+import daily_spend_partitions
+
 # Load environment variables
 load_dotenv()
 
+# Ad -> advertiser for both platforms, shared by the per-date and the backfill queries
+AD_ADVERTISER_MAPPING = """
+ad_advertiser_mapping AS (
+    -- Get Meta advertiser info
+    SELECT 
+        aa.platform,
+        aa.id as ad_id,
+        mp.page_name AS advertiser_name,
+        aa.page_id AS advertiser_id
+    FROM unified.all_ads aa
+    INNER JOIN meta_ads.pages mp ON aa.page_id::bigint = mp.page_id
+    WHERE aa.platform = 'Meta'
+    
+    UNION ALL
+    
+    -- Get Google advertiser info
+    SELECT 
+        aa.platform,
+        aa.id as ad_id,
+        ga.advertiser_name,
+        ga.advertiser_id
+    FROM unified.all_ads aa
+    INNER JOIN google_ads.advertisers ga ON aa.page_id = ga.advertiser_id
+    WHERE aa.platform = 'Google'
+)
+"""
+
+# Changed (ad, date) pairs applied per --incremental transaction
+INCREMENTAL_BATCH_SIZE = int(os.environ.get("DAILY_SPEND_BATCH_SIZE", "50000"))
+# --jobs backfill: ranges queued per connection, and attempts per range (then per date)
+RANGES_PER_JOB = 4
+BACKFILL_RETRIES = 3
+BACKFILL_RETRY_BACKOFF = 10  # seconds, times the attempt number
+
 def get_db_connection():
     """Get database connection"""
     return psycopg2.connect(
@@ -29,17 +77,50 @@ def get_db_connection():
         database=os.getenv('PG_DATABASE')
     )
 
-def calculate_daily_spend_for_date(snapshot_date):
+def lock_daily_spend(cur, shared=False, session=False):
+    """
+    Lock out other writers of the daily spend tables until the transaction ends (or, with
+    session=True, until unlock_daily_spend()). The incremental mode (exclusive) adds deltas
+    to advertiser rows that a whole-date rewrite would otherwise delete under it; whole-date
+    rewrites (shared) run in parallel with each other, e.g. the ranges of a --jobs backfill.
+    """
+    scope = "" if session else "_xact"
+    mode = "_shared" if shared else ""
+    cur.execute(f"SELECT pg_advisory{scope}_lock{mode}(hashtext('calculate_daily_spend'))")
+
+def unlock_daily_spend(cur):
+    """Release a session=True, shared=True lock_daily_spend()."""
+    cur.execute("SELECT pg_advisory_unlock_shared(hashtext('calculate_daily_spend'))")
+
+def calculate_daily_spend_for_date(snapshot_date, conn=None):
     """
     Calculate daily spend for a specific snapshot_date.
     
+    conn: optional open connection (e.g. borrowed from collector_daemon.py's pool); it is
+    left open. Without one, a connection is opened and closed here.
+    
     Logic:
     - snapshot_date contains cumulative data UP TO that date
     - daily_spend(snapshot_date) = cumulative(snapshot_date) - cumulative(snapshot_date - 1)
     - If no previous day exists, daily_spend = cumulative_spend (first day of ad)
     """
     
-    conn = get_db_connection()
+    own_connection = conn is None
+    if own_connection:
+        conn = get_db_connection()
+    with conn.cursor() as check:
+        partitioned = daily_spend_partitions.is_partitioned(check, "unified.daily_spend_by_ad_table")
+    conn.commit()
+    if partitioned:
+        # The date is built separately and swapped in as its partition (same result)
+        try:
+            backfill_range(snapshot_date, snapshot_date, conn)
+            return
+        finally:
+            if own_connection:
+                conn.close()
+    # This run covers the date if it was marked dirty
+    drained = dirty_dates.drain(conn, snapshot_date, snapshot_date)
     cur = conn.cursor()
     
     print(f"\n{'='*60}")
@@ -47,6 +128,8 @@ def calculate_daily_spend_for_date(snapshot_date):
     print(f"{'='*60}\n")
     
     try:
+        lock_daily_spend(cur, shared=True)
+        
         # Step 1: Calculate daily spend by ad
         print("Step 1: Calculating daily spend per ad...")
         cur.execute("""
@@ -107,7 +190,7 @@ def calculate_daily_spend_for_date(snapshot_date):
         
         # Step 2: Calculate daily spend by advertiser
         print("\nStep 2: Calculating daily spend per advertiser...")
-        cur.execute("""
+        cur.execute(f"""
             -- Delete existing data for this date
             DELETE FROM unified.daily_spend_by_advertiser_table WHERE snapshot_date = %s;
             
@@ -117,29 +200,7 @@ def calculate_daily_spend_for_date(snapshot_date):
                 active_ads, total_daily_spend, total_daily_impressions,
                 total_cumulative_spend, total_cumulative_impressions
             )
-            WITH ad_advertiser_mapping AS (
-                -- Get Meta advertiser info
-                SELECT 
-                    aa.platform,
-                    aa.id as ad_id,
-                    mp.page_name AS advertiser_name,
-                    aa.page_id AS advertiser_id
-                FROM unified.all_ads aa
-                INNER JOIN meta_ads.pages mp ON aa.page_id::bigint = mp.page_id
-                WHERE aa.platform = 'Meta'
-                
-                UNION ALL
-                
-                -- Get Google advertiser info
-                SELECT 
-                    aa.platform,
-                    aa.id as ad_id,
-                    ga.advertiser_name,
-                    ga.advertiser_id
-                FROM unified.all_ads aa
-                INNER JOIN google_ads.advertisers ga ON aa.page_id = ga.advertiser_id
-                WHERE aa.platform = 'Google'
-            )
+            WITH {AD_ADVERTISER_MAPPING}
             SELECT 
                 ds.platform,
                 aam.advertiser_name,
@@ -222,57 +283,774 @@ def calculate_daily_spend_for_date(snapshot_date):
     except Exception as e:
         conn.rollback()
         print(f"\n✗ Error: {e}")
+        dirty_dates.restore(conn, drained)
         raise
     finally:
         cur.close()
-        conn.close()
+        if own_connection:
+            conn.close()
 
-def backfill_all_dates():
-    """Backfill calculations for all existing snapshot dates"""
+def backfill_range(date_from=None, date_to=None, conn=None, verbose=True):
+    """
+    Recalculate every snapshot date in [date_from, date_to] (open ends: all dates) in one
+    set-based pass instead of one calculate_daily_spend_for_date() call per date.
+    
+    Each ad's previous snapshot comes from LAG() over (platform, ad_id ORDER BY snapshot_date)
+    in a single scan of unified.all_daily_snapshots (starting one day before date_from). As in
+    the per-date calculation, it only counts when it is exactly one day earlier; otherwise the
+    day's spend is the cumulative spend. Both tables are rewritten for the whole range with one
+    DELETE and one INSERT ... SELECT each, in one transaction, and the advertiser mapping is
+    built once. Returns the number of ad-level rows written.
+    """
+    params = {'date_from': date_from, 'date_to': date_to}
+    # Range on the output tables, and on the snapshots (which need the day before date_from too)
+    target_range = []
+    snapshot_range = []
+    if date_from:
+        target_range.append("snapshot_date >= %(date_from)s::date")
+        snapshot_range.append("snapshot_date >= (%(date_from)s::date - INTERVAL '1 day')::date")
+    if date_to:
+        target_range.append("snapshot_date <= %(date_to)s::date")
+        snapshot_range.append("snapshot_date <= %(date_to)s::date")
+    
+    own_connection = conn is None
+    if own_connection:
+        conn = get_db_connection()
+    try:
+        # Dirty dates in the range are covered by this run
+        drained = dirty_dates.drain(conn, date_from, date_to)
+        try:
+            return recalculate(
+                conn,
+                " AND ".join(target_range) or "TRUE",
+                " AND ".join(snapshot_range) or "TRUE",
+                params,
+                f"{date_from or 'first date'} to {date_to or 'last date'}",
+                verbose=verbose,
+            )
+        except Exception:
+            dirty_dates.restore(conn, drained)
+            raise
+    finally:
+        if own_connection:
+            conn.close()
+
+def split_dates(dates, parts):
+    """Split sorted dates into at most `parts` contiguous (first, last) ranges of similar size."""
+    parts = max(1, min(parts, len(dates)))
+    size, extra = divmod(len(dates), parts)
+    ranges = []
+    start = 0
+    for index in range(parts):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append((dates[start], dates[end - 1]))
+        start = end
+    return ranges
+
+def split_span(dates, parts, first, last):
+    """
+    Split the days [first, last] into at most `parts` ranges that leave no day out, each
+    holding a similar number of the sorted `dates` (which lie within [first, last]). Days
+    between two ranges' dates go to the earlier range.
+    """
+    if not dates:
+        return [(first, last)]
+    starts = [range_first for range_first, _ in split_dates(dates, parts)]
+    starts[0] = first
+    return list(zip(starts, [start - timedelta(days=1) for start in starts[1:]] + [last]))
+
+def run_with_retries(label, attempt_fn):
+    """Call attempt_fn() up to BACKFILL_RETRIES times, backing off between attempts."""
+    for attempt in range(1, BACKFILL_RETRIES + 1):
+        try:
+            return attempt_fn()
+        except Exception as e:
+            print(f"   ✗ {label}: attempt {attempt}/{BACKFILL_RETRIES} failed: {str(e)[:200]}")
+            if attempt == BACKFILL_RETRIES:
+                raise
+            sleep(BACKFILL_RETRY_BACKOFF * attempt)
+
+def parallel_backfill(date_from=None, date_to=None, jobs=4):
+    """
+    backfill_range() split over `jobs` connections: the days from date_from to date_to
+    (open ends: the first and last date with snapshots or ad rows) are cut into contiguous
+    ranges that leave no day out (RANGES_PER_JOB per job, of similar snapshot date counts,
+    so a slow range does not hold up the rest) and recalculated concurrently, each in its
+    own transaction. As in one backfill_range(), ad rows of days that no longer have
+    snapshots are deleted.
+    
+    Ranges are independent: a range's first date reads the previous day from the snapshots
+    (backfill_range() scans from the day before date_from), not from another range's output.
+    A range that keeps failing is retried one snapshot date at a time (with the days up to
+    the next one), so one bad date does not lose its neighbours. Afterwards every day's
+    ad-level row count is checked against its snapshot count, both ways. Returns the dates
+    that failed or did not check out.
+    """
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        # Pruned days are not rebuilt (or checked)
+        cutoff = daily_spend_partitions.pruned_before(cur)
+        if cutoff and (not date_from or date_from < str(cutoff)):
+            date_from = str(cutoff)
+        conditions = []
+        if date_from:
+            conditions.append("snapshot_date >= %(date_from)s::date")
+        if date_to:
+            conditions.append("snapshot_date <= %(date_to)s::date")
+        where = " AND ".join(conditions) or "TRUE"
+        params = {'date_from': date_from, 'date_to': date_to}
+        cur.execute(f"""
+            SELECT DISTINCT snapshot_date FROM unified.all_daily_snapshots
+            WHERE {where}
+            ORDER BY snapshot_date;
+        """, params)
+        dates = [row[0] for row in cur.fetchall()]
+        cur.execute(f"SELECT MIN(snapshot_date), MAX(snapshot_date) FROM unified.daily_spend_by_ad_table WHERE {where}", params)
+        output_first, output_last = cur.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    if not dates and output_first is None:
+        print("✓ No snapshot dates or ad rows in the range")
+        return []
+    known = dates + [d for d in (output_first, output_last) if d]
+    first = datetime.strptime(date_from, '%Y-%m-%d').date() if date_from else min(known)
+    last = datetime.strptime(date_to, '%Y-%m-%d').date() if date_to else max(known)
+    
+    ranges = split_span(dates, jobs * RANGES_PER_JOB, first, last)
+    print(f"\n{'='*60}")
+    print(f"PARALLEL BACKFILL: {first} to {last} ({len(dates)} snapshot dates) "
+          f"in {len(ranges)} ranges on {jobs} connections")
+    print(f"{'='*60}\n")
+    
+    started = time()
+    lock = threading.Lock()
+    progress = {'dates': 0, 'rows': 0}
+    failed = []  # (first, last) ranges that failed
+    
+    def report(label, date_count, rows):
+        with lock:
+            progress['dates'] += date_count
+            progress['rows'] += rows
+            elapsed = max(time() - started, 1e-6)
+            print(f"   ✓ {label}: {rows:,} ad rows. "
+                  f"{progress['dates']}/{len(dates)} dates done ({progress['dates'] / elapsed * 60:.1f} dates/min)")
+    
+    def label_for(range_first, range_last):
+        return str(range_first) if range_first == range_last else f"{range_first} to {range_last}"
+    
+    def backfill(range_first, range_last):
+        range_dates = [d for d in dates if range_first <= d <= range_last]
+        pieces = split_span(range_dates, len(range_dates), range_first, range_last)
+        label = label_for(range_first, range_last)
+        try:
+            rows = run_with_retries(label, lambda: backfill_range(str(range_first), str(range_last), verbose=False))
+            report(label, len(range_dates), rows)
+            return
+        except Exception:
+            if len(pieces) == 1:
+                with lock:
+                    failed.append((range_first, range_last))
+                return
+        print(f"   ↻ {label}: retrying date by date")
+        for piece_first, piece_last in pieces:
+            piece_label = label_for(piece_first, piece_last)
+            try:
+                rows = run_with_retries(piece_label, lambda: backfill_range(str(piece_first), str(piece_last), verbose=False))
+                report(piece_label, len([d for d in range_dates if piece_first <= d <= piece_last]), rows)
+            except Exception:
+                with lock:
+                    failed.append((piece_first, piece_last))
+    
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="backfill") as pool:
+        for future in [pool.submit(backfill, range_first, range_last) for range_first, range_last in ranges]:
+            future.result()
+    
+    print("\nChecking ad-level rows against the snapshots...")
     conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        # Both ways: dates missing ad rows, and ad rows left on dates without snapshots
+        cur.execute("""
+            SELECT COALESCE(s.snapshot_date, d.snapshot_date), COALESCE(s.snapshots, 0), COALESCE(d.ad_rows, 0)
+            FROM (
+                SELECT snapshot_date, COUNT(*) as snapshots
+                FROM unified.all_daily_snapshots
+                WHERE snapshot_date BETWEEN %(first)s AND %(last)s
+                GROUP BY snapshot_date
+            ) s
+            FULL JOIN (
+                SELECT snapshot_date, COUNT(*) as ad_rows
+                FROM unified.daily_spend_by_ad_table
+                WHERE snapshot_date BETWEEN %(first)s AND %(last)s
+                GROUP BY snapshot_date
+            ) d ON d.snapshot_date = s.snapshot_date
+            WHERE COALESCE(s.snapshots, 0) <> COALESCE(d.ad_rows, 0)
+            ORDER BY 1;
+        """, {'first': first, 'last': last})
+        mismatched = [
+            row for row in cur.fetchall()
+            if not any(range_first <= row[0] <= range_last for range_first, range_last in failed)
+        ]
+        conn.commit()
+    finally:
+        conn.close()
+    
+    elapsed = time() - started
+    print(f"\n{'='*60}")
+    print("PARALLEL BACKFILL SUMMARY:")
+    print(f"{'='*60}")
+    print(f"Dates recalculated:  {progress['dates']:,}/{len(dates):,}")
+    print(f"Ad-level rows:       {progress['rows']:,}")
+    print(f"Duration:            {elapsed:.1f}s ({progress['dates'] / max(elapsed, 1e-6) * 60:.1f} dates/min)")
+    if failed:
+        print(f"\n✗ Failed after {BACKFILL_RETRIES} attempts: {', '.join(label_for(*r) for r in sorted(failed))}")
+    if mismatched:
+        print("\n✗ Ad-level rows do not match the snapshots (rewritten during the backfill?):")
+        for snapshot_date, snapshots, ad_rows in mismatched:
+            print(f"   {snapshot_date}: {snapshots:,} snapshots, {ad_rows:,} ad rows")
+    if not failed and not mismatched:
+        print("\n✓ Every date checks out")
+    print(f"{'='*60}\n")
+    return sorted({range_first for range_first, _ in failed} | {row[0] for row in mismatched})
+
+def recalculate_dirty_dates(conn=None):
+    """
+    Drain meta_ads.snapshot_dirty_dates (see dirty_dates.py) and recalculate only those
+    dates, with the same single pass as backfill_range(). Returns the dates recalculated.
+    """
+    own_connection = conn is None
+    if own_connection:
+        conn = get_db_connection()
+    try:
+        dates = dirty_dates.drain(conn)
+        if not dates:
+            print("✓ No dirty snapshot dates, daily spend is up to date")
+            return []
+        print(f"Found {len(dates)} dirty snapshot dates: {', '.join(str(d) for d in dates[:10])}{' ...' if len(dates) > 10 else ''}")
+        # Each date's previous day is read too
+        scan_dates = sorted(set(dates) | {d - timedelta(days=1) for d in dates})
+        try:
+            recalculate(
+                conn,
+                "snapshot_date = ANY(%(dates)s::date[])",
+                "snapshot_date = ANY(%(scan_dates)s::date[])",
+                {'dates': [str(d) for d in dates], 'scan_dates': [str(d) for d in scan_dates]},
+                f"{len(dates)} dirty dates",
+            )
+        except Exception:
+            dirty_dates.restore(conn, dates)
+            raise
+        return dates
+    finally:
+        if own_connection:
+            conn.close()
+
+def recalculate_incremental(conn=None, batch_size=INCREMENTAL_BATCH_SIZE):
+    """
+    Apply only the ad snapshots that changed since the last run (meta_ads.snapshot_dirty_ads,
+    see dirty_dates.py) instead of rewriting whole dates.
+    
+    For each batch of changed (ad_id, snapshot_date) pairs (each write marks the next day's
+    pair too, since its daily spend depends on this one):
+    - the pairs' rows in daily_spend_by_ad_table are deleted and recalculated from the
+      snapshots (an ad whose snapshot is gone just loses its row)
+    - the difference between the removed and the new rows (active ads, daily and cumulative
+      spend and impressions) is added to the advertisers' existing rows for those dates;
+      advertisers without a row get one, rows left with no active ads are deleted
+    
+    Each batch is one transaction with its marks, so a failed batch leaves them in place.
+    Marks a snapshot writer has not committed yet are left for the next run. Returns the
+    number of pairs applied.
+    """
+    own_connection = conn is None
+    if own_connection:
+        conn = get_db_connection()
     cur = conn.cursor()
+    # New dates need their partitions first, created outside the batch transactions so the
+    # parents are not locked for a whole batch; existing rows are updated in place
+    partitioned = daily_spend_partitions.is_partitioned(cur, "unified.daily_spend_by_ad_table")
+    # Marks for pruned days are dropped rather than recreating their partitions
+    cutoff = daily_spend_partitions.pruned_before(cur) if partitioned else None
     
-    print("\n" + "="*60)
-    print("BACKFILLING ALL HISTORICAL DATES")
-    print("="*60 + "\n")
+    print(f"\n{'='*60}")
+    print("INCREMENTAL DAILY SPEND UPDATE")
+    print(f"{'='*60}\n")
     
-    # Get all distinct snapshot dates
-    cur.execute("""
-        SELECT DISTINCT snapshot_date 
-        FROM unified.all_daily_snapshots 
-        ORDER BY snapshot_date;
-    """)
+    applied = 0
+    ad_rows = 0
+    advertiser_rows = 0
+    dates = set()
+    try:
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS delta_keys (
+                platform text NOT NULL,
+                ad_id text NOT NULL,
+                snapshot_date date NOT NULL,
+                PRIMARY KEY (platform, ad_id, snapshot_date)
+            ) ON COMMIT DELETE ROWS;
+            
+            -- Removed (-1) and recalculated (+1) ad rows of the batch
+            CREATE TEMP TABLE IF NOT EXISTS delta_changes (
+                LIKE unified.daily_spend_by_ad_table,
+                sign integer NOT NULL
+            ) ON COMMIT DELETE ROWS;
+        """)
+        conn.commit()
+        
+        while True:
+            if partitioned:
+                # Only dates with snapshots get rows; the next-day marks of today's writes do not yet
+                cur.execute(f"""
+                    SELECT d.snapshot_date
+                    FROM (SELECT DISTINCT snapshot_date FROM {dirty_dates.DIRTY_ADS_TABLE}) d
+                    WHERE (%(cutoff)s::date IS NULL OR d.snapshot_date >= %(cutoff)s::date)
+                      AND EXISTS (SELECT 1 FROM unified.all_daily_snapshots s WHERE s.snapshot_date = d.snapshot_date)
+                """, {'cutoff': cutoff})
+                daily_spend_partitions.create_partitions(conn, [row[0] for row in cur.fetchall()])
+            lock_daily_spend(cur)
+            cur.execute(dirty_dates.drain_ads_sql("delta_keys", batch_size))
+            batch = cur.rowcount
+            if not batch:
+                conn.commit()
+                break
+            if partitioned:
+                if cutoff:
+                    cur.execute("DELETE FROM delta_keys WHERE snapshot_date < %s", (cutoff,))
+                cur.execute("""
+                    SELECT DISTINCT k.snapshot_date FROM delta_keys k
+                    WHERE EXISTS (
+                        SELECT 1 FROM unified.all_daily_snapshots s
+                        WHERE s.platform = k.platform AND s.ad_id::text = k.ad_id AND s.snapshot_date = k.snapshot_date
+                    )
+                """)
+                key_dates = {row[0] for row in cur.fetchall()}
+                if any(key_dates - set(daily_spend_partitions.partitions(cur, table))
+                       for table in daily_spend_partitions.DAILY_SPEND_TABLES):
+                    # A date was marked (or got its first snapshots) after the partitions
+                    # were checked; put the batch back and create them first
+                    conn.rollback()
+                    continue
+            
+            # Step 1: replace the batch's ad rows, keeping both versions for the advertiser deltas
+            cur.execute("""
+                WITH removed AS (
+                    DELETE FROM unified.daily_spend_by_ad_table t
+                    USING delta_keys k
+                    WHERE t.platform = k.platform
+                      AND t.ad_id::text = k.ad_id
+                      AND t.snapshot_date = k.snapshot_date
+                    RETURNING t.*
+                )
+                INSERT INTO delta_changes SELECT removed.*, -1 FROM removed;
+                
+                WITH added AS (
+                    INSERT INTO unified.daily_spend_by_ad_table (
+                        platform, ad_id, snapshot_date,
+                        cumulative_spend, cumulative_impressions,
+                        daily_spend, daily_impressions,
+                        spend_lower, spend_upper,
+                        impressions_lower, impressions_upper
+                    )
+                    SELECT 
+                        current_day.platform,
+                        current_day.ad_id,
+                        current_day.snapshot_date,
+                        (current_day.spend_lower + current_day.spend_upper)::numeric / 2.0 as cumulative_spend,
+                        (current_day.impressions_lower + current_day.impressions_upper)::numeric / 2.0 as cumulative_impressions,
+                        -- Daily = current - previous (or current if no previous)
+                        COALESCE(
+                            (current_day.spend_lower + current_day.spend_upper)::numeric / 2.0
+                                - (prev_day.spend_lower + prev_day.spend_upper)::numeric / 2.0,
+                            (current_day.spend_lower + current_day.spend_upper)::numeric / 2.0
+                        ) as daily_spend,
+                        COALESCE(
+                            (current_day.impressions_lower + current_day.impressions_upper)::numeric / 2.0
+                                - (prev_day.impressions_lower + prev_day.impressions_upper)::numeric / 2.0,
+                            (current_day.impressions_lower + current_day.impressions_upper)::numeric / 2.0
+                        ) as daily_impressions,
+                        current_day.spend_lower,
+                        current_day.spend_upper,
+                        current_day.impressions_lower,
+                        current_day.impressions_upper
+                    FROM delta_keys k
+                    INNER JOIN unified.all_daily_snapshots current_day
+                        ON current_day.platform = k.platform
+                       AND current_day.ad_id::text = k.ad_id
+                       AND current_day.snapshot_date = k.snapshot_date
+                    LEFT JOIN unified.all_daily_snapshots prev_day
+                        ON prev_day.platform = current_day.platform
+                       AND prev_day.ad_id = current_day.ad_id
+                       AND prev_day.snapshot_date = (k.snapshot_date - INTERVAL '1 day')::date
+                    RETURNING *
+                )
+                INSERT INTO delta_changes SELECT added.*, 1 FROM added;
+                
+                SELECT
+                    COUNT(*) FILTER (WHERE sign = 1),
+                    array_agg(DISTINCT snapshot_date)
+                FROM delta_changes;
+            """)
+            batch_ad_rows, batch_dates = cur.fetchone()
+            batch_dates = batch_dates or []
+            
+            # Step 2: add the differences to the advertisers' rows
+            cur.execute(f"""
+                WITH {AD_ADVERTISER_MAPPING},
+                deltas AS (
+                    SELECT 
+                        c.platform,
+                        aam.advertiser_name,
+                        aam.advertiser_id,
+                        c.snapshot_date,
+                        SUM(c.sign) as active_ads,
+                        SUM(c.sign * c.daily_spend) as total_daily_spend,
+                        SUM(c.sign * c.daily_impressions) as total_daily_impressions,
+                        SUM(c.sign * c.cumulative_spend) as total_cumulative_spend,
+                        SUM(c.sign * c.cumulative_impressions) as total_cumulative_impressions
+                    FROM delta_changes c
+                    INNER JOIN ad_advertiser_mapping aam 
+                        ON c.ad_id = aam.ad_id AND c.platform = aam.platform
+                    GROUP BY 
+                        c.platform,
+                        aam.advertiser_name,
+                        aam.advertiser_id,
+                        c.snapshot_date
+                ),
+                updated AS (
+                    UPDATE unified.daily_spend_by_advertiser_table t SET
+                        advertiser_name = d.advertiser_name,
+                        active_ads = t.active_ads + d.active_ads,
+                        total_daily_spend = COALESCE(t.total_daily_spend, 0) + COALESCE(d.total_daily_spend, 0),
+                        total_daily_impressions = COALESCE(t.total_daily_impressions, 0) + COALESCE(d.total_daily_impressions, 0),
+                        total_cumulative_spend = COALESCE(t.total_cumulative_spend, 0) + COALESCE(d.total_cumulative_spend, 0),
+                        total_cumulative_impressions = COALESCE(t.total_cumulative_impressions, 0) + COALESCE(d.total_cumulative_impressions, 0)
+                    FROM deltas d
+                    WHERE t.platform = d.platform
+                      AND t.advertiser_id = d.advertiser_id
+                      AND t.snapshot_date = d.snapshot_date
+                    RETURNING t.platform, t.advertiser_id, t.snapshot_date
+                ),
+                inserted AS (
+                    INSERT INTO unified.daily_spend_by_advertiser_table (
+                        platform, advertiser_name, advertiser_id, snapshot_date,
+                        active_ads, total_daily_spend, total_daily_impressions,
+                        total_cumulative_spend, total_cumulative_impressions
+                    )
+                    SELECT 
+                        d.platform, d.advertiser_name, d.advertiser_id, d.snapshot_date,
+                        d.active_ads, d.total_daily_spend, d.total_daily_impressions,
+                        d.total_cumulative_spend, d.total_cumulative_impressions
+                    FROM deltas d
+                    WHERE d.active_ads > 0
+                      AND NOT EXISTS (
+                          SELECT 1 FROM updated u
+                          WHERE u.platform = d.platform
+                            AND u.advertiser_id = d.advertiser_id
+                            AND u.snapshot_date = d.snapshot_date
+                      )
+                    RETURNING 1
+                )
+                SELECT (SELECT COUNT(*) FROM updated) + (SELECT COUNT(*) FROM inserted);
+            """)
+            batch_advertiser_rows = cur.fetchone()[0]
+            
+            # Advertisers whose last active ad for a date went away
+            cur.execute("""
+                DELETE FROM unified.daily_spend_by_advertiser_table
+                WHERE snapshot_date = ANY(%s::date[]) AND active_ads <= 0;
+            """, ([str(d) for d in batch_dates],))
+            
+            conn.commit()
+            applied += batch
+            ad_rows += batch_ad_rows
+            advertiser_rows += batch_advertiser_rows
+            dates.update(batch_dates)
+            print(f"   ✓ Applied {batch:,} changed ad snapshots: {batch_ad_rows:,} ad rows, "
+                  f"{batch_advertiser_rows:,} advertiser rows adjusted")
+            if batch < batch_size:
+                break
+        
+        if applied:
+            print(f"\n✓ Daily spend updated for {applied:,} changed ad snapshots on {len(dates)} dates "
+                  f"({ad_rows:,} ad rows, {advertiser_rows:,} advertiser rows)")
+        else:
+            print("✓ No changed ad snapshots, daily spend is up to date")
+        print(f"{'='*60}\n")
+        return applied
     
-    dates = [row[0] for row in cur.fetchall()]
-    cur.close()
-    conn.close()
+    except Exception as e:
+        conn.rollback()
+        print(f"\n✗ Error: {e}")
+        raise
+    finally:
+        cur.close()
+        if own_connection:
+            conn.close()
+
+def recalculate(conn, target_where, snapshot_where, params, label, verbose=True):
+    """
+    Rewrite both daily spend tables for the snapshot dates matching target_where, reading
+    the snapshots matching snapshot_where (which must include each target date's previous day).
+    Returns the number of ad-level rows written. verbose=False skips the step output and
+    the summary (parallel backfill workers).
     
-    print(f"Found {len(dates)} dates to process: {dates[0]} to {dates[-1]}\n")
+    If the tables are partitioned (daily_spend_partitions.py), the rows are built in temp
+    tables instead and each date is swapped in as a new partition, so nothing is deleted.
+    Dates before the prune cutoff are skipped, so pruned days are not rebuilt.
+    """
+    log = print if verbose else (lambda *args, **kwargs: None)
+    cur = conn.cursor()
     
-    for i, date in enumerate(dates, 1):
-        print(f"\n[{i}/{len(dates)}] Processing {date}...")
-        calculate_daily_spend_for_date(date)
+    log(f"\n{'='*60}")
+    log(f"RECALCULATING DAILY SPEND: {label}")
+    log(f"{'='*60}\n")
     
-    print("\n" + "="*60)
-    print("✓ BACKFILL COMPLETE!")
-    print("="*60 + "\n")
+    partitioned = False
+    try:
+        partitioned = daily_spend_partitions.is_partitioned(cur, "unified.daily_spend_by_ad_table")
+        if partitioned:
+            cutoff = daily_spend_partitions.pruned_before(cur)
+            if cutoff:
+                target_where = f"({target_where}) AND snapshot_date >= %(pruned_before)s::date"
+                params = {**params, 'pruned_before': cutoff}
+            # Held across the per-date swap transactions
+            lock_daily_spend(cur, shared=True, session=True)
+            ad_table = "daily_spend_ad_rows"
+            advertiser_table = "daily_spend_advertiser_rows"
+            cur.execute(f"""
+                DROP TABLE IF EXISTS {ad_table}, {advertiser_table};
+                CREATE TEMP TABLE {ad_table} (LIKE unified.daily_spend_by_ad_table INCLUDING DEFAULTS);
+                CREATE TEMP TABLE {advertiser_table} (LIKE unified.daily_spend_by_advertiser_table INCLUDING DEFAULTS);
+            """)
+        else:
+            lock_daily_spend(cur, shared=True)
+            ad_table = "unified.daily_spend_by_ad_table"
+            advertiser_table = "unified.daily_spend_by_advertiser_table"
+            cur.execute(f"""
+                DELETE FROM {ad_table} WHERE {target_where};
+                DELETE FROM {advertiser_table} WHERE {target_where};
+            """, params)
+        
+        log("Step 1: Calculating daily spend per ad (one pass over the snapshots)...")
+        cur.execute(f"""
+            INSERT INTO {ad_table} (
+                platform, ad_id, snapshot_date,
+                cumulative_spend, cumulative_impressions,
+                daily_spend, daily_impressions,
+                spend_lower, spend_upper,
+                impressions_lower, impressions_upper
+            )
+            SELECT 
+                platform,
+                ad_id,
+                snapshot_date,
+                avg_spend as cumulative_spend,
+                avg_impressions as cumulative_impressions,
+                -- Daily = current - previous day (or current if there is no previous day)
+                COALESCE(CASE WHEN prev_date = (snapshot_date - INTERVAL '1 day')::date THEN avg_spend - prev_spend END, avg_spend) as daily_spend,
+                COALESCE(CASE WHEN prev_date = (snapshot_date - INTERVAL '1 day')::date THEN avg_impressions - prev_impressions END, avg_impressions) as daily_impressions,
+                spend_lower,
+                spend_upper,
+                impressions_lower,
+                impressions_upper
+            FROM (
+                SELECT 
+                    platform,
+                    ad_id,
+                    snapshot_date,
+                    (spend_lower + spend_upper)::numeric / 2.0 as avg_spend,
+                    (impressions_lower + impressions_upper)::numeric / 2.0 as avg_impressions,
+                    LAG(snapshot_date) OVER w as prev_date,
+                    LAG((spend_lower + spend_upper)::numeric / 2.0) OVER w as prev_spend,
+                    LAG((impressions_lower + impressions_upper)::numeric / 2.0) OVER w as prev_impressions,
+                    spend_lower,
+                    spend_upper,
+                    impressions_lower,
+                    impressions_upper
+                FROM unified.all_daily_snapshots
+                WHERE {snapshot_where}
+                WINDOW w AS (PARTITION BY platform, ad_id ORDER BY snapshot_date)
+            ) s
+            WHERE {target_where};
+        """, params)
+        ad_rows = cur.rowcount
+        log(f"   ✓ Inserted {ad_rows} ad-level records")
+        
+        log("\nStep 2: Calculating daily spend per advertiser...")
+        cur.execute(f"""
+            INSERT INTO {advertiser_table} (
+                platform, advertiser_name, advertiser_id, snapshot_date,
+                active_ads, total_daily_spend, total_daily_impressions,
+                total_cumulative_spend, total_cumulative_impressions
+            )
+            WITH {AD_ADVERTISER_MAPPING}
+            SELECT 
+                ds.platform,
+                aam.advertiser_name,
+                aam.advertiser_id,
+                ds.snapshot_date,
+                COUNT(DISTINCT ds.ad_id) as active_ads,
+                SUM(ds.daily_spend) as total_daily_spend,
+                SUM(ds.daily_impressions) as total_daily_impressions,
+                SUM(ds.cumulative_spend) as total_cumulative_spend,
+                SUM(ds.cumulative_impressions) as total_cumulative_impressions
+            FROM {ad_table} ds
+            INNER JOIN ad_advertiser_mapping aam 
+                ON ds.ad_id = aam.ad_id AND ds.platform = aam.platform
+            WHERE {target_where.replace("snapshot_date", "ds.snapshot_date")}
+            GROUP BY 
+                ds.platform,
+                aam.advertiser_name,
+                aam.advertiser_id,
+                ds.snapshot_date;
+        """, params)
+        log(f"   ✓ Inserted {cur.rowcount} advertiser-level records")
+        
+        if partitioned:
+            swap_partitions(conn, cur, ad_table, advertiser_table, target_where, params, log)
+            cur.execute(f"DROP TABLE {ad_table}, {advertiser_table}")
+            unlock_daily_spend(cur)
+            partitioned = False
+        conn.commit()
+        if not verbose:
+            return ad_rows
+        
+        log(f"\n{'='*60}")
+        log("SUMMARY:")
+        log(f"{'='*60}")
+        
+        cur.execute(f"""
+            SELECT 
+                platform,
+                COUNT(DISTINCT snapshot_date) as dates,
+                COUNT(DISTINCT ad_id) as ads,
+                ROUND(SUM(daily_spend)::numeric, 2) as total_daily_spend,
+                SUM(daily_impressions)::bigint as total_impressions
+            FROM unified.daily_spend_by_ad_table
+            WHERE {target_where}
+            GROUP BY platform
+            ORDER BY platform;
+        """, params)
+        
+        for row in cur.fetchall():
+            platform, dates, ads, spend, impressions = row
+            log(f"{platform:8} | {dates:4} dates | {ads:7} ads | ₹{spend:>14} daily spend | {impressions:>14} impressions")
+        
+        log(f"\n✓ Daily spend recalculated for {label}")
+        log(f"{'='*60}\n")
+        return ad_rows
+        
+    except Exception as e:
+        conn.rollback()
+        log(f"\n✗ Error: {e}")
+        if partitioned and not conn.closed:
+            unlock_daily_spend(cur)
+            conn.commit()
+        raise
+    finally:
+        cur.close()
+
+def swap_partitions(conn, cur, ad_table, advertiser_table, target_where, params, log):
+    """
+    Swap the rows built in ad_table / advertiser_table into the partitioned daily spend
+    tables, one short transaction per date. Every date matching target_where that has a
+    partition is swapped, so a date that no longer has snapshots ends up empty.
+    """
+    existing = set()
+    for table in daily_spend_partitions.DAILY_SPEND_TABLES:
+        existing.update(daily_spend_partitions.partitions(cur, table))
+    cur.execute(f"""
+        SELECT snapshot_date FROM {ad_table}
+        UNION
+        SELECT snapshot_date FROM unnest(%(partition_dates)s::date[]) p (snapshot_date)
+        WHERE {target_where}
+        ORDER BY 1;
+    """, {**params, 'partition_dates': [str(d) for d in existing]})
+    dates = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    
+    log(f"\nStep 3: Swapping in {len(dates)} daily partitions...")
+    for snapshot_date in dates:
+        def swap():
+            try:
+                daily_spend_partitions.build_stage(
+                    cur, "unified.daily_spend_by_ad_table", snapshot_date,
+                    f"SELECT * FROM {ad_table} WHERE snapshot_date = %s", (snapshot_date,),
+                )
+                daily_spend_partitions.build_stage(
+                    cur, "unified.daily_spend_by_advertiser_table", snapshot_date,
+                    f"SELECT * FROM {advertiser_table} WHERE snapshot_date = %s", (snapshot_date,),
+                )
+                for table in daily_spend_partitions.DAILY_SPEND_TABLES:
+                    daily_spend_partitions.swap_in(cur, table, snapshot_date)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        # Usually a lock_timeout behind a long dashboard query
+        run_with_retries(f"swap {snapshot_date}", swap)
+    log(f"   ✓ Swapped in {len(dates)} daily partitions")
+
+def backfill_all_dates():
+    """Backfill calculations for all existing snapshot dates"""
+    backfill_range()
+
+def parse_date(value):
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        print(f"Error: Invalid date format '{value}'. Use YYYY-MM-DD format.")
+        sys.exit(1)
+    return value
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    parser = argparse.ArgumentParser(description="Calculate daily spend tables from the daily snapshots.")
+    parser.add_argument("snapshot_date", nargs="?", help="Snapshot date to calculate (YYYY-MM-DD).")
+    parser.add_argument("--backfill", action="store_true", help="Recalculate a range of dates (all dates by default) in one set-based pass.")
+    parser.add_argument("--from", dest="date_from", help="First snapshot date of the --backfill range (YYYY-MM-DD).")
+    parser.add_argument("--to", dest="date_to", help="Last snapshot date of the --backfill range (YYYY-MM-DD).")
+    parser.add_argument("--jobs", type=int, default=1, help="Split the --backfill range over this many parallel DB connections (default: 1, one pass).")
+    parser.add_argument("--dirty", action="store_true", help="Recalculate only the snapshot dates marked dirty by snapshot writes since the last run.")
+    parser.add_argument("--partition", action="store_true", help="Convert the daily spend tables to daily partitions (one-off, see daily_spend_partitions.py).")
+    parser.add_argument("--prune-older-than", type=int, metavar="DAYS", help="Drop the daily spend partitions of snapshot dates more than DAYS days old.")
+    parser.add_argument("--archive-schema", help="With --prune-older-than, move old partitions to this schema instead of dropping them.")
+    parser.add_argument("--incremental", action="store_true", help="Update only the ads whose snapshots changed since the last run, adjusting the advertiser totals by the difference.")
+    args = parser.parse_args()
+    
+    if args.partition or args.prune_older_than:
+        conn = get_db_connection()
+        try:
+            if args.partition:
+                daily_spend_partitions.partition_tables(conn)
+            if args.prune_older_than:
+                daily_spend_partitions.prune_partitions(
+                    conn, (datetime.now() - timedelta(days=args.prune_older_than)).date(), args.archive_schema
+                )
+        finally:
+            conn.close()
+    elif args.incremental:
+        recalculate_incremental()
+    elif args.dirty:
+        recalculate_dirty_dates()
+    elif args.backfill or args.date_from or args.date_to:
+        date_from = parse_date(args.date_from) if args.date_from else None
+        date_to = parse_date(args.date_to) if args.date_to else None
+        if args.jobs > 1:
+            if parallel_backfill(date_from, date_to, jobs=args.jobs):
+                sys.exit(1)
+        else:
+            backfill_range(date_from, date_to)
+    elif args.snapshot_date:
+        calculate_daily_spend_for_date(parse_date(args.snapshot_date))
+    else:
         print("Usage:")
         print("  1. Calculate for specific date:  python calculate_daily_spend.py 2025-11-10")
         print("  2. Backfill all historical dates: python calculate_daily_spend.py --backfill")
+        print("  3. Backfill a range of dates:     python calculate_daily_spend.py --backfill --from 2025-11-01 --to 2025-11-10")
+        print("  4. Recalculate changed dates:     python calculate_daily_spend.py --dirty")
+        print("  5. Update changed ads only:       python calculate_daily_spend.py --incremental")
+        print("  6. Partition the tables by day:   python calculate_daily_spend.py --partition")
+        print("  7. Drop (or archive) old days:    python calculate_daily_spend.py --prune-older-than 400")
         sys.exit(1)
-    
-    if sys.argv[1] == '--backfill':
-        backfill_all_dates()
-    else:
-        snapshot_date = sys.argv[1]
-        # Validate date format
-        try:
-            datetime.strptime(snapshot_date, '%Y-%m-%d')
-        except ValueError:
-            print(f"Error: Invalid date format '{snapshot_date}'. Use YYYY-MM-DD format.")
-            sys.exit(1)
-        
-        calculate_daily_spend_for_date(snapshot_date)
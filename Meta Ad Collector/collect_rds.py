@@ -9,6 +9,8 @@ To use with AWS RDS:
     - The script will connect to RDS by default; no local DB config is needed.
 
 This script should be run via cron job or other scheduling tool daily for each country collected.
+Several countries can be collected by one run (e.g. `IN US BR`, or --countries-file): they share
+the API quota fairly, one warmed ad cache and one DB connection pool, and a combined summary is printed.
 If you want data for a period longer than 2 days, adjust the arguments accordingly.
 
 More explanation of the script can be found in the README.md file.
@@ -22,9 +24,15 @@ import argparse
 
 from time import sleep
 from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from fb_ads_library_api import FbAdsLibraryTraversal
-from push_to_rds import SQLInserter  # Using the RDS database module
+from traversal_checkpoint import CheckpointStore
+from rate_governor import FairShareGovernor, FairTurnstile, get_governor
+from ad_refresh import read_ad_ids, refresh_ads
+from light_sweep import LightSweep, LIGHT_FIELDS
+from collection_pipeline import CollectionPipeline
+from push_to_rds import SQLInserter, get_pool, POOL_MAX_CONNECTIONS  # Using the RDS database module
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 try:
@@ -39,9 +47,23 @@ except Exception:
 
 api_key = os.environ.get("FACEBOOK_API_KEY")
 
-if not api_key:
-    print("API key not set. Please set the FACEBOOK_API_KEY environment variable.")
-    sys.exit(1)
+# --incremental runs start this far before the country's watermark, to be safe
+WATERMARK_OVERLAP = timedelta(minutes=int(os.environ.get("COLLECT_WATERMARK_OVERLAP_MINUTES", "60")))
+
+FIELDS = "id,ad_creation_time,ad_creative_bodies,ad_creative_link_captions,ad_creative_link_descriptions,ad_creative_link_titles,ad_delivery_start_time,ad_delivery_stop_time,ad_snapshot_url,currency,delivery_by_region,demographic_distribution,bylines,impressions,languages,page_id,page_name,publisher_platforms,spend,target_locations,target_gender,target_ages,estimated_audience_size"
+
+page_limit = 100
+
+# --- TESTING TOGGLE ---
+# Set TESTING to True to limit the number of ads collected.
+# Set it to False for a normal, full collection run.
+TESTING = False
+TEST_LIMIT = 1
+
+# Pipeline sizing: pages fetched ahead of the database writer, and pages per DB commit
+PREFETCH_PAGES = 4
+WRITE_BATCH_PAGES = 4
+# --------------------
 
 def parse_duration(duration_str):
     """Parses a duration string like '12h', '1d', '30m' into a timedelta."""
@@ -56,83 +78,46 @@ def parse_duration(duration_str):
     else:
         raise ValueError("Invalid duration unit. Use 'h' for hours, 'd' for days, or 'm' for minutes.")
 
-if __name__=="__main__":
-    parser = argparse.ArgumentParser(description="Collect ads from the Facebook Ads Library.")
-    parser.add_argument("country", help="The 2-letter country code to collect ads for (e.g., 'IN', 'US').")
-    parser.add_argument("--start-date", help="Start date for collection in YYYY-MM-DD format.")
-    parser.add_argument("--end-date", help="End date for collection in YYYY-MM-DD format.")
-    parser.add_argument("--last", help="Collect ads from the last specified duration (e.g., '12h', '1d', '30m').")
-    parser.add_argument("--ad-id", help="Fetch and print data for a single ad ID, then exit.")
-    
-    args = parser.parse_args()
+def read_countries(path):
+    """Country codes from a file: separated by newlines, commas or spaces, # comments ignored."""
+    countries = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0]
+            countries.extend(token.upper() for token in line.replace(",", " ").split() if token)
+    return countries
 
-        # If --ad-id is used, fetch and update data for a single ad ID, then exit.
-    if args.ad_id:
-        print(f"Attempting to fetch and update data for single ad ID: {args.ad_id}")
-        fields = "id,ad_creation_time,ad_creative_bodies,ad_creative_link_captions,ad_creative_link_descriptions,ad_creative_link_titles,ad_delivery_start_time,ad_delivery_stop_time,ad_snapshot_url,currency,delivery_by_region,demographic_distribution,bylines,impressions,languages,page_id,page_name,publisher_platforms,spend,target_locations,target_gender,target_ages,estimated_audience_size"
-        api_version = "v23.0"
-
-        # Using the search_terms parameter for a direct ID lookup.
-        url = (
-            f"https://graph.facebook.com/{api_version}/ads_archive?"
-            f"search_terms={args.ad_id}&"
-            f"ad_type=POLITICAL_AND_ISSUE_ADS&"
-            f"ad_reached_countries=['{args.country}']&"
-            f"fields={fields}&"
-            f"access_token={api_key}"
-        )
-        
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            data = response.json()
-
-            if data and data.get('data'):
-                ad_data = data['data'][0]
-                print("Successfully fetched new data for the ad.")
-                
-                # Use the existing SQLInserter to update the database
-                sql_inserter = SQLInserter(args.country)
-                sql_inserter.insert_ad(ad_data)
-                
-                # Also insert a daily snapshot for this ad
-                # Use yesterday's date since we run this at 1-2AM and collect previous day's data
-                snapshot_date = date.today() - timedelta(days=1)
-                snapshot = [(
-                    ad_data['id'],
-                    snapshot_date,
-                    ad_data.get("impressions", {}).get("lower_bound"),
-                    ad_data.get("impressions", {}).get("upper_bound"),
-                    ad_data.get("spend", {}).get("lower_bound"),
-                    ad_data.get("spend", {}).get("upper_bound")
-                )]
-                sql_inserter.bulk_insert_snapshots(snapshot)
-                
-                print(f"Successfully updated ad {args.ad_id} in the database.")
-
-            else:
-                print("API returned no data for this ad ID. Database was not updated.")
-                print("Full API response:", json.dumps(data, indent=2))
-            
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching ad data: {e}")
-            if 'response' in locals():
-                print(f"Response content: {response.text}")
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-            
-        sys.exit(0)
-    
-    country = args.country
-    after_date = None
-    before_date = None
-    
-    country = args.country
+def run_args_key(args):
+    """The arguments that decide a run's window, as given (before resolving relative dates)."""
+    return "|".join(str(part) for part in (args.incremental, args.last, args.start_date, args.end_date))
+
+def resolve_window(country, args, checkpoints, started):
+    """
+    Return (after_date, before_date, filter_start_time, watermark, run_started) for one
+    country's run started at `started`. With --resume, an unfinished run with the same
+    arguments keeps the window it resolved and the time it started, which is what its
+    window covers up to.
+    """
     after_date = None
     before_date = None
     filter_start_time = None
+    watermark = checkpoints.get_watermark(country) if args.incremental else None
+
+    saved = checkpoints.get_run_window(country, run_args_key(args)) if args.resume else None
+    if saved:
+        after_date, before_date, filter_start_time, run_started = saved
+        print(f"Resuming the unfinished run for country '{country}' over its window {after_date} to {before_date}"
+              + (f" (since {filter_start_time:%Y-%m-%d %H:%M:%S})" if filter_start_time else ""))
+        return after_date, before_date, filter_start_time, watermark, run_started or started
 
-    if args.last:
+    if watermark:
+        # Incremental mode: everything delivered since the last completed run
+        filter_start_time = watermark - WATERMARK_OVERLAP
+        after_date = filter_start_time.strftime('%Y-%m-%d')
+        before_date = date.today().strftime('%Y-%m-%d')
+        print(f"Collecting ads for country '{country}' since the last completed run at {watermark:%Y-%m-%d %H:%M:%S} "
+              f"(from {filter_start_time:%Y-%m-%d %H:%M:%S}, {WATERMARK_OVERLAP} overlap)")
+    elif args.last:
         # Relative time mode
         duration = parse_duration(args.last)
         filter_start_time = datetime.now() - duration
@@ -150,138 +135,212 @@ if __name__=="__main__":
         after_date = filter_start_time.strftime('%Y-%m-%d')
         before_date = date.today().strftime('%Y-%m-%d')
         print(f"No date range specified. Defaulting to the last 24 hours for country '{country}'.")
+    if args.incremental and not watermark:
+        print(f"No watermark for '{country}' yet; this run will set it once it completes.")
+    checkpoints.save_run_window(country, run_args_key(args), after_date, before_date, filter_start_time, started)
+    return after_date, before_date, filter_start_time, watermark, started
 
-    print(f"Beginning ad collection at: {datetime.now()}")
+def retry_deferred_ads(country, checkpoints, sql_inserter):
+    """Look up again the new ads an earlier --light run could not fetch in full."""
+    deferred = checkpoints.deferred_ads(country)
+    if not deferred:
+        return
+    print(f"Retrying {len(deferred)} ads deferred by an earlier light sweep for '{country}'...")
+    result = refresh_ads(sql_inserter, api_key, country, deferred)
+    failed = set(result['not_found']) | set(result['errors'])
+    given_up = checkpoints.settle_deferred_ads(
+        country, [ad_id for ad_id in deferred if ad_id not in failed], failed
+    )
+    if given_up:
+        print(f"Gave up on {len(given_up)} deferred ads for '{country}': {', '.join(given_up[:20])}")
 
-    page_limit = 100
-    n = 0
+def collect_country(country, args, checkpoints, cache=None, governor=None):
+    """
+    Collect one country's ads for the window given by args. Returns a summary dict
+    {'country', 'ads_written', 'pages', 'error', 'seconds'}; errors are reported there
+    rather than raised, so one country failing does not stop the others.
 
-    # --- TESTING TOGGLE ---
-    # Set TESTING to True to limit the number of ads collected.
-    # Set it to False for a normal, full collection run.
-    TESTING = False
-    TEST_LIMIT = 1
-    
-    # Batch size for daily snapshot inserts
-    BATCH_SIZE = 100  # Insert snapshots every 100 ads during testing
-    AD_COMMIT_BATCH = 50  # Commit ads every 50 instead of 100 for better balance
-    # --------------------
-            
+    cache: AdIndexCache shared with other countries' inserters (warmed once per process)
+    governor: pacing for this country's API requests, see rate_governor.FairShareGovernor
+    """
+    summary = {'country': country, 'ads_written': 0, 'pages': 0, 'error': None, 'seconds': 0}
+    started = datetime.now()
+    light_sweep = None
+    sql_inserter = None
+    pipeline = None
     try:
+        after_date, before_date, filter_start_time, watermark, run_started = resolve_window(
+            country, args, checkpoints, started
+        )
+        print(f"Beginning ad collection for '{country}' at: {datetime.now()}")
+
         collector = FbAdsLibraryTraversal(
             api_key,
-            "id,ad_creation_time,ad_creative_bodies,ad_creative_link_captions,ad_creative_link_descriptions,ad_creative_link_titles,ad_delivery_start_time,ad_delivery_stop_time,ad_snapshot_url,currency,delivery_by_region,demographic_distribution,bylines,impressions,languages,page_id,page_name,publisher_platforms,spend,target_locations,target_gender,target_ages,estimated_audience_size",
+            LIGHT_FIELDS if args.light else FIELDS,
             ".",
             country,
             after_date=after_date,
             before_date=before_date,
             page_limit=page_limit,
             api_version="v23.0", # Current version as of Sep 2025
+            governor=governor,
         )
 
-        sql_inserter = SQLInserter(country)
-        
-        n = 0
-        daily_snapshots = []  # Collect snapshots for batch insert
-        
-        collection_complete = False
-        for ads in collector.generate_ad_archives():
-            if ads:
-                batch_size = len(ads)
-                ads_in_batch_processed = 0
-                for ad in ads:
-                    # If in relative time mode, filter by active delivery time
-                    if filter_start_time:
-                        start_time_str = ad.get("ad_delivery_start_time")
-                        stop_time_str = ad.get("ad_delivery_stop_time")
-                        
-                        # An ad is considered active in the window if its delivery period
-                        # overlaps with the user's requested time window.
-                        # [ad_start, ad_stop] overlaps with [filter_start, now]
-                        
-                        is_active_in_window = False
-                        if start_time_str:
-                            # Parse start time, ignoring timezone for direct comparison
-                            ad_start_time = datetime.fromisoformat(start_time_str.split('+')[0])
-                            
-                            # If the ad has a stop time
-                            if stop_time_str:
-                                ad_stop_time = datetime.fromisoformat(stop_time_str.split('+')[0])
-                                # Overlap condition: (StartA <= EndB) and (EndA >= StartB)
-                                if ad_start_time <= datetime.now() and ad_stop_time >= filter_start_time:
-                                    is_active_in_window = True
-                            # If the ad is still running (no stop time)
-                            else:
-                                # Check if it started before the window ended
-                                if ad_start_time <= datetime.now():
-                                    is_active_in_window = True
-                        
-                        if not is_active_in_window:
-                            continue # Skip ad if it was not active in the window
-                    
-                    # Insert/Update ad in main tables (no auto-commit, batch commit later)
-                    sql_inserter.insert_ad(ad, auto_commit=False)
-                    
-                    # Collect daily snapshot data (don't insert yet)
-                    # Use yesterday's date since we run this at 1-2AM and collect previous day's data
-                    snapshot_date = date.today() - timedelta(days=1)
-                    daily_snapshots.append((
-                        ad['id'],
-                        snapshot_date,
-                        ad.get("impressions", {}).get("lower_bound"),
-                        ad.get("impressions", {}).get("upper_bound"),
-                        ad.get("spend", {}).get("lower_bound"),
-                        ad.get("spend", {}).get("upper_bound")
-                    ))
-                    
-                    n += 1
-                    ads_in_batch_processed += 1
-                    
-                    # Progress indicator
-                    if n % 10 == 0:
-                        print(f"  → Processed {n} ads so far...")
-                    
-                    # Commit every AD_COMMIT_BATCH ads for better balance
-                    if ads_in_batch_processed % AD_COMMIT_BATCH == 0:
-                        sql_inserter.connection.commit()
-                    
-                    # When we reach batch size, insert snapshots
-                    if len(daily_snapshots) >= BATCH_SIZE:
-                        sql_inserter.bulk_insert_snapshots(daily_snapshots)
-                        daily_snapshots = []  # Clear for next batch
-                    
-                    # Check if the testing limit has been reached
-                    if TESTING and n >= TEST_LIMIT:
-                        print(f"\n--- Testing limit of {TEST_LIMIT} ads reached. Stopping collection. ---")
-                        collection_complete = True
-                        break
-                
-                # Commit all ads in this batch at once
-                sql_inserter.connection.commit()
-                
-                print(f"Fetched a batch of {batch_size} ads. Processed {ads_in_batch_processed} ads within the time window. Total collected so far: {n}")
-
-                # If we are in relative time mode and a full batch was fetched but nothing was processed,
-                # it means we have reached ads older than our time window.
-                if filter_start_time and batch_size == page_limit and ads_in_batch_processed == 0:
-                    print("Found a full page of ads older than the specified time window. Stopping collection.")
-                    collection_complete = True
-
-            if collection_complete:
-                break
-
-            if not ads:
-                print("[DIAGNOSTIC] Received an empty batch of ads. There may be no ads matching the criteria.")
-                break # Exit if there are no more ads to fetch
-
-        # Insert any remaining snapshots after the loop
-        if daily_snapshots:
-            sql_inserter.bulk_insert_snapshots(daily_snapshots)
-            print(f"Inserted final batch of {len(daily_snapshots)} snapshots")
+        # Warm the page/ad cache once so already-known ads are written without their child rows
+        if cache is None:
+            sql_inserter = SQLInserter(country, warm_cache=True)
+        else:
+            sql_inserter = SQLInserter(country, cache=cache)
+
+        if not TESTING:
+            retry_deferred_ads(country, checkpoints, sql_inserter)
+
+        if args.light:
+            # Known ads keep their light records; new ones are fetched again with every field
+            light_sweep = LightSweep(sql_inserter.cache, SQLInserter(country, cache=sql_inserter.cache), api_key, country)
+
+        if args.shards > 1:
+            ad_pages = collector.generate_ad_archives_sharded(
+                max_workers=args.shards, checkpoint_store=checkpoints, resume=args.resume
+            )
+        else:
+            ad_pages = collector.generate_ad_archives(checkpoint_store=checkpoints, resume=args.resume)
+
+        # Fetching, filtering and DB writes run as overlapping stages (see collection_pipeline.py)
+        pipeline = CollectionPipeline(
+            sql_inserter,
+            checkpoints=checkpoints,
+            filter_start_time=filter_start_time,
+            # Sharded pages interleave several windows, so one stale page says nothing about the rest.
+            stop_on_stale_page=bool(filter_start_time) and args.shards <= 1,
+            page_limit=page_limit,
+            prefetch_pages=PREFETCH_PAGES,
+            write_batch_pages=WRITE_BATCH_PAGES,
+            max_ads=TEST_LIMIT if TESTING else None,
+            complete_ads=light_sweep.complete if light_sweep else None,
+        )
+        pipeline.run(ad_pages)
+        checkpoints.clear_run_window(country)
+
+        # Only a window that reaches up to today covers everything delivered before this run started
+        if args.incremental and not TESTING and before_date >= run_started.strftime('%Y-%m-%d'):
+            checkpoints.set_watermark(country, run_started, run_key=collector._checkpoint_run_key(checkpoints))
+            print(f"Watermark for '{country}' advanced to {run_started:%Y-%m-%d %H:%M:%S}")
 
     except Exception as e:
-        print("Encountered Error!")
+        print(f"Encountered Error for '{country}'!")
         print(e)
+        summary['error'] = str(e)[:200]
     finally:
-        print(f'Got {n} ads | on {str(datetime.now())}')
+        if pipeline:
+            summary['ads_written'] = pipeline.ads_written
+            summary['pages'] = pipeline.pages_fetched
+        if light_sweep:
+            light_sweep.close()
+            light_sweep.print_summary()
+            if light_sweep.deferred_ads:
+                # The window, its checkpoints and the watermark move on without them
+                checkpoints.add_deferred_ads(country, light_sweep.deferred_ads)
+        if sql_inserter:
+            sql_inserter.close_db()
+        summary['seconds'] = (datetime.now() - started).total_seconds()
+        print(f"Got {summary['ads_written']} ads | on {str(datetime.now())}")
         print('Finished ad collection for country: ', country, "\nAt: ", datetime.now())
+    return summary
+
+def collect_countries(countries, args, checkpoints, cache=None):
+    """
+    Collect several countries in one process, one thread each. They share the API key's
+    rate governor through a FairTurnstile (the country served least goes next), one warmed
+    AdIndexCache and one connection pool; every country still writes its own batches.
+    """
+    # A writer connection per country, plus one for --light cache misses
+    get_pool(max_connections=max(POOL_MAX_CONNECTIONS, len(countries) * (2 if args.light else 1)))
+    turnstile = FairTurnstile(get_governor(api_key))
+
+    if cache is None:
+        warm_inserter = SQLInserter(countries[0], warm_cache=True)
+        cache = warm_inserter.cache
+        warm_inserter.close_db()
+
+    print(f"Collecting {len(countries)} countries in one process: {', '.join(countries)}")
+    started = datetime.now()
+    with ThreadPoolExecutor(max_workers=len(countries), thread_name_prefix="collect") as executor:
+        futures = [
+            executor.submit(collect_country, country, args, checkpoints, cache, FairShareGovernor(turnstile, country))
+            for country in countries
+        ]
+        summaries = [future.result() for future in futures]
+    elapsed = (datetime.now() - started).total_seconds()
+
+    print(f"\n{'='*60}")
+    print("MULTI-COUNTRY COLLECTION SUMMARY")
+    print(f"{'='*60}")
+    print(f"{'Country':<9}{'Ads':>10}{'Pages':>8}{'API calls':>11}{'Minutes':>9}  Status")
+    for summary in summaries:
+        status = f"error: {summary['error']}" if summary['error'] else "ok"
+        print(f"{summary['country']:<9}{summary['ads_written']:>10,}{summary['pages']:>8,}"
+              f"{turnstile.served.get(summary['country'], 0):>11,}{summary['seconds'] / 60:>9.1f}  {status}")
+    print(f"{'Total':<9}{sum(s['ads_written'] for s in summaries):>10,}{sum(s['pages'] for s in summaries):>8,}"
+          f"{sum(turnstile.served.values()):>11,}{elapsed / 60:>9.1f}")
+    return summaries
+
+def collect(countries, args, checkpoints, cache=None):
+    """Collect one or several countries; returns their summaries (see collect_country)."""
+    if len(countries) == 1:
+        return [collect_country(countries[0], args, checkpoints, cache=cache)]
+    return collect_countries(countries, args, checkpoints, cache=cache)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Collect ads from the Facebook Ads Library.")
+    parser.add_argument("countries", nargs="*", help="2-letter country codes to collect ads for (e.g., 'IN', 'US'). Several countries run in one process and share the API quota.")
+    parser.add_argument("--countries-file", help="Read country codes from this file (one per line, # comments allowed) in addition to the ones given.")
+    parser.add_argument("--start-date", help="Start date for collection in YYYY-MM-DD format.")
+    parser.add_argument("--end-date", help="End date for collection in YYYY-MM-DD format.")
+    parser.add_argument("--last", help="Collect ads from the last specified duration (e.g., '12h', '1d', '30m').")
+    parser.add_argument("--ad-id", help="Fetch and update one or more ad IDs (comma-separated), then exit.")
+    parser.add_argument("--ad-ids-file", help="Fetch and update every ad ID listed in this file ('-' for stdin), then exit.")
+    parser.add_argument("--shards", type=int, default=1, help="Walk the date range as this many concurrent date windows (useful for long --start-date backfills).")
+    parser.add_argument("--resume", action="store_true", help="Continue the last run over the same country and date range from its last committed page.")
+    parser.add_argument("--incremental", action="store_true", help="Collect only what was delivered since the country's last completed --incremental run (with a small overlap).")
+    parser.add_argument("--light", action="store_true", help="Sweep with a light field set and fetch the full fields only for ads not in the database yet.")
+    return parser
+
+if __name__=="__main__":
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if not api_key:
+        print("API key not set. Please set the FACEBOOK_API_KEY environment variable.")
+        sys.exit(1)
+
+    countries = list(args.countries)
+    if args.countries_file:
+        countries.extend(read_countries(args.countries_file))
+    countries = list(dict.fromkeys(countries))
+    if not countries:
+        parser.error("give at least one country code (or --countries-file)")
+
+        # If --ad-id or --ad-ids-file is used, fetch and update just those ads, then exit.
+    if args.ad_id or args.ad_ids_file:
+        if args.ad_ids_file:
+            ad_ids = read_ad_ids(args.ad_ids_file)
+        else:
+            ad_ids = [ad_id.strip() for ad_id in args.ad_id.split(",") if ad_id.strip()]
+        print(f"Attempting to fetch and update data for {len(ad_ids)} ad ID(s)")
+        
+        # One SQLInserter (one pooled connection) for every chunk; lookups use the first country
+        sql_inserter = SQLInserter(countries[0])
+        try:
+            result = refresh_ads(sql_inserter, api_key, countries[0], ad_ids)
+        finally:
+            sql_inserter.close_db()
+            
+        sys.exit(1 if result['errors'] else 0)
+    
+    # Every committed page's cursor is checkpointed, so a crashed run can be continued with --resume.
+    # The same store keeps the per-country watermark for --incremental runs.
+    checkpoints = CheckpointStore()
+
+    summaries = collect(countries, args, checkpoints)
+    sys.exit(1 if any(summary['error'] for summary in summaries) else 0)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Staged collection pipeline used by collect_rds.py and collect_local.py.
+
+Fetching a page from Meta and writing it to the database used to be strictly serialized.
+Here they overlap:
+
+    fetch thread  --(bounded queue, N pages prefetched)-->  filter stage (caller's thread)
+    filter stage  --(bounded queue)-->  writer thread (batches pages into one commit)
+
+Both queues are bounded, so a slow writer backs up the filter stage, which in turn stops
+the fetch thread from running ahead by more than `prefetch_pages` pages.
+A page's checkpoint is only recorded by the writer, after its ads and snapshots are committed.
+"""
+
+import queue
+import threading
+from datetime import date, datetime, timedelta
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def is_active_in_window(ad, filter_start_time):
+    """
+    An ad is considered active in the window if its delivery period
+    overlaps with the requested time window [filter_start_time, now].
+    """
+    start_time_str = ad.get("ad_delivery_start_time")
+    stop_time_str = ad.get("ad_delivery_stop_time")
+    if not start_time_str:
+        return False
+
+    # Parse start time, ignoring timezone for direct comparison
+    ad_start_time = datetime.fromisoformat(start_time_str.split('+')[0])
+    if ad_start_time > datetime.now():
+        return False
+    # If the ad is still running (no stop time) it overlaps the window
+    if not stop_time_str:
+        return True
+    ad_stop_time = datetime.fromisoformat(stop_time_str.split('+')[0])
+    return ad_stop_time >= filter_start_time
+
+
+def snapshot_row(ad, snapshot_date):
+    return (
+        ad['id'],
+        snapshot_date,
+        ad.get("impressions", {}).get("lower_bound"),
+        ad.get("impressions", {}).get("upper_bound"),
+        ad.get("spend", {}).get("lower_bound"),
+        ad.get("spend", {}).get("upper_bound")
+    )
+
+
+class CollectionPipeline:
+    def __init__(
+        self,
+        sql_inserter,
+        checkpoints=None,
+        filter_start_time=None,
+        stop_on_stale_page=False,
+        page_limit=100,
+        prefetch_pages=4,
+        write_batch_pages=4,
+        max_ads=None,
+        snapshot_date=None,
+        complete_ads=None,
+    ):
+        """
+        Args:
+            sql_inserter: SQLInserter used only by the writer thread
+            checkpoints: optional CheckpointStore; pages are recorded once committed
+            filter_start_time: keep only ads delivering since this time (--last mode)
+            stop_on_stale_page: stop once a full page has no ads in the window
+            prefetch_pages: pages the fetch thread may run ahead of the filter stage
+            write_batch_pages: pages the writer may combine into one commit
+            max_ads: stop after this many ads (testing)
+            snapshot_date: date for the daily snapshots, defaults to yesterday since we
+                run at 1-2AM and collect the previous day's data
+            complete_ads: optional callable run on each page's accepted ads before they are
+                queued for writing, e.g. LightSweep.complete (--light)
+        """
+        self.sql_inserter = sql_inserter
+        self.checkpoints = checkpoints
+        self.filter_start_time = filter_start_time
+        self.stop_on_stale_page = stop_on_stale_page
+        self.page_limit = page_limit
+        self.write_batch_pages = write_batch_pages
+        self.max_ads = max_ads
+        self.snapshot_date = snapshot_date or (date.today() - timedelta(days=1))
+        self.complete_ads = complete_ads
+
+        self.fetched = queue.Queue(maxsize=prefetch_pages)
+        self.to_write = queue.Queue(maxsize=write_batch_pages * 2)
+        self.stop_event = threading.Event()
+        self.write_error = None
+        self.ads_accepted = 0
+        self.ads_written = 0
+        self.pages_fetched = 0
+
+    def _put(self, target, item, alive=None):
+        # Bounded put that gives up if the pipeline is shutting down or the consumer died
+        while True:
+            try:
+                target.put(item, timeout=1)
+                return True
+            except queue.Full:
+                if self.stop_event.is_set() or (alive is not None and not alive()):
+                    return False
+
+    def _fetch(self, ad_pages):
+        try:
+            for page in ad_pages:
+                if self.stop_event.is_set() or not self._put(self.fetched, page):
+                    break
+        except BaseException as error:
+            self._put(self.fetched, _Failure(error))
+        finally:
+            close = getattr(ad_pages, "close", None)
+            if close:
+                close()
+            self._put(self.fetched, _END)
+
+    def _write_batch(self, batch):
+        # Ads, their child rows and the snapshots go in as one set-based transaction
+        ads = [ad for _, page_ads, _ in batch for ad in page_ads]
+        snapshots = [row for _, _, rows in batch for row in rows]
+        self.sql_inserter.insert_ads_bulk(ads, snapshots)
+
+        # Everything in the batch is durable now
+        for page, ads, _ in batch:
+            self.ads_written += len(ads)
+            if self.checkpoints:
+                self.checkpoints.record_page(page, len(ads))
+        print(f"  → Wrote {sum(len(ads) for _, ads, _ in batch)} ads from {len(batch)} page(s). Total written: {self.ads_written}")
+
+    def _write(self):
+        try:
+            finished = False
+            while not finished:
+                item = self.to_write.get()
+                if item is _END:
+                    break
+                batch = [item]
+                # Drain whatever else is already waiting, up to one commit's worth
+                while len(batch) < self.write_batch_pages:
+                    try:
+                        item = self.to_write.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _END:
+                        finished = True
+                        break
+                    batch.append(item)
+                self._write_batch(batch)
+        except BaseException as error:
+            self.write_error = error
+            self.stop_event.set()
+
+    def run(self, ad_pages):
+        """Run the pipeline over a page generator; returns the number of ads written."""
+        fetcher = threading.Thread(target=self._fetch, args=(ad_pages,), name="collect-fetch", daemon=True)
+        writer = threading.Thread(target=self._write, name="collect-write", daemon=True)
+        fetcher.start()
+        writer.start()
+        try:
+            while self.write_error is None:
+                try:
+                    item = self.fetched.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if item is _END:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+
+                page = item
+                self.pages_fetched += 1
+                if self.filter_start_time:
+                    # Skip ads that were not active in the window
+                    ads = [ad for ad in page if is_active_in_window(ad, self.filter_start_time)]
+                else:
+                    ads = list(page)
+
+                limit_reached = False
+                if self.max_ads is not None and self.ads_accepted + len(ads) >= self.max_ads:
+                    ads = ads[:self.max_ads - self.ads_accepted]
+                    limit_reached = True
+                self.ads_accepted += len(ads)
+                # Counted before completion, which may defer ads that are in the window
+                in_window = len(ads)
+
+                if self.complete_ads and ads:
+                    ads = self.complete_ads(ads)
+                snapshots = [snapshot_row(ad, self.snapshot_date) for ad in ads]
+                if not self._put(self.to_write, (page, ads, snapshots), alive=writer.is_alive):
+                    break
+                print(f"Fetched a batch of {len(page)} ads. Processed {len(ads)} ads within the time window. Total collected so far: {self.ads_accepted}")
+
+                if limit_reached:
+                    print(f"\n--- Testing limit of {self.max_ads} ads reached. Stopping collection. ---")
+                    break
+                # If we are in relative time mode and a full batch was fetched but nothing was processed,
+                # it means we have reached ads older than our time window.
+                if self.stop_on_stale_page and len(page) == self.page_limit and not in_window:
+                    print("Found a full page of ads older than the specified time window. Stopping collection.")
+                    break
+        finally:
+            # Stop fetching, then let the writer drain everything already accepted
+            self.stop_event.set()
+            if writer.is_alive():
+                while True:
+                    try:
+                        self.to_write.put(_END, timeout=1)
+                        break
+                    except queue.Full:
+                        if not writer.is_alive():
+                            break
+            writer.join()
+            fetcher.join(timeout=5)
+
+        if self.write_error is not None:
+            raise self.write_error
+        return self.ads_written
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Long-running collector: collection, stale-ad recollection and daily-spend jobs on internal
+schedules, in one warm process.
+
+Every cron run of collect_rds.py, recollect_inactive_rds_optimized.py and
+calculate_daily_spend.py pays interpreter start, heavy imports, .env loading, fresh
+DB/TLS connections and (for collection) warming the ad cache. The daemon pays that once:
+
+    DB          one push_to_rds connection pool, shared by every job
+    HTTP        the traversals' module-level keep-alive sessions stay open
+    ad cache    the collection's AdIndexCache is warmed once and re-warmed every
+                DAEMON_CACHE_MAX_AGE_HOURS (ads written by other processes are only
+                missed, which costs an extra upsert, never a wrong row)
+    state       the CheckpointStore (watermarks for --incremental) stays open
+
+Jobs run one at a time, most overdue first, so collection and recollection never fight
+over the API quota. Recollection gets a --max-minutes budget that ends before the next
+collection is due. Each job also takes a Postgres advisory lock, so a second daemon (or
+a manual run through the daemon's --once) skips a job that is already running elsewhere.
+
+Usage:
+    python3 collector_daemon.py IN US --collect-every 60 --recollect-every 360 --daily-spend-at 02:30
+    python3 collector_daemon.py IN --collect-args "--last 2h --light" --recollect-args "--queue"
+    python3 collector_daemon.py IN --once            # run every job once, then exit
+
+SIGINT/SIGTERM finish the running job and exit; a second signal stops immediately.
+"""
+
+import os
+import sys
+import shlex
+import signal
+import argparse
+import threading
+from time import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import collect_rds
+import recollect_inactive_rds_optimized as recollect
+from calculate_daily_spend import recalculate_incremental
+from push_to_rds import get_pool, POOL_MAX_CONNECTIONS
+from traversal_checkpoint import CheckpointStore
+
+CACHE_MAX_AGE = timedelta(hours=float(os.environ.get("DAEMON_CACHE_MAX_AGE_HOURS", "24")))
+# Recollection stops this long before the next collection is due
+RECOLLECT_MARGIN_MINUTES = 5
+# Longest sleep between schedule checks, so a stop signal is noticed promptly
+MAX_IDLE_SECONDS = 60
+
+
+class Job:
+    def __init__(self, name, run, every=None, at=None):
+        """
+        Args:
+            run: callable taking the daemon, returns a short result string
+            every: timedelta between runs (first run right away)
+            at: "HH:MM" for a once-a-day job
+        """
+        self.name = name
+        self.run = run
+        self.every = every
+        self.at = datetime.strptime(at, "%H:%M").time() if at else None
+        self.next_run = datetime.now() if every else self._next_daily(datetime.now())
+        self.runs = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self.last_result = None
+
+    def _next_daily(self, now):
+        run_at = datetime.combine(now.date(), self.at)
+        return run_at if run_at > now else run_at + timedelta(days=1)
+
+    def reschedule(self, started):
+        if self.every:
+            # Measured from the start, so a long run does not push the schedule back
+            self.next_run = max(started + self.every, datetime.now())
+        else:
+            self.next_run = self._next_daily(datetime.now())
+
+
+class CollectorDaemon:
+    def __init__(self, countries, args):
+        self.countries = countries
+        self.args = args
+        self.stop = threading.Event()
+        self.checkpoints = CheckpointStore()
+        self.cache = None
+        self.cache_warmed_at = None
+        self.jobs = []
+        if args.collect_every:
+            self.jobs.append(Job("collect", CollectorDaemon.run_collection, every=timedelta(minutes=args.collect_every)))
+        if args.recollect_every:
+            self.jobs.append(Job("recollect", CollectorDaemon.run_recollection, every=timedelta(minutes=args.recollect_every)))
+        if args.daily_spend_at:
+            self.jobs.append(Job("daily_spend", CollectorDaemon.run_daily_spend, at=args.daily_spend_at))
+
+        # Sized once for the largest job: one writer (+ one --light lookup) connection per
+        # country, or the recollection's workers plus its queue, plus the daemon's lock
+        self.pool = get_pool(max_connections=max(
+            POOL_MAX_CONNECTIONS, len(countries) * 2, recollect.MAX_WORKERS + 2
+        ) + 1)
+
+    @contextmanager
+    def job_lock(self, name):
+        """Session advisory lock for a job; yields False if another process holds it."""
+        connection = self.pool.getconn()
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (f"collector_daemon:{name}",))
+            acquired = cursor.fetchone()[0]
+            connection.commit()
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", (f"collector_daemon:{name}",))
+                    connection.commit()
+        finally:
+            cursor.close()
+            self.pool.putconn(connection)
+
+    # --- jobs ---
+
+    def run_collection(self):
+        args = collect_rds.build_parser().parse_args(self.countries + shlex.split(self.args.collect_args))
+        if self.cache is None or datetime.now() - self.cache_warmed_at > CACHE_MAX_AGE:
+            print("Warming the ad cache...")
+            warm_inserter = collect_rds.SQLInserter(self.countries[0], warm_cache=True)
+            self.cache = warm_inserter.cache
+            self.cache_warmed_at = datetime.now()
+            warm_inserter.close_db()
+        summaries = collect_rds.collect(self.countries, args, self.checkpoints, cache=self.cache)
+        failed = [summary['country'] for summary in summaries if summary['error']]
+        if failed:
+            raise RuntimeError(f"collection failed for {', '.join(failed)}")
+        return f"{sum(summary['ads_written'] for summary in summaries):,} ads written"
+
+    def run_recollection(self):
+        args = recollect.build_parser().parse_args(shlex.split(self.args.recollect_args))
+        # Leave the quota to the next collection run
+        collect_job = next((job for job in self.jobs if job.name == "collect"), None)
+        if collect_job:
+            minutes_left = (collect_job.next_run - datetime.now()).total_seconds() / 60 - RECOLLECT_MARGIN_MINUTES
+            if minutes_left < 1:
+                return "skipped, collection is due"
+            args.max_minutes = min(args.max_minutes or minutes_left, minutes_left)
+        if not recollect.main(args):
+            raise RuntimeError("recollection stopped on an error (see the traceback above)")
+        return f"budget {args.max_minutes:.0f} min" if args.max_minutes else "done"
+
+    def run_daily_spend(self):
+        # Only the ads whose snapshots collection or recollection wrote since the last run
+        connection = self.pool.getconn()
+        try:
+            applied = recalculate_incremental(conn=connection)
+        finally:
+            self.pool.putconn(connection)
+        return f"daily spend for {applied:,} changed ad snapshots"
+
+    # --- scheduling ---
+
+    def run_job(self, job):
+        started = datetime.now()
+        clock = time()
+        print(f"\n{'='*60}\n[daemon] {started:%Y-%m-%d %H:%M:%S} starting {job.name}\n{'='*60}")
+        try:
+            with self.job_lock(job.name) as acquired:
+                if acquired:
+                    job.last_result = job.run(self)
+                else:
+                    job.last_result = "skipped, running in another process"
+        except Exception as e:
+            job.failures += 1
+            job.last_result = f"failed: {str(e)[:200]}"
+            import traceback
+            traceback.print_exc()
+        finally:
+            job.runs += 1
+            job.seconds += time() - clock
+            job.reschedule(started)
+        print(f"[daemon] {job.name}: {job.last_result} in {time() - clock:.0f}s. "
+              f"Next run at {job.next_run:%Y-%m-%d %H:%M}")
+
+    def run_forever(self):
+        print(f"[daemon] Started for {', '.join(self.countries)} with jobs: "
+              f"{', '.join(f'{job.name} (next {job.next_run:%H:%M})' for job in self.jobs)}")
+        while not self.stop.is_set():
+            now = datetime.now()
+            due = [job for job in self.jobs if job.next_run <= now]
+            if due:
+                self.run_job(min(due, key=lambda job: job.next_run))
+                continue
+            next_run = min(job.next_run for job in self.jobs)
+            self.stop.wait(min(MAX_IDLE_SECONDS, max(1, (next_run - now).total_seconds())))
+
+    def run_once(self):
+        for job in self.jobs:
+            if self.stop.is_set():
+                break
+            self.run_job(job)
+
+    def print_summary(self):
+        print(f"\n{'='*60}")
+        print("COLLECTOR DAEMON SUMMARY")
+        print(f"{'='*60}")
+        for job in self.jobs:
+            print(f"{job.name:<12} {job.runs:>4} runs, {job.failures:>3} failed, {job.seconds / 60:>8.1f} min"
+                  f"  last: {job.last_result}")
+
+    def close(self):
+        self.checkpoints.close()
+        self.pool.closeall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run collection, recollection and daily-spend jobs on internal schedules.")
+    parser.add_argument("countries", nargs="*", help="2-letter country codes to collect (e.g. 'IN', 'US').")
+    parser.add_argument("--countries-file", help="Read country codes from this file as well.")
+    parser.add_argument("--collect-every", type=float, default=60, help="Minutes between collection runs (0 to disable, default: 60).")
+    parser.add_argument("--collect-args", default="--incremental", help="Extra collect_rds.py arguments (default: '--incremental').")
+    parser.add_argument("--recollect-every", type=float, default=360, help="Minutes between recollection runs (0 to disable, default: 360).")
+    parser.add_argument("--recollect-args", default="", help="Extra recollect_inactive_rds_optimized.py arguments (e.g. '--queue').")
+    parser.add_argument("--daily-spend-at", default="02:30", help="Time of day (HH:MM) to update daily spend for the ads whose snapshots changed ('' to disable).")
+    parser.add_argument("--once", action="store_true", help="Run every enabled job once, then exit.")
+    args = parser.parse_args()
+
+    countries = list(args.countries)
+    if args.countries_file:
+        countries.extend(collect_rds.read_countries(args.countries_file))
+    countries = list(dict.fromkeys(countries))
+    if args.collect_every and not countries:
+        parser.error("give at least one country code (or --countries-file), or --collect-every 0")
+    if args.collect_every and not collect_rds.api_key:
+        print("API key not set. Please set the FACEBOOK_API_KEY environment variable.")
+        sys.exit(1)
+    if args.recollect_every and not recollect.api_key:
+        print("API key not set. Please set FACEBOOK_API_KEY_CLEANUP or FACEBOOK_API_KEY environment variable.")
+        sys.exit(1)
+
+    daemon = CollectorDaemon(countries, args)
+    if not daemon.jobs:
+        parser.error("every job is disabled")
+
+    def handle_signal(signum, frame):
+        if daemon.stop.is_set():
+            raise KeyboardInterrupt
+        print(f"\n[daemon] Signal {signum} received, stopping after the running job (signal again to stop now)")
+        daemon.stop.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    try:
+        if args.once:
+            daemon.run_once()
+        else:
+            daemon.run_forever()
+    finally:
+        daemon.print_summary()
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
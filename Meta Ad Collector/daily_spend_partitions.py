@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Daily partitions for the daily spend tables, loaded by partition swap.
+
+Rewriting a date with DELETE + INSERT leaves a day's worth of dead tuples in
+unified.daily_spend_by_ad_table and daily_spend_by_advertiser_table for vacuum to clean up
+while the dashboard reads them. Once the tables are partitioned by snapshot_date (one
+partition per day, see partition_tables()), calculate_daily_spend.py recomputes a date
+into a fresh staging table instead and swaps it in:
+
+    CREATE TABLE <stage> (LIKE <parent> ...)               indexes built on the stage
+    INSERT INTO <stage> ...
+    ADD CHECK (snapshot_date in the day)                   so ATTACH skips its scan
+    DETACH the old partition, DROP it, ATTACH <stage>      lock_timeout bounded
+
+Both tables' stages for a date are built first and swapped last, in one transaction, so
+the parents are only locked from the first DETACH to the commit. Date-range reads of the
+parent are pruned to the days they cover, and old days can be dropped or moved to an
+archive schema with prune_partitions(). The prune cutoff is kept in
+unified.daily_spend_prune_cutoff (migrations/add_daily_spend_prune_cutoff.sql), and
+later recalculations skip the days before it instead of recreating them.
+
+Partitions are named <table>_pYYYYMMDD; the incremental mode creates missing ones with
+create_partitions(), in a short transaction of their own, before writing into a new date.
+"""
+
+import os
+import re
+from datetime import datetime, timedelta
+
+DAILY_SPEND_TABLES = ("unified.daily_spend_by_ad_table", "unified.daily_spend_by_advertiser_table")
+PRUNE_CUTOFF_TABLE = "unified.daily_spend_prune_cutoff"
+# How long a swap waits for dashboard reads on the parent before failing (and being retried)
+SWAP_LOCK_TIMEOUT = os.environ.get("DAILY_SPEND_SWAP_LOCK_TIMEOUT", "5s")
+
+_PARTITION_SUFFIX = re.compile(r"_p(\d{8})$")
+# Not IDENTITY: a copied identity column would get a sequence of its own
+_LIKE_OPTIONS = "INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING INDEXES INCLUDING STORAGE"
+
+
+def partition_name(table, day, prefix=""):
+    """Schema-qualified name of `table`'s partition for `day` (a date)."""
+    schema, name = table.split(".")
+    return f"{schema}.{name}_{prefix}p{day:%Y%m%d}"
+
+
+def is_partitioned(cur, table):
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))", (table,))
+    return cur.fetchone()[0]
+
+
+def partitions(cur, table):
+    """{date: schema-qualified partition name} of `table`'s daily partitions."""
+    cur.execute("""
+        SELECT n.nspname, c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE i.inhparent = to_regclass(%s)
+    """, (table,))
+    days = {}
+    for schema, name in cur.fetchall():
+        match = _PARTITION_SUFFIX.search(name)
+        if match:
+            days[datetime.strptime(match.group(1), "%Y%m%d").date()] = f"{schema}.{name}"
+    return days
+
+
+def pruned_before(cur):
+    """First snapshot date kept by prune_partitions(), or None if nothing was pruned."""
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (PRUNE_CUTOFF_TABLE,))
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute(f"SELECT pruned_before FROM {PRUNE_CUTOFF_TABLE}")
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _bounds(day):
+    return f"FOR VALUES FROM ('{day}') TO ('{day + timedelta(days=1)}')"
+
+
+def ensure_partitions(cur, table, dates):
+    """Create the missing daily partitions of `table` for `dates`, in the caller's transaction."""
+    existing = partitions(cur, table)
+    for day in sorted(set(dates) - set(existing)):
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {partition_name(table, day)} PARTITION OF {table} {_bounds(day)}")
+
+
+def create_partitions(conn, dates):
+    """
+    Create the missing daily partitions of both tables for `dates` in a transaction of
+    their own, which locks the parents only as long as the CREATEs take (lock_timeout
+    bounded).
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL lock_timeout = %s", (SWAP_LOCK_TIMEOUT,))
+        for table in DAILY_SPEND_TABLES:
+            ensure_partitions(cur, table, dates)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def build_stage(cur, table, day, rows_select, params=None):
+    """
+    Build the replacement for `table`'s partition for `day` from `rows_select` (all of the
+    parent's columns, in order, all on `day`), in the caller's transaction. Returns the
+    number of rows.
+    """
+    stage = partition_name(table, day, prefix="stage_")
+    cur.execute(f"""
+        DROP TABLE IF EXISTS {stage};
+        CREATE TABLE {stage} (LIKE {table} {_LIKE_OPTIONS});
+    """)
+    cur.execute(f"INSERT INTO {stage} {rows_select}", params)
+    rows = cur.rowcount
+    cur.execute(f"""
+        ALTER TABLE {stage} ADD CONSTRAINT {stage.split('.')[1]}_day
+            CHECK (snapshot_date >= '{day}' AND snapshot_date < '{day + timedelta(days=1)}');
+        ANALYZE {stage};
+    """)
+    return rows
+
+
+def swap_in(cur, table, day):
+    """
+    Replace `table`'s partition for `day` with the build_stage() table. Locks the parent
+    until the caller commits, which it should do right away.
+    """
+    stage = partition_name(table, day, prefix="stage_")
+    current = partition_name(table, day)
+    cur.execute("SET LOCAL lock_timeout = %s", (SWAP_LOCK_TIMEOUT,))
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (current,))
+    if cur.fetchone()[0]:
+        cur.execute(f"""
+            ALTER TABLE {table} DETACH PARTITION {current};
+            DROP TABLE {current};
+        """)
+    cur.execute(f"""
+        ALTER TABLE {table} ATTACH PARTITION {stage} {_bounds(day)};
+        ALTER TABLE {stage} DROP CONSTRAINT {stage.split('.')[1]}_day;
+        ALTER TABLE {stage} RENAME TO {current.split('.')[1]};
+    """)
+
+
+def partition_tables(conn):
+    """
+    One-off migration of the daily spend tables to daily partitions. The current table is
+    renamed to <table>_unpartitioned and kept; its rows are copied into a partitioned table
+    of the same name and columns, with one partition per date. Each table is migrated in
+    one transaction.
+    """
+    cur = conn.cursor()
+    try:
+        for table in DAILY_SPEND_TABLES:
+            if is_partitioned(cur, table):
+                print(f"✓ {table} is already partitioned")
+                continue
+            schema, name = table.split(".")
+            # Views keep pointing at the renamed table, so they would silently go stale
+            cur.execute("""
+                SELECT DISTINCT v.oid::regclass::text
+                FROM pg_depend d
+                JOIN pg_rewrite r ON r.oid = d.objid
+                JOIN pg_class v ON v.oid = r.ev_class
+                WHERE d.refobjid = to_regclass(%s) AND v.oid <> d.refobjid
+            """, (table,))
+            views = [row[0] for row in cur.fetchall()]
+            if views:
+                raise RuntimeError(f"{table} is used by views {', '.join(views)}; drop them, partition, and recreate them")
+
+            print(f"Partitioning {table}...")
+            cur.execute(f"SELECT DISTINCT snapshot_date FROM {table}")
+            dates = [row[0] for row in cur.fetchall()]
+            # A unique index without snapshot_date cannot be copied to a partitioned table;
+            # the CREATE fails and nothing is changed
+            cur.execute(f"""
+                ALTER TABLE {table} RENAME TO {name}_unpartitioned;
+                CREATE TABLE {table} (LIKE {schema}.{name}_unpartitioned {_LIKE_OPTIONS})
+                    PARTITION BY RANGE (snapshot_date);
+            """)
+            ensure_partitions(cur, table, dates)
+            cur.execute(f"INSERT INTO {table} SELECT * FROM {schema}.{name}_unpartitioned")
+            rows = cur.rowcount
+            conn.commit()
+            print(f"   ✓ {rows:,} rows in {len(dates)} daily partitions. "
+                  f"The old table is kept as {schema}.{name}_unpartitioned; drop it once the new one checks out")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def prune_partitions(conn, before, archive_schema=None):
+    """
+    Detach the daily partitions older than `before` (a date) from both tables and drop
+    them, or move them to `archive_schema`. One short transaction per partition. Returns
+    the number of partitions pruned.
+
+    The cutoff is recorded first, so later recalculations skip those days instead of
+    recreating their partitions.
+    """
+    cur = conn.cursor()
+    pruned = 0
+    try:
+        cur.execute(f"""
+            INSERT INTO {PRUNE_CUTOFF_TABLE} AS c (id, pruned_before) VALUES (true, %s)
+            ON CONFLICT (id) DO UPDATE SET
+                pruned_before = GREATEST(c.pruned_before, EXCLUDED.pruned_before),
+                updated_at = now()
+        """, (before,))
+        conn.commit()
+        if archive_schema:
+            cur.execute(f"CREATE SCHEMA IF NOT EXISTS {archive_schema}")
+            conn.commit()
+        for table in DAILY_SPEND_TABLES:
+            for day, partition in sorted(partitions(cur, table).items()):
+                if day >= before:
+                    continue
+                cur.execute("SET LOCAL lock_timeout = %s", (SWAP_LOCK_TIMEOUT,))
+                cur.execute(f"ALTER TABLE {table} DETACH PARTITION {partition}")
+                if archive_schema:
+                    cur.execute(f"ALTER TABLE {partition} SET SCHEMA {archive_schema}")
+                else:
+                    cur.execute(f"DROP TABLE {partition}")
+                conn.commit()
+                pruned += 1
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    action = f"moved to {archive_schema}" if archive_schema else "dropped"
+    print(f"✓ {pruned} daily spend partitions before {before} {action}")
+    return pruned
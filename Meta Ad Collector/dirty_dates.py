@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Snapshot dates (and ads) whose daily spend needs recomputing.
+
+Daily spend for date D is cumulative(D) - cumulative(D - 1), so a snapshot written (or
+rewritten) for ad A on date D makes (A, D) and (A, D + 1) stale. Every snapshot write path
+marks them, in the same transaction as the snapshots, at two levels:
+
+    meta_ads.snapshot_dirty_dates   D and D + 1, for calculate_daily_spend.py --dirty
+                                    (recomputes whole dates)
+    meta_ads.snapshot_dirty_ads     (A, D) and (A, D + 1), for --incremental (replaces just
+                                    those ads' rows and applies the difference to the
+                                    advertiser totals)
+
+The write paths are:
+
+    push_to_rds / push_to_local_db   insert_ads_bulk, close_out_ads_bulk, bulk_insert_snapshots
+    sync_to_rds                      snapshots merged into RDS
+
+Recomputing a whole date also clears that date's ad marks; the incremental mode leaves the
+date marks alone, so a later --dirty run still redoes those dates. Both tables are Meta only,
+since Google snapshots are not written here.
+
+A mark updates an existing row rather than skipping it, so it holds that row's lock until
+the writer commits. drain() has to wait for it and so never removes a date whose snapshot
+write is not visible yet. The incremental drain skips locked rows and leaves them for the
+next run. Marks are the last statement before a commit to keep that short.
+
+The tables are created by migrations/add_snapshot_dirty_marks.sql.
+"""
+
+DIRTY_DATES_TABLE = "meta_ads.snapshot_dirty_dates"
+DIRTY_ADS_TABLE = "meta_ads.snapshot_dirty_ads"
+
+
+def mark_dates_sql(dates_select):
+    """
+    Statement marking every date from `dates_select` (a query returning one date column)
+    and the day after it.
+    """
+    return f"""
+        INSERT INTO {DIRTY_DATES_TABLE} (snapshot_date)
+        SELECT DISTINCT v.snapshot_date
+        FROM ({dates_select}) src (snapshot_date),
+             LATERAL (VALUES (src.snapshot_date::date), (src.snapshot_date::date + 1)) v (snapshot_date)
+        WHERE v.snapshot_date IS NOT NULL
+        ORDER BY v.snapshot_date
+        ON CONFLICT (snapshot_date) DO UPDATE SET marked_at = now()
+    """
+
+
+def mark_ads_sql(snapshots_select):
+    """
+    Statement marking every (ad_id, snapshot_date) from `snapshots_select` (a query
+    returning those two columns) and the same ad on the day after.
+    """
+    return f"""
+        INSERT INTO {DIRTY_ADS_TABLE} (ad_id, snapshot_date)
+        SELECT DISTINCT src.ad_id::bigint, v.snapshot_date
+        FROM ({snapshots_select}) src (ad_id, snapshot_date),
+             LATERAL (VALUES (src.snapshot_date::date), (src.snapshot_date::date + 1)) v (snapshot_date)
+        WHERE src.ad_id IS NOT NULL AND v.snapshot_date IS NOT NULL
+        ORDER BY 1, 2
+        ON CONFLICT (ad_id, snapshot_date) DO UPDATE SET marked_at = now()
+    """
+
+
+def mark_sql(snapshots_select):
+    """Both marking statements for the (ad_id, snapshot_date) rows of `snapshots_select`."""
+    return (
+        mark_dates_sql(f"SELECT snapshot_date FROM ({snapshots_select}) dirty (ad_id, snapshot_date)")
+        + ";\n"
+        + mark_ads_sql(snapshots_select)
+    )
+
+
+def mark_snapshots(cursor, snapshots):
+    """Mark the given (ad_id, snapshot_date) pairs dirty."""
+    pairs = sorted({(str(ad_id), str(snapshot_date)) for ad_id, snapshot_date in snapshots if ad_id and snapshot_date})
+    if not pairs:
+        return
+    cursor.execute(
+        mark_sql("SELECT unnest(%s::bigint[]), unnest(%s::date[])"),
+        ([int(ad_id) for ad_id, _ in pairs], [d for _, d in pairs]) * 2,
+    )
+
+
+def drain(connection, date_from=None, date_to=None):
+    """
+    Remove and return the dirty dates (optionally only those in [date_from, date_to]),
+    together with those dates' ad marks, committed right away. Put the dates back with
+    restore() if recomputing them fails.
+    """
+    conditions = []
+    if date_from:
+        conditions.append("snapshot_date >= %(date_from)s::date")
+    if date_to:
+        conditions.append("snapshot_date <= %(date_to)s::date")
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            WITH drained AS (
+                DELETE FROM {DIRTY_DATES_TABLE}
+                WHERE {" AND ".join(conditions) or "TRUE"}
+                RETURNING snapshot_date
+            ),
+            drained_ads AS (
+                DELETE FROM {DIRTY_ADS_TABLE}
+                WHERE snapshot_date IN (SELECT snapshot_date FROM drained)
+            )
+            SELECT snapshot_date FROM drained
+        """, {'date_from': date_from, 'date_to': date_to})
+        dates = sorted(row[0] for row in cursor.fetchall())
+    connection.commit()
+    return dates
+
+
+def restore(connection, dates):
+    """Mark drained dates dirty again (exactly these dates, not the day after)."""
+    if not dates:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {DIRTY_DATES_TABLE} (snapshot_date)
+            SELECT unnest(%s::date[])
+            ON CONFLICT (snapshot_date) DO NOTHING
+        """, ([str(d) for d in dates],))
+    connection.commit()
+
+
+def drain_ads_sql(target, limit):
+    """
+    Statement moving up to `limit` ad marks into `target` (platform, ad_id text, snapshot_date),
+    in the caller's transaction. Rows a writer still holds are skipped, not waited for.
+    """
+    return f"""
+        WITH drained AS (
+            DELETE FROM {DIRTY_ADS_TABLE}
+            WHERE (ad_id, snapshot_date) IN (
+                SELECT ad_id, snapshot_date FROM {DIRTY_ADS_TABLE}
+                ORDER BY snapshot_date, ad_id
+                LIMIT {int(limit)}
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING ad_id, snapshot_date
+        )
+        INSERT INTO {target} (platform, ad_id, snapshot_date)
+        SELECT 'Meta', ad_id::text, snapshot_date FROM drained
+        ON CONFLICT DO NOTHING
+    """
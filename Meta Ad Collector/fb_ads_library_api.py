@@ -11,11 +11,24 @@
 
 import json
 import re
-from datetime import datetime
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 import requests
-import sys
 from time import sleep
+from requests.adapters import HTTPAdapter
+
+from rate_governor import get_governor, governor_for_url
+from traversal_checkpoint import restore_access_token
+
+# One keep-alive session for every traversal in the process, so consecutive pages
+# reuse the TCP+TLS connection to graph.facebook.com instead of reconnecting each time.
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+http_session.headers.update({"Accept-Encoding": "gzip, deflate"})
 
 def get_ad_archive_id(data):
     """
@@ -24,6 +37,21 @@ def get_ad_archive_id(data):
     return re.search(r"/\?id=([0-9]+)", data["ad_snapshot_url"]).group(1)
 
 
+class AdArchivePage(list):
+    """
+    One page of ads as returned by the traversal. Behaves like a plain list, and also
+    carries the cursor for the following page and, for checkpointed traversals, the
+    (run_key, window) it belongs to, so CheckpointStore.record_page() can save it. The
+    last page read from a dense window also carries the windows its unread days were
+    split into (`split`), recorded along with it.
+    """
+    def __init__(self, ads, next_url=None, checkpoint=None, split=None):
+        super().__init__(ads)
+        self.next_url = next_url
+        self.checkpoint = checkpoint
+        self.split = split
+
+
 class FbAdsLibraryTraversal:
     default_url_pattern = (
         "https://graph.facebook.com/{}/ads_archive?unmask_removed_content=true&ad_type=POLITICAL_AND_ISSUE_ADS&access_token={}&"
@@ -47,7 +75,15 @@ class FbAdsLibraryTraversal:
         page_limit=100,
         api_version=None,
         retry_limit=3,
+        transport=None,
+        governor=None,
     ):
+        """
+        transport: optional GraphBatchTransport (graph_batch.py); requests are then packed
+        with other traversals' requests into batch calls instead of sent one by one.
+        governor: pacing for this traversal's requests, defaults to the API key's RateGovernor
+        (a FairShareGovernor when several countries share one key, see rate_governor.py)
+        """
         self.page_count = 0
         self.access_token = access_token
         self.fields = fields
@@ -61,14 +97,16 @@ class FbAdsLibraryTraversal:
         self.ad_active_status = ad_active_status
         self.page_limit = page_limit
         self.retry_limit = retry_limit
+        self.transport = transport
+        self.governor = governor or get_governor(access_token)
         if api_version is None:
             self.api_version = self.default_api_version
         else:
             self.api_version = api_version
         print ("set to api v=",api_version)
 
-    def generate_ad_archives(self):
-        next_page_url = self.default_url_pattern.format(
+    def _build_url(self, after_date, before_date):
+        return self.default_url_pattern.format(
             self.api_version,
             self.access_token,
             self.fields,
@@ -77,35 +115,198 @@ class FbAdsLibraryTraversal:
             self.search_page_ids,
             self.ad_active_status,
             self.page_limit,
-            self.after_date,
-            self.before_date
+            after_date,
+            before_date
         )
-        return self.__class__._get_ad_archives_from_url(
-            next_page_url, cutoff_after_date = self.cutoff_after_date, country=self.country, retry_limit=self.retry_limit
+
+    def generate_ad_archives(self, checkpoint_store=None, resume=False):
+        """
+        Yield AdArchivePage lists of ads. With a checkpoint_store, every page carries the
+        cursor to record once it is committed, and resume=True continues the last run
+        over the same country/fields/date range from its saved cursor.
+        """
+        if checkpoint_store is None:
+            next_page_url = self._build_url(self.after_date, self.before_date)
+            return self.__class__._get_ad_archives_from_url(
+                next_page_url, cutoff_after_date = self.cutoff_after_date, country=self.country, retry_limit=self.retry_limit,
+                governor=self.governor, transport=self.transport
+            )
+        return self._generate_checkpointed(checkpoint_store, resume)
+
+    def _checkpoint_run_key(self, checkpoint_store):
+        return checkpoint_store.run_key(
+            self.country, self.fields, self.search_page_ids, self.after_date, self.before_date
         )
 
+    def _window_url(self, window, saved_url):
+        if saved_url:
+            return restore_access_token(saved_url, self.access_token)
+        return self._build_url(*window)
+
+    def _generate_checkpointed(self, checkpoint_store, resume):
+        run_key = self._checkpoint_run_key(checkpoint_store)
+        windows = checkpoint_store.start_run(run_key, [(self.after_date, self.before_date)], resume=resume)
+        for window, saved_url in windows:
+            yield from self.__class__._get_ad_archives_from_url(
+                self._window_url(window, saved_url), cutoff_after_date=self.cutoff_after_date, country=self.country,
+                retry_limit=self.retry_limit, governor=self.governor, checkpoint=(run_key, window),
+                transport=self.transport
+            )
+
+    def generate_ad_archives_sharded(
+        self,
+        max_workers=4,
+        shard_days=7,
+        dense_page_limit=10,
+        checkpoint_store=None,
+        resume=False,
+    ):
+        """
+        Same pages as generate_ad_archives(), but [after_date, before_date] is split into
+        windows of `shard_days` days that are walked concurrently by `max_workers` threads.
+
+        The Ads Library only filters on whole days (ad_delivery_date_min/max), so one day
+        is the smallest window. Pages come newest first, so a window that is still
+        paginating after `dense_page_limit` pages has been read down to the oldest start
+        date seen so far; only the days from its first day to that date are re-queued, as
+        two halves, and the pages already read are kept. Ads already seen are dropped, so
+        the caller receives every ad once no matter how many windows it was delivered in.
+        All workers share the API key's RateGovernor, so adding workers does not multiply the quota spend.
+        With a checkpoint_store, windows, splits and cursors are recorded so resume=True
+        restarts only the unfinished windows.
+        """
+        first_day = datetime.strptime(self.after_date, "%Y-%m-%d").date()
+        last_day = datetime.strptime(self.before_date, "%Y-%m-%d").date()
+        windows = []
+        window_start = first_day
+        while window_start <= last_day:
+            window_end = min(window_start + timedelta(days=shard_days - 1), last_day)
+            windows.append((window_start.isoformat(), window_end.isoformat()))
+            window_start = window_end + timedelta(days=1)
+
+        run_key = None
+        if checkpoint_store is not None:
+            run_key = self._checkpoint_run_key(checkpoint_store)
+            pending = deque(checkpoint_store.start_run(run_key, windows, resume=resume))
+        else:
+            pending = deque((window, None) for window in windows)
+
+        print(f"Sharded traversal: {len(pending)} windows of up to {shard_days} days, {max_workers} workers")
+
+        governor = self.governor
+        results = queue.Queue(maxsize=max_workers * 2)
+        stop_event = threading.Event()
+        seen_ids = set()
+        active = 0
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            while pending or active:
+                while pending and active < max_workers:
+                    window, saved_url = pending.popleft()
+                    executor.submit(
+                        self._walk_window, window, saved_url, run_key, governor, results, stop_event, dense_page_limit
+                    )
+                    active += 1
+
+                kind, window, payload = results.get()
+                if kind == "page":
+                    fresh = []
+                    for ad in payload:
+                        ad_id = ad.get("id")
+                        if ad_id in seen_ids:
+                            continue
+                        seen_ids.add(ad_id)
+                        fresh.append(ad)
+                    if payload.split:
+                        (left_start, left_end), (right_start, right_end) = payload.split
+                        print(f"Window {window[0]} to {window[1]} is dense, splitting its unread days into "
+                              f"{left_start}..{left_end} and {right_start}..{right_end}")
+                        pending.extend((half, None) for half in payload.split)
+                    # A page made only of duplicates is not passed on, so its cursor is not
+                    # recorded either; a resume re-reads at most that one page. An empty page
+                    # is the window's end marker, and the split is recorded with its page
+                    # once that is committed, so both are passed on.
+                    if fresh or not payload or payload.split:
+                        yield AdArchivePage(
+                            fresh, next_url=payload.next_url, checkpoint=payload.checkpoint, split=payload.split
+                        )
+                elif kind == "done":
+                    active -= 1
+                elif kind == "error":
+                    raise payload
+        finally:
+            stop_event.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _walk_window(self, window, saved_url, run_key, governor, results, stop_event, dense_page_limit):
+        def put(item):
+            # Blocks while the consumer is behind, but gives up once the traversal is stopped
+            while not stop_event.is_set():
+                try:
+                    results.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        window_start = datetime.strptime(window[0], "%Y-%m-%d").date()
+        window_end = datetime.strptime(window[1], "%Y-%m-%d").date()
+        try:
+            pages = 0
+            # Oldest ad_delivery_start_time read so far; every later day of the window is complete
+            oldest = window_end
+            for page in self.__class__._get_ad_archives_from_url(
+                self._window_url(window, saved_url), cutoff_after_date=self.cutoff_after_date, country=self.country,
+                retry_limit=self.retry_limit, governor=governor,
+                checkpoint=(run_key, window) if run_key else None, transport=self.transport
+            ):
+                for ad in page:
+                    started = ad.get("ad_delivery_start_time")
+                    if started:
+                        oldest = max(window_start, min(oldest, datetime.strptime(started[:10], "%Y-%m-%d").date()))
+                pages += 1
+                # Once the rest is a single day there is nothing left to narrow; keep paginating
+                if pages >= dense_page_limit and oldest > window_start:
+                    # The oldest day may be only partly read, so it stays in the rest
+                    middle = window_start + (oldest - window_start) // 2
+                    page.split = [
+                        (window_start.isoformat(), middle.isoformat()),
+                        ((middle + timedelta(days=1)).isoformat(), oldest.isoformat()),
+                    ]
+                    put(("page", window, page))
+                    return
+                if not put(("page", window, page)):
+                    return
+        except BaseException as error:
+            put(("error", window, error))
+        finally:
+            put(("done", window, None))
+
     @staticmethod
     def _get_ad_archives_from_url(
-        next_page_url, cutoff_after_date="2023-10-10", country="unknown", retry_limit=5
+        next_page_url, cutoff_after_date="2023-10-10", country="unknown", retry_limit=5, governor=None, checkpoint=None,
+        transport=None
     ):
         last_error_url = None
         last_retry_count = 0
         start_time_cutoff_after = datetime.strptime(cutoff_after_date, "%Y-%m-%d").timestamp()
-        time_to_regain_access = 0
+        # Pacing comes from the API's own usage headers instead of fixed sleeps; see rate_governor.py
+        governor = governor or governor_for_url(next_page_url)
         print("inside _get_ad_archives_from_ur ")
         while next_page_url is not None:
-            if time_to_regain_access > 0:
-                print(f"sleeping inside of ad archive for: {time_to_regain_access + 1} minutes")
-                sleep((time_to_regain_access + 1) * 60)
-            else:
-                print(f"sleeping inside of ad archive for just 1 second to catch some air!")
-                sleep(1)
-
             try:
-                print(f"[{datetime.now()}] Making API request to Meta...")
-                response = requests.get(next_page_url, timeout=300) # Added a 5-minute timeout
-                print(f"[{datetime.now()}] API request finished.")
-                response_data = json.loads(response.text)
+                if transport is not None:
+                    # Packed into a batch call with other lookups; the transport paces the batches
+                    response_data = transport.get(next_page_url)
+                else:
+                    governor.wait()
+                    print(f"[{datetime.now()}] Making API request to Meta...")
+                    response = http_session.get(next_page_url, timeout=300) # Added a 5-minute timeout
+                    print(f"[{datetime.now()}] API request finished.")
+                    response_data = json.loads(response.text)
+                    usage = governor.observe(response.headers)
+                    if usage is not None:
+                        print(f"API usage: {usage:.0f}%")
             except requests.exceptions.Timeout:
                 print(f"[{datetime.now()}] The API request timed out after 5 minutes. Retrying...")
                 continue
@@ -115,49 +316,14 @@ class FbAdsLibraryTraversal:
                 sleep(65)
                 continue
 
-            business_use_case_usage = response.headers.get('x-business-use-case-usage', '{}')
-            estimated_time = 0
-            try:
-                usage_data = json.loads(business_use_case_usage)
-                # Extract 'estimated_time_to_regain_access' (assuming you are targeting the first key and the first dictionary item)
-                key = next(iter(usage_data))  # Get the first key (e.g., '1651268252335870')
-                estimated_time = usage_data[key][0].get('estimated_time_to_regain_access', 30)
-            except (json.JSONDecodeError, KeyError, IndexError):
-                estimated_time = 0
-            except StopIteration:
-                print("Ecountered Stop iteration error")
-                estimated_time = 0
-                
-            print("Estimated time: " + str(estimated_time))
-            estimated_time = int(estimated_time)
-            if estimated_time > 0:
-                sleep(int(estimated_time) * 60)
-
-            try:
-                usage_data = json.loads(business_use_case_usage)
-                # Extract 'estimated_time_to_regain_access' (assuming you are targeting the first key and the first dictionary item)
-                key = next(iter(usage_data))
-                response_headers = usage_data[key][0]
-
-                time_to_regain_access = response_headers['estimated_time_to_regain_access']
-                if int(time_to_regain_access) == 0:
-                    if int(response_headers['total_time']) > 100:
-                        time_to_regain_access = 60 # make it 60 minutes
-
-                if int(time_to_regain_access) > 0:
-                    continue # Go straight to sleeping since we have hit regain access limit
-
-            except Exception as ex:
-                print("Error in parsing response headers: ", ex)
-                            
             if "error" in response_data:
                 if next_page_url == last_error_url:
                     # failed again
                     if last_retry_count >= retry_limit:
                         print("Failed retry limit...")
                         raise Exception(
-                            "Error message: [{}], failed on URL: [{}], Estimated time to regain access: [{}]".format(
-                                json.dumps(response_data["error"]), next_page_url, estimated_time
+                            "Error message: [{}], failed on URL: [{}]".format(
+                                json.dumps(response_data["error"]), next_page_url
                             )
                         )
                 else:
@@ -182,25 +348,19 @@ class FbAdsLibraryTraversal:
             if len(filtered) == 0:
                 print(" if no data after the after_date, break")
                 next_page_url = None
+                if checkpoint:
+                    # Nothing left in the window: an empty last page marks it done once the
+                    # pages before it are committed
+                    yield AdArchivePage([], next_url=None, checkpoint=checkpoint)
                 break
-            yield filtered
-
-            if "paging" in response_data:
-                next_page_url = response_data["paging"]["next"]
-            else:
-                next_page_url = None
 
-            # Added to kill script to prevent API call runaway, where the limit has already been reached, and the script still attempts to call the API
-            # Which contributes to increasing the API limit even more, without this the script would need to be killed manually. 
-            try:
-                if int(response_headers['total_time']) >= 100:
-                    sys.exit()
-            except:
-                pass
+            # Work out the cursor before yielding, so the page can carry it for checkpointing
+            next_page_url = response_data.get("paging", {}).get("next")
+            yield AdArchivePage(filtered, next_url=next_page_url, checkpoint=checkpoint)
 
     @classmethod
-    def generate_ad_archives_from_url(cls, failure_url, after_date="1970-01-01"):
+    def generate_ad_archives_from_url(cls, failure_url, cutoff_after_date="2023-10-10"):
         """
         if we failed from error, later we can just continue from the last failure url
         """
-        return cls._get_ad_archives_from_url(failure_url, after_date=after_date)
\ No newline at end of file
+        return cls._get_ad_archives_from_url(failure_url, cutoff_after_date=cutoff_after_date)
\ No newline at end of file
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Asyncio version of FbAdsLibraryTraversal.
+
+All traversals share one aiohttp.ClientSession (keep-alive, gzip), so a single event loop
+can keep dozens of page cursors in flight without a thread per request. Pacing is shared
+with the threaded traversals through rate_governor.
+
+Usage:
+    async with create_session() as session:
+        collector = AsyncFbAdsLibraryTraversal(session, api_key, "id,spend", ".", "IN")
+        async for ads in collector.generate_ad_archives():
+            ...
+
+Point `graph_api_host` at a local server to run against a mock Graph API.
+"""
+
+import asyncio
+import json
+from datetime import datetime, date
+
+import aiohttp
+
+from rate_governor import get_governor
+
+
+def create_session(max_connections=64):
+    """Create the pooled HTTP session shared by every AsyncFbAdsLibraryTraversal."""
+    connector = aiohttp.TCPConnector(limit=max_connections, keepalive_timeout=120)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=300),
+        headers={"Accept-Encoding": "gzip, deflate"},
+    )
+
+
+class AsyncFbAdsLibraryTraversal:
+    default_url_pattern = (
+        "{}/{}/ads_archive?unmask_removed_content=true&ad_type=POLITICAL_AND_ISSUE_ADS&access_token={}&"
+        + "fields={}&search_terms={}&ad_reached_countries={}&search_page_ids={}&"
+        + "ad_active_status={}&limit={}&"
+        + "ad_delivery_date_min={}&ad_delivery_date_max={}"
+    )
+    default_api_version = "v23.0"
+    default_graph_api_host = "https://graph.facebook.com"
+
+    def __init__(
+        self,
+        session,
+        access_token,
+        fields,
+        search_term,
+        country,
+        search_page_ids="",
+        ad_active_status="ALL",
+        after_date="1970-01-01",
+        before_date=None,
+        cutoff_after_date="2023-10-10",
+        page_limit=100,
+        api_version=None,
+        retry_limit=3,
+        graph_api_host=None,
+    ):
+        """
+        Arguments match FbAdsLibraryTraversal. Pass cutoff_after_date=None to get every
+        ad the API returns (the fb_ads_library_cleanup behaviour used by recollection).
+        """
+        self.session = session
+        self.access_token = access_token
+        self.fields = fields
+        self.search_term = search_term
+        self.country = country
+        self.search_page_ids = search_page_ids
+        self.ad_active_status = ad_active_status
+        self.after_date = after_date
+        self.before_date = before_date if before_date else date.today().strftime('%Y-%m-%d')
+        self.cutoff_after_date = cutoff_after_date
+        self.page_limit = page_limit
+        self.api_version = api_version or self.default_api_version
+        self.retry_limit = retry_limit
+        self.graph_api_host = graph_api_host or self.default_graph_api_host
+
+    def _build_url(self):
+        return self.default_url_pattern.format(
+            self.graph_api_host,
+            self.api_version,
+            self.access_token,
+            self.fields,
+            self.search_term,
+            self.country,
+            self.search_page_ids,
+            self.ad_active_status,
+            self.page_limit,
+            self.after_date,
+            self.before_date
+        )
+
+    async def generate_ad_archives(self):
+        async for ads in self.generate_ad_archives_from_url(self._build_url()):
+            yield ads
+
+    async def generate_ad_archives_from_url(self, next_page_url):
+        last_error_url = None
+        last_retry_count = 0
+        governor = get_governor(self.access_token)
+        start_time_cutoff_after = None
+        if self.cutoff_after_date:
+            start_time_cutoff_after = datetime.strptime(self.cutoff_after_date, "%Y-%m-%d").timestamp()
+
+        while next_page_url is not None:
+            await governor.wait_async()
+
+            try:
+                async with self.session.get(next_page_url) as response:
+                    response_text = await response.text()
+                    await governor.observe_async(response.headers)
+                response_data = json.loads(response_text)
+            except asyncio.TimeoutError:
+                print(f"⚠️  API timeout, retrying...")
+                continue
+            except Exception as e:
+                print(f"⚠️  Request error: {str(e)[:100]}, retrying after 60s...")
+                await asyncio.sleep(60)
+                continue
+
+            if "error" in response_data:
+                print(f"API Error: {response_data['error']}")
+                if next_page_url == last_error_url:
+                    last_retry_count += 1
+                    if last_retry_count >= self.retry_limit:
+                        raise Exception(f"Retry limit exceeded for URL: {next_page_url}. Error: {response_data['error']}")
+                else:
+                    last_error_url = next_page_url
+                    last_retry_count = 1
+                await asyncio.sleep(60)
+                continue
+
+            data = response_data.get("data")
+            if not data:
+                break
+
+            if start_time_cutoff_after is not None:
+                data = [
+                    ad_archive for ad_archive in data
+                    if "ad_delivery_start_time" in ad_archive
+                    and datetime.strptime(ad_archive["ad_delivery_start_time"][:10], "%Y-%m-%d").timestamp() >= start_time_cutoff_after
+                ]
+                if not data:
+                    break
+
+            yield data
+
+            if "paging" in response_data and response_data["paging"].get("next"):
+                next_page_url = response_data["paging"]["next"]
+            else:
+                next_page_url = None
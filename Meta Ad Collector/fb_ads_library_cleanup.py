@@ -12,10 +12,18 @@
 
 import json
 import re
-import sys
 from datetime import datetime
 from time import sleep
 import requests
+from requests.adapters import HTTPAdapter
+
+from rate_governor import get_governor, governor_for_url
+
+# One keep-alive session for every traversal in the process, so consecutive pages
+# reuse the TCP+TLS connection to graph.facebook.com instead of reconnecting each time.
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+http_session.headers.update({"Accept-Encoding": "gzip, deflate"})
 
 def get_ad_archive_id(data):
     """
@@ -47,7 +55,12 @@ class FbAdsLibraryTraversal:
         page_limit=100,
         api_version=None,
         retry_limit=3,
+        transport=None,
     ):
+        """
+        transport: optional GraphBatchTransport (graph_batch.py); requests are then packed
+        with other traversals' requests into batch calls instead of sent one by one.
+        """
         self.page_count = 0
         self.access_token = access_token
         self.fields = fields
@@ -59,6 +72,7 @@ class FbAdsLibraryTraversal:
         self.ad_active_status = ad_active_status
         self.page_limit = page_limit
         self.retry_limit = retry_limit
+        self.transport = transport
         if api_version is None:
             self.api_version = self.default_api_version
         else:
@@ -79,32 +93,32 @@ class FbAdsLibraryTraversal:
             self.max_date
         )
         return self.__class__._get_ad_archives_from_url(
-            next_page_url, country=self.country, retry_limit=self.retry_limit
+            next_page_url, country=self.country, retry_limit=self.retry_limit,
+            governor=get_governor(self.access_token), transport=self.transport
         )
 
     @staticmethod
     def _get_ad_archives_from_url(
-        next_page_url, country="unknown", retry_limit=3
+        next_page_url, country="unknown", retry_limit=3, governor=None, transport=None
     ):
         last_error_url = None
         last_retry_count = 0
-        time_to_regain_access = 0
+        # Shared, header-driven pacing (see rate_governor.py) instead of a fixed 5s sleep
+        governor = governor or governor_for_url(next_page_url)
 
         while next_page_url is not None:
-            # Implement dynamic sleep based on API feedback
-            if time_to_regain_access > 0:
-                print(f"API rate limit hit. Sleeping for {time_to_regain_access + 1} minutes.")
-                sleep((time_to_regain_access + 1) * 60)
-                time_to_regain_access = 0 # Reset after sleeping
-            else:
-                # Default short sleep to be a good citizen
-                sleep(5)
-
             try:
-                # API request (timestamps suppressed for clean output)
-                response = requests.get(next_page_url, timeout=300)
-                # API request finished
-                response_data = json.loads(response.text)
+                if transport is not None:
+                    # Packed into a batch call with other lookups; the transport paces the batches
+                    response_data = transport.get(next_page_url)
+                else:
+                    governor.wait()
+                    # API request (timestamps suppressed for clean output)
+                    response = http_session.get(next_page_url, timeout=300)
+                    # API request finished
+                    response_data = json.loads(response.text)
+                    # Rate limit headers feed the shared governor, which pauses all callers when needed
+                    governor.observe(response.headers)
             except requests.exceptions.Timeout:
                 print(f"⚠️  API timeout, retrying...")
                 continue
@@ -113,19 +127,6 @@ class FbAdsLibraryTraversal:
                 sleep(60)
                 continue
 
-            # Parse rate limit headers
-            business_use_case_usage = response.headers.get('x-business-use-case-usage', '{}')
-            try:
-                usage_data = json.loads(business_use_case_usage)
-                # The key is the app-id, which we can get dynamically
-                if usage_data:
-                    first_key = next(iter(usage_data))
-                    usage_info = usage_data[first_key][0]
-                    time_to_regain_access = int(usage_info.get('estimated_time_to_regain_access', 0))
-            except (json.JSONDecodeError, KeyError, IndexError, StopIteration) as e:
-                print(f"Could not parse rate limit headers: {e}")
-                time_to_regain_access = 0
-                
             if "error" in response_data:
                 print(f"API Error: {response_data['error']}")
                 if next_page_url == last_error_url:
@@ -136,12 +137,9 @@ class FbAdsLibraryTraversal:
                     last_error_url = next_page_url
                     last_retry_count = 1
                 
-                # If there's an error, respect the sleep time
-                if time_to_regain_access > 0:
-                    continue
-                else: # Default wait on unknown error
-                    sleep(60)
-                    continue
+                # Default wait on unknown error; rate limit errors are already paused by the governor
+                sleep(60)
+                continue
 
             data = response_data.get("data")
             if not data:
@@ -156,8 +154,8 @@ class FbAdsLibraryTraversal:
                 next_page_url = None
 
     @classmethod
-    def generate_ad_archives_from_url(cls, failure_url, after_date="1970-01-01"):
+    def generate_ad_archives_from_url(cls, failure_url):
         """
         if we failed from error, later we can just continue from the last failure url
         """
-        return cls._get_ad_archives_from_url(failure_url, after_date=after_date)
+        return cls._get_ad_archives_from_url(failure_url)
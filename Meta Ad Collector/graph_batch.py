@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Graph API batch transport for small ads_archive lookups.
+
+Single-ad lookups and per-page recollection queries are tiny, so most of their wall-clock
+time is HTTP round trips. GraphBatchTransport packs up to MAX_BATCH_SIZE independent GET
+sub-requests, submitted from any number of threads, into one `POST /` batch call:
+
+    transport = GraphBatchTransport(access_token)
+    data = transport.get(url)                # blocks until its sub-response is back
+    pages = transport.get_many([url, ...])   # several lookups in as few calls as possible
+
+Every caller gets back the parsed JSON body of its own sub-request (an "error" body
+included), so the traversals' existing error handling and `paging.next` following work
+unchanged; each sub-request's next page simply goes into a later batch.
+
+The batch call is paced by the API key's RateGovernor, at one token per sub-request. FB_GRAPH_BATCH_URL points the
+transport elsewhere (e.g. a local stand-in server); sub-request URLs keep their path and
+query, minus the access token, which is sent once per batch.
+"""
+
+import os
+import json
+import queue
+import threading
+from concurrent.futures import Future
+from time import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_governor import get_governor
+from traversal_checkpoint import strip_access_token
+
+GRAPH_BATCH_URL = os.environ.get("FB_GRAPH_BATCH_URL", "https://graph.facebook.com/")
+MAX_BATCH_SIZE = 50  # Graph API limit
+# How long the first sub-request waits for others to join its batch
+BATCH_LINGER_SECONDS = int(os.environ.get("FB_GRAPH_BATCH_LINGER_MS", "100")) / 1000
+# A null entry in the batch response means that sub-request did not finish in time
+MAX_SUBREQUEST_ATTEMPTS = 3
+
+_CLOSE = object()
+
+
+def relative_url(url):
+    """Path and query of a Graph API URL without the access token, as a batch relative_url."""
+    parts = urlsplit(strip_access_token(url))
+    return parts.path.lstrip("/") + ("?" + parts.query if parts.query else "")
+
+
+class _SubRequest:
+    def __init__(self, url):
+        self.url = url
+        self.relative_url = relative_url(url)
+        self.future = Future()
+        self.attempts = 0
+
+
+class GraphBatchTransport:
+    def __init__(
+        self,
+        access_token,
+        batch_url=GRAPH_BATCH_URL,
+        max_batch_size=MAX_BATCH_SIZE,
+        linger=BATCH_LINGER_SECONDS,
+        timeout=300,
+    ):
+        self.access_token = access_token
+        self.batch_url = batch_url
+        self.max_batch_size = min(max_batch_size, MAX_BATCH_SIZE)
+        self.linger = linger
+        self.timeout = timeout
+        self.governor = get_governor(access_token)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        self.pending = queue.Queue()
+        self.closing = False
+        self.batches_sent = 0
+        self.subrequests_sent = 0
+        self.thread = threading.Thread(target=self._run, name="graph-batch", daemon=True)
+        self.thread.start()
+
+    def submit(self, url):
+        """Queue a GET for the next batch; returns a Future of its parsed JSON body."""
+        if self.closing:
+            raise RuntimeError("GraphBatchTransport is closed")
+        sub_request = _SubRequest(url)
+        self.pending.put(sub_request)
+        return sub_request.future
+
+    def get(self, url):
+        return self.submit(url).result()
+
+    def get_many(self, urls):
+        futures = [self.submit(url) for url in urls]
+        return [future.result() for future in futures]
+
+    def close(self):
+        """Send whatever is still queued, then stop the dispatcher thread."""
+        if not self.closing:
+            self.closing = True
+            self.pending.put(_CLOSE)
+            self.thread.join()
+        self.session.close()
+
+    def _collect(self):
+        # Block for the first sub-request, then give others `linger` seconds to join it
+        item = self.pending.get()
+        if item is _CLOSE:
+            return None
+        batch = [item]
+        deadline = time() + self.linger
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self.pending.get(timeout=max(0, deadline - time()))
+            except queue.Empty:
+                break
+            if item is _CLOSE:
+                # Finish what is queued before stopping
+                self.pending.put(_CLOSE)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+            try:
+                self._send(batch)
+            except BaseException as error:
+                for sub_request in batch:
+                    if not sub_request.future.done():
+                        sub_request.future.set_exception(error)
+
+    def _send(self, batch):
+        # Meta counts every sub-request against call_count, so the batch costs one token each
+        self.governor.wait(cost=len(batch))
+        try:
+            response = self.session.post(
+                self.batch_url,
+                data={
+                    "access_token": self.access_token,
+                    "include_headers": "false",
+                    "batch": json.dumps([
+                        {"method": "GET", "relative_url": sub_request.relative_url}
+                        for sub_request in batch
+                    ]),
+                },
+                timeout=self.timeout,
+            )
+            results = json.loads(response.text)
+        except Exception as error:
+            # Callers see the same exceptions a direct GET would raise, and retry the same way
+            for sub_request in batch:
+                sub_request.future.set_exception(error)
+            return
+        self.governor.observe(response.headers)
+        self.batches_sent += 1
+        self.subrequests_sent += len(batch)
+
+        if not isinstance(results, list):
+            # The whole batch was rejected (bad token, rate limit): every caller gets the error
+            for sub_request in batch:
+                sub_request.future.set_result(results)
+            return
+
+        for sub_request, result in zip(batch, results):
+            if result is None:
+                sub_request.attempts += 1
+                if sub_request.attempts < MAX_SUBREQUEST_ATTEMPTS and not self.closing:
+                    self.pending.put(sub_request)
+                else:
+                    sub_request.future.set_result({"error": {"message": "Batch sub-request did not complete"}})
+                continue
+            try:
+                sub_request.future.set_result(json.loads(result.get("body") or "{}"))
+            except ValueError as error:
+                sub_request.future.set_exception(error)
+        # Sub-requests the response did not account for
+        for sub_request in batch[len(results):]:
+            sub_request.future.set_result({"error": {"message": "Missing from batch response"}})
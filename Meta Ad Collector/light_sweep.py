@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Two-phase (light/full) collection, used by collect_rds.py / collect_local.py --light.
+
+For ads that already exist, insert_ads_bulk only updates spend, impressions and stop time,
+so downloading their creatives, regions and demographics again is wasted payload, decode
+time and quota. With --light the traversal asks only for LIGHT_FIELDS, and LightSweep
+completes each page before it is written:
+
+    known ads   go to the writer as they are (the light fields are all that gets updated)
+    new ads     are fetched again with the full field list, by id, through a
+                GraphBatchTransport (up to 50 lookups per call)
+
+"Known" comes from the writer's warmed AdIndexCache; ids the cache cannot answer for are
+checked with one query per page on a separate pooled connection. A new ad whose full
+lookup fails is left out of this run rather than stored half empty. Its id is kept in the
+CheckpointStore (deferred_ads) and looked up again at the start of the country's next run,
+since that run's window and checkpoints may not cover it any more.
+"""
+
+from ad_refresh import lookup_url
+from graph_batch import GraphBatchTransport
+
+# Everything insert_ads_bulk updates on known ads, plus what the traversal and the
+# time-window filter need
+LIGHT_FIELDS = "id,page_id,page_name,ad_delivery_start_time,ad_delivery_stop_time,impressions,spend"
+
+
+class LightSweep:
+    def __init__(self, cache, lookup_inserter, api_key, country):
+        """
+        Args:
+            cache: the writing SQLInserter's AdIndexCache (read only here)
+            lookup_inserter: SQLInserter whose connection is used for cache misses
+        """
+        self.cache = cache
+        self.lookup_inserter = lookup_inserter
+        self.api_key = api_key
+        self.country = country
+        self.transport = GraphBatchTransport(api_key)
+        self.known_ads = 0
+        self.new_ads = 0
+        self.deferred_ads = []
+
+    def known_ids(self, ad_ids):
+        known = set()
+        unknown = []
+        for ad_id in ad_ids:
+            cached = self.cache.has_ad(ad_id)
+            if cached:
+                known.add(ad_id)
+            elif cached is None:
+                unknown.append(ad_id)
+        if unknown:
+            cursor = self.lookup_inserter.cursor
+            cursor.execute("SELECT id FROM meta_ads.ads WHERE id = ANY(%s)", ([int(ad_id) for ad_id in unknown],))
+            known.update(str(row[0]) for row in cursor.fetchall())
+            self.lookup_inserter.connection.commit()
+        return known
+
+    def complete(self, ads):
+        """Return the page's ads ready to write: light records for known ads, full ones for new ads."""
+        known = self.known_ids([ad["id"] for ad in ads if ad.get("id")])
+        new_ids = list(dict.fromkeys(ad["id"] for ad in ads if ad.get("id") and ad["id"] not in known))
+
+        full_ads = {}
+        if new_ids:
+            results = self.transport.get_many([lookup_url(ad_id, self.country, self.api_key) for ad_id in new_ids])
+            for ad_id, data in zip(new_ids, results):
+                match = next((ad for ad in (data.get("data") or []) if ad.get("id") == ad_id), None)
+                if match is None:
+                    self.deferred_ads.append(ad_id)
+                else:
+                    full_ads[ad_id] = match
+
+        completed = []
+        for ad in ads:
+            if ad.get("id") in known:
+                completed.append(ad)
+            elif ad.get("id") in full_ads:
+                completed.append(full_ads[ad["id"]])
+        self.known_ads += sum(1 for ad in ads if ad.get("id") in known)
+        self.new_ads += len(full_ads)
+        if new_ids:
+            print(f"  Light sweep: {len(ads) - len(new_ids)} known, {len(full_ads)}/{len(new_ids)} new ads fetched in full")
+        return completed
+
+    def close(self):
+        self.transport.close()
+        self.lookup_inserter.close_db()
+
+    def print_summary(self):
+        print(f"Light sweep: {self.known_ads} known ads updated from the light fields, "
+              f"{self.new_ads} new ads fetched in full "
+              f"({self.transport.batches_sent} batch calls for {self.transport.subrequests_sent} lookups)")
+        if self.deferred_ads:
+            print(f"  {len(self.deferred_ads)} new ads could not be fetched in full and were left for the next run: "
+                  f"{', '.join(self.deferred_ads[:20])}{' ...' if len(self.deferred_ads) > 20 else ''}")
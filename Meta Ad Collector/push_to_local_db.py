@@ -8,6 +8,8 @@
 
 import os
 import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
 import traceback
 import math
 from datetime import datetime, date
@@ -15,6 +17,12 @@ from dotenv import load_dotenv
 from sshtunnel import SSHTunnelForwarder
 import json
 import time
+import io
+import csv
+import threading
+
+from ad_index_cache import AdIndexCache
+import dirty_dates
 
 # Load environment variables from .env file
 load_dotenv()
@@ -37,10 +45,169 @@ def remove_nul_chars(value):
     return value
 
 
+def remove_nul_chars_deep(value):
+    # jsonb rejects \u0000 anywhere in a document
+    if isinstance(value, dict):
+        return {k: remove_nul_chars_deep(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [remove_nul_chars_deep(v) for v in value]
+    return remove_nul_chars(value)
+
+
+POOL_MAX_CONNECTIONS = int(os.environ.get("SQL_POOL_MAX_CONNECTIONS", "8"))
+POOL_CHECK_AFTER_IDLE_SECONDS = int(os.environ.get("SQL_POOL_CHECK_AFTER_IDLE_SECONDS", "30"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of database connections shared by every SQLInserter in the process.
+
+    getconn() blocks while all `max_connections` connections are in use, and health-checks
+    a connection before handing it out: closed ones are replaced, and ones that sat idle
+    for more than `check_after_idle` seconds must answer SELECT 1 first. putconn() rolls
+    back anything the borrower left uncommitted.
+    """
+
+    def __init__(self, env=None, max_connections=POOL_MAX_CONNECTIONS, check_after_idle=POOL_CHECK_AFTER_IDLE_SECONDS):
+        self.env = env or load_sql_env()
+        self.max_connections = max_connections
+        self.check_after_idle = check_after_idle
+        self.condition = threading.Condition()
+        self.idle = []  # (connection, returned_at), most recently used last
+        self.borrowed = 0
+        self.closed = False
+
+    def _connect(self):
+        # Use connect_timeout and TCP keepalive parameters to make the
+        # connection more resilient to transient network issues.
+        connection = psycopg2.connect(
+            host=self.env["pg_host"],
+            port=self.env["pg_port"],
+            user=self.env["pg_user"],
+            password=self.env["pg_password"],
+            dbname=self.env["pg_database"],
+            connect_timeout=10,
+            keepalives=1,
+            keepalives_idle=60,
+            keepalives_interval=10,
+            keepalives_count=5,
+        )
+        cursor = connection.cursor()
+        # Performance optimizations for RDS
+        cursor.execute("SET client_encoding TO 'utf8'")
+        cursor.execute("SET synchronous_commit TO OFF")  # Faster commits for bulk inserts
+        cursor.execute("SET work_mem TO '256MB'")  # More memory for sorting/indexing
+        connection.commit()
+        cursor.close()
+        print(f"Postgres database '{self.env['pg_database']}' connection established!")
+        return connection
+
+    def _healthy(self, connection, idle_for):
+        if connection.closed != 0:
+            return False
+        if idle_for < self.check_after_idle:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def getconn(self, timeout=None):
+        """Borrow a healthy connection, waiting up to `timeout` seconds (forever if None)."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise psycopg2.InterfaceError("connection pool is closed")
+                if self.idle:
+                    connection, returned_at = self.idle.pop()
+                    break
+                if self.borrowed < self.max_connections:
+                    connection, returned_at = None, None
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"No database connection free after {timeout}s")
+                self.condition.wait(remaining)
+            self.borrowed += 1
+
+        # Health check and connect outside the lock, they can take a while
+        try:
+            if connection is not None and not self._healthy(connection, time.time() - returned_at):
+                print("Pooled DB connection failed its health check, replacing it")
+                self._close_quietly(connection)
+                connection = None
+            if connection is None:
+                connection = self._connect()
+            return connection
+        except Exception:
+            with self.condition:
+                self.borrowed -= 1
+                self.condition.notify()
+            raise
+
+    def putconn(self, connection, close=False):
+        """Return a borrowed connection; close=True discards it (e.g. after a network error)."""
+        if connection is None:
+            return
+        if not close:
+            try:
+                if connection.closed != 0:
+                    close = True
+                elif connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    # Never hand an open transaction to the next borrower
+                    connection.rollback()
+            except Exception:
+                close = True
+        with self.condition:
+            self.borrowed -= 1
+            if close or self.closed:
+                self._close_quietly(connection)
+            else:
+                self.idle.append((connection, time.time()))
+            self.condition.notify()
+
+    def closeall(self):
+        with self.condition:
+            self.closed = True
+            for connection, _ in self.idle:
+                self._close_quietly(connection)
+            self.idle = []
+            self.condition.notify_all()
+
+
+def get_pool(max_connections=None):
+    """
+    Return the process-wide connection pool. The first caller may size it; later
+    callers get the same pool.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = ConnectionPool(max_connections=max_connections or POOL_MAX_CONNECTIONS)
+        return _pool
+
+
 class SQLInserter:
-    def __init__(self, country, use_tunnel=False):
+    def __init__(self, country, use_tunnel=False, warm_cache=False, pool=None, cache=None):
         self.country = country
         self.env = load_sql_env()
+        # Connections are borrowed from the shared pool and returned by close_db()
+        self.pool = pool or get_pool()
         self.connection = None
         self.cursor = None
         # SSH Tunneling is not needed for a local database connection.
@@ -50,53 +217,49 @@ class SQLInserter:
         # were not present yet (e.g. due to transient DB disconnect during ad insert).
         # These will be retried on subsequent bulk_insert_snapshots calls.
         self.pending_snapshots = []
-        # In-memory cache of ad IDs we've successfully inserted in this run
-        # to avoid querying the DB every time we insert snapshots
-        self.known_ad_ids = set()
+        # In-memory page names and ad ids, so the hot path does not have to ask the DB
+        # whether a page was renamed or an ad already exists. warm_cache=True loads
+        # everything up front (one streaming query); otherwise it fills as we go.
+        # Inserters writing from different threads can share one cache (see ad_index_cache.py).
+        self.cache = cache if cache is not None else AdIndexCache()
         self.connect_db()
+        if warm_cache and cache is None:
+            self.cache.warm(self.connection)
 
     def connect_db(self):
+        # Anything not committed is lost with the old connection
+        self.cache.rollback()
         try:
-            # Close old connection/cursor if they exist
+            # Discard the old connection/cursor if they exist
             if self.cursor:
                 try:
                     self.cursor.close()
                 except Exception:
                     pass
-            if self.connection:
-                try:
-                    self.connection.close()
-                except Exception:
-                    pass
-            
-            # Use connect_timeout and TCP keepalive parameters to make the
-            # connection more resilient to transient network issues.
-            self.connection = psycopg2.connect(
-                host=self.env["pg_host"],
-                port=self.env["pg_port"],
-                user=self.env["pg_user"],
-                password=self.env["pg_password"],
-                dbname=self.env["pg_database"],
-                connect_timeout=10,
-                keepalives=1,
-                keepalives_idle=60,
-                keepalives_interval=10,
-                keepalives_count=5,
-            )
+                self.cursor = None
+            if self.connection is not None:
+                self.pool.putconn(self.connection, close=True)
+                self.connection = None
+
+            # The pool hands out health-checked connections with our session settings applied
+            self.connection = self.pool.getconn()
             self.cursor = self.connection.cursor()
-            # Performance optimizations for RDS
-            self.cursor.execute("SET client_encoding TO 'utf8'")
-            self.cursor.execute("SET synchronous_commit TO OFF")  # Faster commits for bulk inserts
-            self.cursor.execute("SET work_mem TO '256MB'")  # More memory for sorting/indexing
-            self.connection.commit()
-            print(f"Postgres database '{self.env['pg_database']}' connection established!")
         except Exception as e:
             print("Database connection error:", e)
             traceback.print_exc()
             raise  # Re-raise so caller can handle retry logic
 
+    def commit(self):
+        """Commit the current transaction and publish its writes to the cache."""
+        self.connection.commit()
+        self.cache.commit()
+
+    def rollback(self):
+        self.cache.rollback()
+        self.connection.rollback()
+
     def ensure_connection(self):
-        """Ensure connection is alive; reconnect if closed."""
+        """Ensure connection is alive; borrow a fresh pooled connection if closed."""
         try:
             if not self.connection or getattr(self.connection, 'closed', 1) != 0:
                 print("DB connection closed or missing, reconnecting...")
@@ -166,33 +329,24 @@ class SQLInserter:
                 self.ensure_connection()
 
                 # 1. Smart Page Update (only if name changed)
-                if page_name:
+                if page_name and self.cache.page_name(page_id) != page_name:
                     try:
-                        # Check if page exists and if name is different
-                        self.cursor.execute(
-                            "SELECT page_name FROM meta_ads.pages WHERE page_id = %s",
-                            (page_id,)
-                        )
-                        result = self.cursor.fetchone()
-
-                        if result is None:
-                            insert_page_query = """
-                                INSERT INTO meta_ads.pages (page_id, page_name)
-                                VALUES (%s, %s);
-                            """
-                            self.cursor.execute(insert_page_query, (page_id, page_name))
-
-                        elif result[0] != page_name:
-                            update_page_query = """
-                                UPDATE meta_ads.pages SET page_name = %s, updated_at = now()
-                                WHERE page_id = %s;
-                            """
-                            self.cursor.execute(update_page_query, (page_name, page_id))
+                        # Insert new pages, rename only when the name actually changed
+                        upsert_page_query = """
+                            INSERT INTO meta_ads.pages (page_id, page_name)
+                            VALUES (%s, %s)
+                            ON CONFLICT (page_id) DO UPDATE SET
+                                page_name = EXCLUDED.page_name,
+                                updated_at = now()
+                            WHERE meta_ads.pages.page_name IS DISTINCT FROM EXCLUDED.page_name;
+                        """
+                        self.cursor.execute(upsert_page_query, (page_id, page_name))
+                        self.cache.set_page(page_id, page_name)
 
                     except Exception as e:
                         print(f"Error handling page {page_id}: {e}")
                         try:
-                            self.connection.rollback()
+                            self.rollback()
                         except Exception:
                             pass
 
@@ -206,9 +360,13 @@ class SQLInserter:
                         return None
                     return json.dumps(val)
 
-                # 2. Check if ad already exists in the database
-                self.cursor.execute("SELECT 1 FROM meta_ads.ads WHERE id = %s", (ad_id,))
-                ad_exists = self.cursor.fetchone() is not None
+                # 2. Check if ad already exists (cache first, DB only if the cache can't tell)
+                ad_exists = self.cache.has_ad(ad_id)
+                if ad_exists is None:
+                    self.cursor.execute("SELECT 1 FROM meta_ads.ads WHERE id = %s", (ad_id,))
+                    ad_exists = self.cursor.fetchone() is not None
+                    if ad_exists:
+                        self.cache.remember_ad(ad_id)
 
                 if ad_exists:
                     try:
@@ -233,7 +391,7 @@ class SQLInserter:
                     except Exception as e:
                         print(f"Error updating existing ad {ad_id}: {e}")
                         try:
-                            self.connection.rollback()
+                            self.rollback()
                         except Exception:
                             pass
                         return
@@ -293,10 +451,11 @@ class SQLInserter:
                             fb_ad.get("target_gender"),
                             to_jsonb(fb_ad.get("target_locations"))
                         ))
+                        self.cache.add_ad(ad_id)
                     except Exception as e:
                         print(f"Error inserting new ad {ad_id}: {e}")
                         try:
-                            self.connection.rollback()
+                            self.rollback()
                         except Exception:
                             pass
                         return
@@ -319,7 +478,7 @@ class SQLInserter:
                     except Exception as e:
                         print(f"Error inserting creative content for ad {ad_id}: {e}")
                         try:
-                            self.connection.rollback()
+                            self.rollback()
                         except Exception:
                             pass
 
@@ -344,7 +503,7 @@ class SQLInserter:
                             except Exception as e:
                                 print(f"Error inserting region data for ad {ad_id}: {e}")
                                 try:
-                                    self.connection.rollback()
+                                    self.rollback()
                                 except Exception:
                                     pass
 
@@ -370,12 +529,12 @@ class SQLInserter:
                             except Exception as e:
                                 print(f"Error inserting demographic data for ad {ad_id}: {e}")
                                 try:
-                                    self.connection.rollback()
+                                    self.rollback()
                                 except Exception:
                                     pass
 
                 if auto_commit:
-                    self.connection.commit()
+                    self.commit()
 
                 # success
                 return
@@ -430,7 +589,7 @@ class SQLInserter:
             except Exception as e:
                 print(f"An unexpected error occurred processing ad {ad_id}: {e}")
                 try:
-                    self.connection.rollback()
+                    self.rollback()
                 except Exception:
                     pass
                 traceback.print_exc()
@@ -449,6 +608,355 @@ class SQLInserter:
             except ValueError:
                 return None
 
+    def _bulk_ad_doc(self, fb_ad):
+        """Flatten one API ad into the JSON document staged by insert_ads_bulk.
+
+        Keys match the column names of the target tables, so the server can turn each
+        document into typed rows with jsonb_populate_record.
+        """
+        ad_id = fb_ad.get("id")
+        return {
+            "id": ad_id,
+            "page_id": fb_ad.get("page_id"),
+            "page_name": fb_ad.get("page_name"),
+            "ad_creation_time": fb_ad.get("ad_creation_time"),
+            "ad_delivery_start_time": fb_ad.get("ad_delivery_start_time"),
+            "ad_delivery_stop_time": fb_ad.get("ad_delivery_stop_time"),
+            "ad_snapshot_url": fb_ad.get("ad_snapshot_url"),
+            "bylines": fb_ad.get("bylines"),
+            "currency": fb_ad.get("currency"),
+            "estimated_audience_size_lower": fb_ad.get("estimated_audience_size", {}).get("lower_bound"),
+            "estimated_audience_size_upper": fb_ad.get("estimated_audience_size", {}).get("upper_bound"),
+            "impressions_lower": fb_ad.get("impressions", {}).get("lower_bound"),
+            "impressions_upper": fb_ad.get("impressions", {}).get("upper_bound"),
+            "languages": fb_ad.get("languages"),
+            "publisher_platforms": fb_ad.get("publisher_platforms"),
+            "spend_lower": fb_ad.get("spend", {}).get("lower_bound"),
+            "spend_upper": fb_ad.get("spend", {}).get("upper_bound"),
+            "target_ages": fb_ad.get("target_ages"),
+            "target_gender": fb_ad.get("target_gender"),
+            "target_locations": fb_ad.get("target_locations"),
+            "creative": {
+                "ad_id": ad_id,
+                "ad_creative_bodies": fb_ad.get("ad_creative_bodies"),
+                "ad_creative_link_captions": fb_ad.get("ad_creative_link_captions"),
+                "ad_creative_link_descriptions": fb_ad.get("ad_creative_link_descriptions"),
+                "ad_creative_link_titles": fb_ad.get("ad_creative_link_titles"),
+            },
+            "regions": [
+                {
+                    "ad_id": ad_id,
+                    "region": region_data.get("region"),
+                    "spend_percentage": self.safe_numeric(region_data.get("percentage")),
+                    "impressions_percentage": None,
+                }
+                for region_data in (fb_ad.get("delivery_by_region") or [])
+            ],
+            "demographics": [
+                {
+                    "ad_id": ad_id,
+                    "age_group": demo_data.get("age"),
+                    "gender": demo_data.get("gender"),
+                    "spend_percentage": self.safe_numeric(demo_data.get("percentage")),
+                    "impressions_percentage": None,
+                }
+                for demo_data in (fb_ad.get("demographic_distribution") or [])
+            ],
+        }
+
+    def insert_ads_bulk(self, ads, snapshots=None):
+        """
+        Set-based version of insert_ad for a whole API page (or several).
+
+        The ads (and optional snapshots) are staged as JSON documents into temp tables with
+        one COPY each, then pages, ads, creatives, regions, demographics and snapshots are
+        merged with a handful of INSERT ... ON CONFLICT statements, all in one transaction.
+        Semantics match insert_ad + bulk_insert_snapshots: an ad that already exists only
+        gets spend, impressions and stop time updated; creatives, regions and demographics
+        are written for new ads only; snapshots are written for ads present after the merge.
+
+        Args:
+            ads: list of ad dicts as returned by the API (ads without id/page_id are skipped)
+            snapshots: optional list of tuples (ad_id, snapshot_date, impressions_lower,
+                       impressions_upper, spend_lower, spend_upper)
+
+        Returns (ads written, of which new)
+        """
+        # Last occurrence wins, like calling insert_ad in order
+        docs = {}
+        pages = {}
+        for fb_ad in ads:
+            if fb_ad.get("id") and fb_ad.get("page_id"):
+                doc = self._bulk_ad_doc(fb_ad)
+                if self.cache.has_ad(doc["id"]):
+                    # Child rows are only written for new ads, no need to ship them
+                    doc.update(creative=None, regions=[], demographics=[])
+                if doc["page_name"] is not None:
+                    if self.cache.page_name(doc["page_id"]) == doc["page_name"]:
+                        doc["page_name"] = None
+                    else:
+                        pages[doc["page_id"]] = doc["page_name"]
+                docs[str(doc["id"])] = json.dumps(remove_nul_chars_deep(doc), default=str)
+        snapshot_docs = {}
+        for s in (snapshots or []):
+            snapshot_docs[(str(s[0]), str(s[1]))] = json.dumps({
+                "ad_id": s[0],
+                "snapshot_date": s[1],
+                "impressions_lower": s[2],
+                "impressions_upper": s[3],
+                "spend_lower": s[4],
+                "spend_upper": s[5],
+            }, default=str)
+        if not docs and not snapshot_docs:
+            return 0, 0
+
+        def copy_docs(table, values):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            for doc in values:
+                writer.writerow([doc])
+            buffer.seek(0)
+            self.cursor.copy_expert(f"COPY {table} (doc) FROM STDIN WITH (FORMAT csv)", buffer)
+
+        retries = 3
+        # Use longer delays for network issues (5min, 10min, 15min)
+        backoff = 300  # 5 minutes
+        for attempt in range(1, retries + 1):
+            try:
+                self.ensure_connection()
+                # ON COMMIT DELETE ROWS: the stage is empty again after every transaction
+                self.cursor.execute("""
+                    CREATE TEMP TABLE IF NOT EXISTS bulk_ads_stage (doc jsonb) ON COMMIT DELETE ROWS;
+                    CREATE TEMP TABLE IF NOT EXISTS bulk_snapshots_stage (doc jsonb) ON COMMIT DELETE ROWS;
+                    CREATE TEMP TABLE IF NOT EXISTS bulk_new_ads (id bigint PRIMARY KEY) ON COMMIT DELETE ROWS;
+                """)
+                copy_docs("bulk_ads_stage", docs.values())
+                copy_docs("bulk_snapshots_stage", snapshot_docs.values())
+
+                self.cursor.execute("""
+                    -- Ads not in the database yet get the full treatment below
+                    INSERT INTO bulk_new_ads (id)
+                    SELECT (st.doc->>'id')::bigint FROM bulk_ads_stage st
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM meta_ads.ads a WHERE a.id = (st.doc->>'id')::bigint
+                    );
+
+                    -- Pages: insert new ones, rename only when the name changed
+                    INSERT INTO meta_ads.pages (page_id, page_name)
+                    SELECT DISTINCT ON (p.page_id) p.page_id, p.page_name
+                    FROM bulk_ads_stage st,
+                         jsonb_populate_record(NULL::meta_ads.pages, jsonb_build_object(
+                             'page_id', st.doc->'page_id', 'page_name', st.doc->'page_name')) p
+                    WHERE p.page_name IS NOT NULL
+                    ORDER BY p.page_id
+                    ON CONFLICT (page_id) DO UPDATE SET
+                        page_name = EXCLUDED.page_name,
+                        updated_at = now()
+                    WHERE meta_ads.pages.page_name IS DISTINCT FROM EXCLUDED.page_name;
+
+                    -- Ads: full row for new ads, spend/impressions/stop time for existing ones
+                    INSERT INTO meta_ads.ads (
+                        id, ad_creation_time, ad_delivery_start_time, ad_delivery_stop_time,
+                        ad_snapshot_url, bylines, currency, estimated_audience_size_lower,
+                        estimated_audience_size_upper, impressions_lower, impressions_upper,
+                        languages, page_id, publisher_platforms, spend_lower, spend_upper,
+                        target_ages, target_gender, target_locations
+                    )
+                    SELECT
+                        a.id, a.ad_creation_time, a.ad_delivery_start_time, a.ad_delivery_stop_time,
+                        a.ad_snapshot_url, a.bylines, a.currency, a.estimated_audience_size_lower,
+                        a.estimated_audience_size_upper, a.impressions_lower, a.impressions_upper,
+                        a.languages, a.page_id, a.publisher_platforms, a.spend_lower, a.spend_upper,
+                        a.target_ages, a.target_gender, a.target_locations
+                    FROM bulk_ads_stage st, jsonb_populate_record(NULL::meta_ads.ads, st.doc) a
+                    ON CONFLICT (id) DO UPDATE SET
+                        impressions_lower = EXCLUDED.impressions_lower,
+                        impressions_upper = EXCLUDED.impressions_upper,
+                        spend_lower = EXCLUDED.spend_lower,
+                        spend_upper = EXCLUDED.spend_upper,
+                        ad_delivery_stop_time = EXCLUDED.ad_delivery_stop_time,
+                        updated_at = now();
+
+                    INSERT INTO meta_ads.ad_creative_content (
+                        ad_id, ad_creative_bodies, ad_creative_link_captions,
+                        ad_creative_link_descriptions, ad_creative_link_titles
+                    )
+                    SELECT c.ad_id, c.ad_creative_bodies, c.ad_creative_link_captions,
+                           c.ad_creative_link_descriptions, c.ad_creative_link_titles
+                    FROM bulk_ads_stage st
+                    JOIN bulk_new_ads n ON n.id = (st.doc->>'id')::bigint,
+                         jsonb_populate_record(NULL::meta_ads.ad_creative_content, st.doc->'creative') c
+                    ON CONFLICT (ad_id) DO NOTHING;
+
+                    INSERT INTO meta_ads.ad_regions (ad_id, region, spend_percentage, impressions_percentage)
+                    SELECT r.ad_id, r.region, r.spend_percentage, r.impressions_percentage
+                    FROM bulk_ads_stage st
+                    JOIN bulk_new_ads n ON n.id = (st.doc->>'id')::bigint,
+                         jsonb_array_elements(st.doc->'regions') e,
+                         jsonb_populate_record(NULL::meta_ads.ad_regions, e.value) r
+                    ON CONFLICT (ad_id, region) DO NOTHING;
+
+                    INSERT INTO meta_ads.ad_demographics (ad_id, age_group, gender, spend_percentage, impressions_percentage)
+                    SELECT d.ad_id, d.age_group, d.gender, d.spend_percentage, d.impressions_percentage
+                    FROM bulk_ads_stage st
+                    JOIN bulk_new_ads n ON n.id = (st.doc->>'id')::bigint,
+                         jsonb_array_elements(st.doc->'demographics') e,
+                         jsonb_populate_record(NULL::meta_ads.ad_demographics, e.value) d
+                    ON CONFLICT (ad_id, age_group, gender) DO NOTHING;
+
+                    -- Snapshots for ads that exist now (FK); the rest cannot be stored
+                    INSERT INTO meta_ads.ad_daily_snapshots
+                        (ad_id, snapshot_date, impressions_lower, impressions_upper, spend_lower, spend_upper)
+                    SELECT s.ad_id, s.snapshot_date, s.impressions_lower, s.impressions_upper, s.spend_lower, s.spend_upper
+                    FROM bulk_snapshots_stage st,
+                         jsonb_populate_record(NULL::meta_ads.ad_daily_snapshots, st.doc) s
+                    WHERE EXISTS (SELECT 1 FROM meta_ads.ads a WHERE a.id = s.ad_id)
+                    ON CONFLICT (ad_id, snapshot_date) DO UPDATE SET
+                        impressions_lower = EXCLUDED.impressions_lower,
+                        impressions_upper = EXCLUDED.impressions_upper,
+                        spend_lower = EXCLUDED.spend_lower,
+                        spend_upper = EXCLUDED.spend_upper,
+                        created_at = now();
+                """ + dirty_dates.mark_sql(
+                    "SELECT doc->>'ad_id', (doc->>'snapshot_date')::date FROM bulk_snapshots_stage"
+                ) + """;
+
+                    SELECT count(*) FROM bulk_new_ads;
+                """)
+                new_ads = self.cursor.fetchone()[0]
+                for ad_id in docs:
+                    self.cache.add_ad(ad_id)
+                for page_id, page_name in pages.items():
+                    self.cache.set_page(page_id, page_name)
+                self.commit()
+                return len(docs), new_ads
+
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as db_err:
+                print(f"DB connection error during bulk insert on attempt {attempt}/{retries}: {db_err}")
+                if attempt == retries:
+                    print(f"Failed to insert {len(docs)} ads after {retries} attempts")
+                    raise
+                # The whole batch is one transaction, so it is safe to replay after reconnecting
+                print(f"Waiting {backoff}s ({backoff//60} minutes) before reconnecting...")
+                time.sleep(backoff)
+                backoff += 300
+                try:
+                    self.connect_db()
+                except Exception as ex:
+                    print(f"Reconnect failed during bulk insert: {ex}")
+
+            except Exception as e:
+                print(f"Error bulk inserting {len(docs)} ads: {e}")
+                try:
+                    self.rollback()
+                except Exception:
+                    pass
+                traceback.print_exc()
+                return 0, 0
+
+    def close_out_ads_bulk(self, stopped_ads):
+        """
+        Apply the recollection result for ads that have stopped delivering.
+
+        All stop time, spend and impressions updates go in as one UPDATE ... FROM (VALUES ...),
+        and each ad's snapshot for its stop date is upserted in the same statement, then
+        committed once. Unlike insert_ads_bulk this never creates ads or pages: ads that are
+        not in the database are ignored.
+
+        Args:
+            stopped_ads: list of ad dicts as returned by the API, with ad_delivery_stop_time set
+
+        Returns the set of ad ids that were updated
+        """
+        # Last occurrence wins; an ad can only be updated once per statement
+        docs = {}
+        for fb_ad in stopped_ads:
+            stop_time = fb_ad.get("ad_delivery_stop_time")
+            if not fb_ad.get("id") or not stop_time:
+                continue
+            # The snapshot is for the STOP DATE, not today
+            try:
+                stop_date = datetime.fromisoformat(stop_time.replace('+00:00', '')).date()
+            except ValueError:
+                stop_date = date.today()
+            # Keys match both meta_ads.ads and meta_ads.ad_daily_snapshots columns
+            docs[str(fb_ad["id"])] = json.dumps({
+                "id": fb_ad["id"],
+                "ad_id": fb_ad["id"],
+                "snapshot_date": stop_date,
+                "ad_delivery_stop_time": stop_time,
+                "impressions_lower": fb_ad.get("impressions", {}).get("lower_bound"),
+                "impressions_upper": fb_ad.get("impressions", {}).get("upper_bound"),
+                "spend_lower": fb_ad.get("spend", {}).get("lower_bound"),
+                "spend_upper": fb_ad.get("spend", {}).get("upper_bound"),
+            }, default=str)
+        if not docs:
+            return set()
+
+        retries = 3
+        # Use longer delays for network issues (5min, 10min, 15min)
+        backoff = 300  # 5 minutes
+        for attempt in range(1, retries + 1):
+            try:
+                self.ensure_connection()
+                rows = execute_values(self.cursor, f"""
+                    WITH docs (doc) AS (VALUES %s),
+                    updated AS (
+                        UPDATE meta_ads.ads t SET
+                            impressions_lower = a.impressions_lower,
+                            impressions_upper = a.impressions_upper,
+                            spend_lower = a.spend_lower,
+                            spend_upper = a.spend_upper,
+                            ad_delivery_stop_time = a.ad_delivery_stop_time,
+                            updated_at = now()
+                        FROM docs, jsonb_populate_record(NULL::meta_ads.ads, docs.doc) a
+                        WHERE t.id = a.id
+                        RETURNING t.id
+                    ),
+                    snapshots AS (
+                        INSERT INTO meta_ads.ad_daily_snapshots
+                            (ad_id, snapshot_date, impressions_lower, impressions_upper, spend_lower, spend_upper)
+                        SELECT s.ad_id, s.snapshot_date, s.impressions_lower, s.impressions_upper, s.spend_lower, s.spend_upper
+                        FROM docs, jsonb_populate_record(NULL::meta_ads.ad_daily_snapshots, docs.doc) s, updated u
+                        WHERE u.id = s.ad_id
+                        ON CONFLICT (ad_id, snapshot_date) DO UPDATE SET
+                            impressions_lower = EXCLUDED.impressions_lower,
+                            impressions_upper = EXCLUDED.impressions_upper,
+                            spend_lower = EXCLUDED.spend_lower,
+                            spend_upper = EXCLUDED.spend_upper,
+                            created_at = now()
+                        RETURNING ad_id, snapshot_date
+                    ),
+                    marked_dates AS ({dirty_dates.mark_dates_sql("SELECT snapshot_date FROM snapshots")}),
+                    marked_ads AS ({dirty_dates.mark_ads_sql("SELECT ad_id, snapshot_date FROM snapshots")})
+                    SELECT id FROM updated
+                """, [(doc,) for doc in docs.values()], template="(%s::jsonb)", page_size=len(docs), fetch=True)
+                self.commit()
+                return {str(row[0]) for row in rows}
+
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as db_err:
+                print(f"DB connection error during bulk close-out on attempt {attempt}/{retries}: {db_err}")
+                if attempt == retries:
+                    print(f"Failed to close out {len(docs)} ads after {retries} attempts")
+                    raise
+                # One statement, one transaction: safe to replay after reconnecting
+                print(f"Waiting {backoff}s ({backoff//60} minutes) before reconnecting...")
+                time.sleep(backoff)
+                backoff += 300
+                try:
+                    self.connect_db()
+                except Exception as ex:
+                    print(f"Reconnect failed during bulk close-out: {ex}")
+
+            except Exception as e:
+                print(f"Error closing out {len(docs)} ads: {e}")
+                try:
+                    self.rollback()
+                except Exception:
+                    pass
+                traceback.print_exc()
+                return set()
+
     def bulk_insert_snapshots(self, snapshots):
         """
         Insert multiple daily snapshots in one batch transaction.
@@ -487,20 +995,26 @@ class SQLInserter:
                         self.pending_snapshots = []
 
                 # Ensure we only insert snapshots for ads that already exist to avoid FK violations.
+                # Ads the cache knows about need no lookup.
                 ad_ids = list({s[0] for s in snapshots})
-                existing_ids = set()
-                if ad_ids:
+                existing_ids = {aid for aid in ad_ids if self.cache.has_ad(aid)}
+                unknown_ids = [aid for aid in ad_ids if aid not in existing_ids]
+                if unknown_ids:
                     # Cast ad_ids to bigint to match the id column type
-                    ad_ids_as_bigint = [int(aid) for aid in ad_ids]
+                    ad_ids_as_bigint = [int(aid) for aid in unknown_ids]
                     self.cursor.execute("SELECT id FROM meta_ads.ads WHERE id = ANY(%s)", (ad_ids_as_bigint,))
-                    existing_ids = {str(row[0]) for row in self.cursor.fetchall()}
+                    for (found_id,) in self.cursor.fetchall():
+                        existing_ids.add(str(found_id))
+                        self.cache.remember_ad(found_id)
 
                 snapshots_existing = [s for s in snapshots if s[0] in existing_ids]
                 snapshots_missing = [s for s in snapshots if s[0] not in existing_ids]
 
                 if snapshots_existing:
                     self.cursor.executemany(insert_query, snapshots_existing)
-                    self.connection.commit()
+                    # The snapshots' daily spend (and the next day's) has to be recomputed
+                    dirty_dates.mark_snapshots(self.cursor, [(s[0], s[1]) for s in snapshots_existing])
+                    self.commit()
                     print(f"Successfully inserted/updated {len(snapshots_existing)} daily snapshots")
                 else:
                     print("No snapshots to insert now (waiting for corresponding ad rows)")
@@ -562,7 +1076,7 @@ class SQLInserter:
             except Exception as e:
                 print(f"Error bulk inserting snapshots: {e}")
                 try:
-                    self.connection.rollback()
+                    self.rollback()
                 except Exception:
                     pass
                 traceback.print_exc()
@@ -570,9 +1084,15 @@ class SQLInserter:
 
     def close_db(self):
         if self.cursor:
-            self.cursor.close()
-        if self.connection:
-            self.connection.close()
+            try:
+                self.cursor.close()
+            except Exception:
+                pass
+            self.cursor = None
+        if self.connection is not None:
+            # Back to the pool for the next SQLInserter
+            self.pool.putconn(self.connection)
+            self.connection = None
         if self.tunnel:
             try:
                 self.tunnel.stop()
@@ -580,4 +1100,7 @@ class SQLInserter:
                 pass
 
     def __del__(self):
-        self.close_db()
+        try:
+            self.close_db()
+        except Exception:
+            pass
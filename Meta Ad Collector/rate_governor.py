@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Adaptive rate governor for the Meta Ad Library API.
+
+Instead of sleeping a fixed amount before every request, every response's
+`x-business-use-case-usage` header (call_count, total_cputime, total_time and
+estimated_time_to_regain_access) is fed back into a token bucket whose refill rate
+shrinks smoothly as the remaining headroom shrinks:
+
+    rate = max_requests_per_second * (headroom / 100) ** 2     (never below min_fraction)
+
+When Meta reports a lockout, or usage reaches `pause_threshold`, sending is paused
+(not the process killed) until the lockout is over.
+
+The bucket state lives in a small JSON file under the temp directory, guarded by an
+flock, so every thread and every process using the same API key draws from one budget.
+
+Usage:
+    governor = get_governor(access_token)
+    governor.wait()                      # before each request
+    governor.observe(response.headers)   # after each response
+
+When several traversals share one key (a multi-country collection), each gets a
+FairShareGovernor on a common FairTurnstile: send tokens then go to whichever traversal
+has been served the fewest, so one dense country cannot starve the others.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from time import sleep, time
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qs
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: state is still shared between threads, but not between processes
+    fcntl = None
+
+USAGE_HEADER = "x-business-use-case-usage"
+USAGE_METRICS = ("call_count", "total_cputime", "total_time")
+
+MAX_REQUESTS_PER_SECOND = float(os.environ.get("FB_API_MAX_RPS", "2"))
+PAUSE_THRESHOLD = float(os.environ.get("FB_API_PAUSE_THRESHOLD", "95"))
+CEILING_PAUSE_SECONDS = int(os.environ.get("FB_API_CEILING_PAUSE_SECONDS", "600"))
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+def parse_usage_header(headers):
+    """
+    Return (max usage percent, estimated_time_to_regain_access in minutes) from a
+    response's headers, or (None, 0) when the header is missing or malformed.
+    """
+    raw = headers.get(USAGE_HEADER) if headers else None
+    if not raw:
+        return None, 0
+    try:
+        usage_data = json.loads(raw)
+    except (json.JSONDecodeError, TypeError):
+        return None, 0
+
+    usage = None
+    regain_minutes = 0
+    for entries in usage_data.values():
+        for entry in entries:
+            for metric in USAGE_METRICS:
+                try:
+                    value = float(entry.get(metric, 0))
+                except (TypeError, ValueError):
+                    continue
+                usage = value if usage is None else max(usage, value)
+            try:
+                regain_minutes = max(regain_minutes, int(entry.get("estimated_time_to_regain_access", 0)))
+            except (TypeError, ValueError):
+                pass
+    return usage, regain_minutes
+
+
+class RateGovernor:
+    def __init__(
+        self,
+        name="default",
+        max_requests_per_second=MAX_REQUESTS_PER_SECOND,
+        pause_threshold=PAUSE_THRESHOLD,
+        ceiling_pause_seconds=CEILING_PAUSE_SECONDS,
+        min_fraction=0.05,
+        state_dir=None,
+    ):
+        self.name = name
+        self.max_requests_per_second = max_requests_per_second
+        self.pause_threshold = pause_threshold
+        self.ceiling_pause_seconds = ceiling_pause_seconds
+        self.min_fraction = min_fraction
+        self.burst = max(1.0, max_requests_per_second)
+        self.state_path = os.path.join(state_dir or tempfile.gettempdir(), f"fb_ads_rate_governor_{name}.json")
+        self.lock = threading.Lock()
+        # API calls this process has been let through (retries and batched calls included)
+        self.calls_sent = 0
+
+    @contextmanager
+    def _locked_state(self):
+        with self.lock:
+            with open(self.state_path, "a+") as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    raw = f.read()
+                    try:
+                        state = json.loads(raw) if raw else {}
+                    except ValueError:
+                        state = {}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    if fcntl:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _rate(self, usage):
+        headroom = max(0.0, 100.0 - (usage or 0.0)) / 100.0
+        return self.max_requests_per_second * max(self.min_fraction, headroom ** 2)
+
+    def reserve(self, cost=1):
+        """
+        Try to take `cost` send tokens (one per API call, so a batch of n calls costs n).
+        Returns 0 when the caller may send now, otherwise the number of seconds to wait
+        before asking again.
+
+        A cost above the bucket's burst is let through once the bucket is full and leaves
+        it in debt, so the calls after it wait until the average rate is back in bounds.
+        """
+        with self._locked_state() as state:
+            now = time()
+            paused_until = state.get("paused_until", 0)
+            if paused_until > now:
+                return paused_until - now
+
+            rate = self._rate(state.get("usage"))
+            tokens = state.get("tokens", self.burst)
+            last_refill = state.get("last_refill", now)
+            tokens = min(self.burst, tokens + max(0.0, now - last_refill) * rate)
+            state["last_refill"] = now
+            needed = min(cost, self.burst)
+            if tokens >= needed:
+                state["tokens"] = tokens - cost
+                self.calls_sent += cost
+                return 0
+            state["tokens"] = tokens
+            return (needed - tokens) / rate
+
+    def wait(self, cost=1):
+        """Block until a request (or a batch of `cost` calls) may be sent."""
+        while True:
+            delay = self.reserve(cost)
+            if delay <= 0:
+                return
+            if delay > 60:
+                print(f"Rate governor: API quota paused, waiting {delay / 60:.1f} minutes...")
+            # Re-check at least once a minute so a pause set by another process is picked up
+            sleep(min(delay, 60))
+
+    async def wait_async(self, cost=1):
+        """
+        asyncio version of wait(). reserve() blocks on the state file's flock while another
+        process holds it, so it runs in the default executor, off the event loop.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            delay = await loop.run_in_executor(None, self.reserve, cost)
+            if delay <= 0:
+                return
+            await asyncio.sleep(min(delay, 60))
+
+    def pause(self, seconds):
+        with self._locked_state() as state:
+            state["paused_until"] = max(state.get("paused_until", 0), time() + seconds)
+
+    def observe(self, headers):
+        """
+        Feed one response's headers back into the bucket. Returns the usage percent
+        reported by Meta (None if the header was absent).
+        """
+        usage, regain_minutes = parse_usage_header(headers)
+        if usage is None and regain_minutes == 0:
+            return None
+
+        with self._locked_state() as state:
+            now = time()
+            if usage is not None:
+                state["usage"] = usage
+            pause_seconds = 0
+            if regain_minutes > 0:
+                pause_seconds = (regain_minutes + 1) * 60
+                print(f"Rate governor: Meta asks to wait {regain_minutes} minutes, pausing all requests")
+            elif usage is not None and usage >= self.pause_threshold:
+                pause_seconds = self.ceiling_pause_seconds
+                print(f"Rate governor: usage at {usage:.0f}%, pausing for {pause_seconds // 60} minutes")
+            if pause_seconds:
+                state["paused_until"] = max(state.get("paused_until", 0), now + pause_seconds)
+                state["tokens"] = 0
+        return usage
+
+    async def observe_async(self, headers):
+        """asyncio version of observe(), run in the default executor like wait_async()."""
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, self.observe, headers)
+
+
+class FairTurnstile:
+    """Hands a shared governor's send tokens to the waiting key that has been served least."""
+
+    def __init__(self, governor):
+        self.governor = governor
+        self.condition = threading.Condition()
+        self.served = {}
+        self.waiting = []  # (served, arrival, key) of blocked callers
+        self.arrivals = 0
+
+    def _first_in_line(self, entry):
+        return min(self.waiting) == entry
+
+    def wait(self, key, cost=1):
+        with self.condition:
+            self.arrivals += 1
+            entry = (self.served.get(key, 0), self.arrivals, key)
+            self.waiting.append(entry)
+            self.condition.wait_for(lambda: self._first_in_line(entry))
+        try:
+            # Only the caller first in line waits on the governor; the rest queue behind it
+            self.governor.wait(cost)
+        finally:
+            with self.condition:
+                self.waiting.remove(entry)
+                self.served[key] = self.served.get(key, 0) + cost
+                self.condition.notify_all()
+
+    def observe(self, headers):
+        return self.governor.observe(headers)
+
+
+class FairShareGovernor:
+    """A RateGovernor-compatible view of a FairTurnstile for one key (e.g. a country)."""
+
+    def __init__(self, turnstile, key):
+        self.turnstile = turnstile
+        self.key = key
+
+    def wait(self, cost=1):
+        self.turnstile.wait(self.key, cost)
+
+    def observe(self, headers):
+        return self.turnstile.observe(headers)
+
+    def served(self):
+        return self.turnstile.served.get(self.key, 0)
+
+
+def get_governor(access_token=None, name=None):
+    """
+    Return the process-wide governor for an API key. Keys get separate budgets
+    (and state files), identified by a short hash so the token never touches disk.
+    """
+    if name is None:
+        name = hashlib.sha1((access_token or "").encode()).hexdigest()[:12]
+    with _governors_lock:
+        if name not in _governors:
+            _governors[name] = RateGovernor(name)
+        return _governors[name]
+
+
+def governor_for_url(url):
+    """Governor for the access_token embedded in a Graph API URL (e.g. a paging.next cursor)."""
+    token = parse_qs(urlsplit(url).query).get("access_token", [""])[0]
+    return get_governor(token)
@@ -12,8 +12,7 @@
 
 import os
 import sys
-from time import sleep
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta
 from collections import defaultdict
 from dotenv import load_dotenv
 
@@ -55,39 +54,18 @@ def process_api_batch(country, sql_inserter, page_ids, oldest_ad_time, newest_ad
     )
 
     updated_count = 0
-    daily_snapshots = []  # Collect snapshots for batch insert
     
     for ads_batch in collector.generate_ad_archives():
-        for ad in ads_batch:
-            # If the API returns an ad we were looking for, it means we have new info.
-            # The `insert_ad` function will handle the update via "ON CONFLICT".
-            if ad['id'] in ad_ids_to_check:
-                # We only need to update if a stop time is now present.
-                stop_time = ad.get("ad_delivery_stop_time")
-                if stop_time:
-                    sql_inserter.insert_ad(ad)
-                    
-                    # Create snapshot for the STOP DATE, not today
-                    try:
-                        stop_date = datetime.fromisoformat(stop_time.replace('+00:00', '')).date()
-                    except:
-                        stop_date = date.today()
-                    
-                    # Also collect snapshot data
-                    daily_snapshots.append((
-                        ad['id'],
-                        stop_date,
-                        ad.get("impressions", {}).get("lower_bound"),
-                        ad.get("impressions", {}).get("upper_bound"),
-                        ad.get("spend", {}).get("lower_bound"),
-                        ad.get("spend", {}).get("upper_bound")
-                    ))
-                    
-                    updated_count += 1
-    
-    # Insert all snapshots for this batch
-    if daily_snapshots:
-        sql_inserter.bulk_insert_snapshots(daily_snapshots)
+        # If the API returns an ad we were looking for and it now has a stop time,
+        # close it out (stop time, spend, impressions and its stop-date snapshot).
+        stopped_ads = [
+            ad for ad in ads_batch
+            if ad['id'] in ad_ids_to_check and ad.get("ad_delivery_stop_time")
+        ]
+        
+        # Write this page's close-outs in one statement
+        if stopped_ads:
+            updated_count += len(sql_inserter.close_out_ads_bulk(stopped_ads))
     
     print(f"Found and updated {updated_count} ads in this batch.")
 
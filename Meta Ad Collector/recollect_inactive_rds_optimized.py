@@ -7,22 +7,40 @@ Key improvements:
 2. Smarter batching based on ad count, not just page count
 3. Progress tracking and resumability
 4. Snapshot created for actual stop date, not today
-5. Narrower date ranges per page to reduce API calls
+5. Narrower date ranges per page to reduce API calls; pages are bin-packed into
+   multi-page requests by date cluster and expected volume (recollect_planner.py)
 6. Statistics and performance metrics
+7. Optional asyncio mode (RECOLLECT_ASYNC=1): many page cursors on one pooled HTTP session
+8. Optional shared work queue (--populate / --queue): pages are claimed from
+   meta_ads.recollect_work with SKIP LOCKED, so several machines can run at once
+9. Pages are worked on in payoff order (recollect_priority.py), and a run can be given an
+   API-call or time budget (--max-api-calls / --max-minutes) after which it stops cleanly
+10. Optional Graph API batch calls (RECOLLECT_GRAPH_BATCH=1): the workers' page lookups are
+    packed up to 50 per HTTP call (graph_batch.py)
+
+Usage:
+    python3 recollect_inactive_rds_optimized.py                     # single host, local progress file
+    python3 recollect_inactive_rds_optimized.py --populate --queue  # fill the shared queue and work on it
+    python3 recollect_inactive_rds_optimized.py --queue             # additional workers
+    python3 recollect_inactive_rds_optimized.py --max-api-calls 5000  # best 5000 calls' worth
 """
 
 import os
 import sys
-from time import sleep
-from datetime import datetime, timedelta, date
-from collections import defaultdict
+import asyncio
+import argparse
+from datetime import datetime, timedelta
 import json
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
 from dotenv import load_dotenv
 
 from fb_ads_library_cleanup import FbAdsLibraryTraversal
-from push_to_rds import SQLInserter
+from push_to_rds import SQLInserter, get_pool
+from rate_governor import get_governor
+from recollect_planner import plan_requests
+from recollect_queue import RecollectQueue, LEASE_MINUTES
+from recollect_priority import rank_pages, load_page_targets, STALE_AD_CONDITION
 
 # Load environment variables from .env file
 load_dotenv()
@@ -30,12 +48,8 @@ load_dotenv()
 # Fallback to regular API key if cleanup key not set
 api_key = os.environ.get("FACEBOOK_API_KEY_CLEANUP") or os.environ.get("FACEBOOK_API_KEY")
 
-if not api_key:
-    print("API key not set. Please set FACEBOOK_API_KEY_CLEANUP or FACEBOOK_API_KEY environment variable.")
-    sys.exit(1)
-
 # Configuration
-BATCH_SIZE_PAGES = 10  # Pages per batch
+BATCH_SIZE_PAGES = 100  # Pages planned (and checkpointed) together
 MAX_DATE_RANGE_DAYS = 90  # Don't query ranges longer than 90 days
 MIN_STALE_DAYS = int(os.environ.get("MIN_STALE_DAYS", "2"))  # Default 2 days for daily runs, override with env var
 PROGRESS_FILE = "/tmp/recollect_progress.json"
@@ -44,11 +58,21 @@ PROGRESS_FILE = "/tmp/recollect_progress.json"
 # Set MAX_WORKERS=1 to disable parallel processing (safe mode)
 # Set MAX_WORKERS=3-5 for optimal speed (recommended)
 MAX_WORKERS = int(os.environ.get("RECOLLECT_MAX_WORKERS", "3"))
-RATE_LIMIT_SLEEP = 2  # Seconds to sleep between API calls (per thread)
 
-# Global lock for rate limiting across threads
-api_rate_limiter = threading.Lock()
-last_api_call_time = 0
+# Set RECOLLECT_ASYNC=1 to fetch pages as asyncio tasks over one pooled HTTP session
+# instead of a thread per page (requires aiohttp).
+USE_ASYNC = os.environ.get("RECOLLECT_ASYNC", "0") == "1"
+ASYNC_CONCURRENCY = int(os.environ.get("RECOLLECT_ASYNC_CONCURRENCY", "24"))
+if USE_ASYNC:
+    from fb_ads_library_async import AsyncFbAdsLibraryTraversal, create_session
+
+# Set RECOLLECT_GRAPH_BATCH=1 to pack the threaded workers' API requests into Graph API batch
+# calls. Each worker has one request in flight, so raise RECOLLECT_MAX_WORKERS (e.g. 20-50)
+# to fill the batches.
+USE_GRAPH_BATCH = os.environ.get("RECOLLECT_GRAPH_BATCH", "0") == "1"
+graph_transport = None
+if USE_GRAPH_BATCH and not USE_ASYNC:
+    from graph_batch import GraphBatchTransport
 
 class RecollectionStats:
     """Thread-safe statistics tracking during recollection process"""
@@ -58,9 +82,53 @@ class RecollectionStats:
         self.ads_checked = 0
         self.ads_updated = 0
         self.ads_still_active = 0
-        self.api_calls = 0
+        # API calls are counted by the key's rate governor, see track_api_calls()
+        self.governor = None
+        self.calls_at_start = 0
         self.pages_processed = 0
+        self.requests_processed = 0
+        self.requests_stopped_early = 0
+        # Per-page results, reported to the work queue's outcome rows
+        self.page_outcomes = {}
+        # Optional run budget, see set_budget()
+        self.max_api_calls = None
+        self.deadline = None
+        self.budget_reason = None
         self.lock = threading.Lock()  # Thread-safe counter updates
+    
+    def track_api_calls(self, governor):
+        """
+        Count the API calls `governor` lets through from now on: every attempt, retry and
+        batched lookup, which is what the quota is charged for.
+        """
+        self.governor = governor
+        self.calls_at_start = governor.calls_sent
+    
+    @property
+    def api_calls(self):
+        if self.governor is None:
+            return 0
+        return self.governor.calls_sent - self.calls_at_start
+    
+    def set_budget(self, max_api_calls=None, max_minutes=None):
+        self.max_api_calls = max_api_calls
+        if max_minutes is not None:
+            self.deadline = self.start_time + timedelta(minutes=max_minutes)
+    
+    def budget_exhausted(self):
+        """
+        True once the API-call or time budget is spent. Checked after every page, so a run
+        overshoots by at most the calls its workers have in flight.
+        """
+        with self.lock:
+            if self.budget_reason is None:
+                if self.max_api_calls is not None and self.api_calls >= self.max_api_calls:
+                    self.budget_reason = f"API-call budget of {self.max_api_calls:,} spent"
+                elif self.deadline is not None and datetime.now() >= self.deadline:
+                    self.budget_reason = f"time budget spent at {self.deadline:%H:%M:%S}"
+                if self.budget_reason:
+                    print(f"\n⏱️  Stopping: {self.budget_reason}, finishing requests in flight...")
+            return self.budget_reason is not None
         
     def increment_ads_checked(self, count=1):
         with self.lock:
@@ -74,13 +142,33 @@ class RecollectionStats:
         with self.lock:
             self.ads_still_active += count
     
-    def increment_api_calls(self, count=1):
-        with self.lock:
-            self.api_calls += count
-    
     def increment_pages_processed(self, count=1):
         with self.lock:
             self.pages_processed += count
+    
+    def increment_requests_processed(self, count=1):
+        with self.lock:
+            self.requests_processed += count
+    
+    def increment_requests_stopped_early(self, count=1):
+        with self.lock:
+            self.requests_stopped_early += count
+    
+    def record_page_outcome(self, page_id, targets_seen=0, ads_updated=0, error=None, interrupted=False):
+        with self.lock:
+            outcome = self.page_outcomes.setdefault(
+                page_id, {'targets_seen': 0, 'ads_updated': 0, 'error': None, 'interrupted': False}
+            )
+            outcome['targets_seen'] += targets_seen
+            outcome['ads_updated'] += ads_updated
+            if error:
+                outcome['error'] = error
+            if interrupted:
+                outcome['interrupted'] = True
+    
+    def pop_page_outcomes(self, page_ids):
+        with self.lock:
+            return {page_id: self.page_outcomes.pop(page_id) for page_id in page_ids if page_id in self.page_outcomes}
         
     def print_summary(self):
         with self.lock:
@@ -93,11 +181,20 @@ class RecollectionStats:
             print(f"Ads updated (now stopped): {self.ads_updated:,}")
             print(f"Ads still active:          {self.ads_still_active:,}")
             print(f"Pages processed:           {self.pages_processed:,}")
+            print(f"Packed API requests:       {self.requests_processed:,}")
+            print(f"Requests stopped early:    {self.requests_stopped_early:,}")
             print(f"API calls made:            {self.api_calls:,}")
             print(f"Duration:                  {duration:.1f}s ({duration/60:.1f} min)")
+            if self.budget_reason:
+                print(f"Stopped early:             {self.budget_reason}")
             if self.ads_updated > 0:
                 print(f"Average time per update:   {duration/self.ads_updated:.2f}s")
-            print(f"Parallel workers:          {MAX_WORKERS}")
+            if USE_ASYNC:
+                print(f"Async pages in flight:     {ASYNC_CONCURRENCY}")
+            else:
+                print(f"Parallel workers:          {MAX_WORKERS}")
+            if graph_transport is not None:
+                print(f"Graph API batch calls:     {graph_transport.batches_sent:,} ({graph_transport.subrequests_sent:,} requests)")
             print("="*60)
 
 def save_progress(processed_page_ids):
@@ -125,175 +222,454 @@ def load_progress():
         print(f"Warning: Could not load progress: {e}")
     return set()
 
-def rate_limited_api_call():
+def handle_ads_batch(sql_inserter, ad_pages, ads_batch, stats, thread_id):
     """
-    Global rate limiter to ensure minimum time between API calls across all threads.
+    Close out every stopped target ad in one API page, together with its stop-date snapshot,
+    in a single set-based write. `ad_pages` maps each target ad id to its page id.
+    Returns the number of ads updated. A failed write is raised, so the request's targets
+    stay outstanding and its pages get an error outcome instead of being counted as done.
     """
-    global last_api_call_time
-    
-    with api_rate_limiter:
-        current_time = datetime.now().timestamp()
-        time_since_last_call = current_time - last_api_call_time
-        
-        if time_since_last_call < RATE_LIMIT_SLEEP:
-            sleep_time = RATE_LIMIT_SLEEP - time_since_last_call
-            sleep(sleep_time)
+    stopped_ads = []
+    for ad in ads_batch:
+        stats.increment_ads_checked()
         
-        last_api_call_time = datetime.now().timestamp()
+        if ad['id'] in ad_pages:
+            if ad.get("ad_delivery_stop_time"):
+                stopped_ads.append(ad)
+            else:
+                stats.increment_ads_still_active()
+    
+    if not stopped_ads:
+        return 0
+    try:
+        updated_ids = sql_inserter.close_out_ads_bulk(stopped_ads)
+    except Exception as e:
+        print(f"    [Thread {thread_id}] ❌ Failed to update {len(stopped_ads)} ads: {e}")
+        raise
+    
+    stats.increment_ads_updated(len(updated_ids))
+    for ad in stopped_ads:
+        if ad['id'] in updated_ids:
+            stats.record_page_outcome(ad_pages[ad['id']], ads_updated=1)
+            print(f"    [Thread {thread_id}] ✅ Updated ad {ad['id']}: stopped at {ad['ad_delivery_stop_time']}")
+    return len(updated_ids)
+
+def outstanding_window(ad_infos, remaining):
+    """(oldest, newest) start_time among the request's target ads not returned by the API yet."""
+    start_dates = [info['start_time'] for info in ad_infos if info['ad_id'] in remaining]
+    return min(start_dates), max(start_dates)
+
+def should_narrow(window, narrower):
+    """
+    Restart a request's traversal with a narrower date window only once that at least halves
+    the span in days: restarting throws away the paging cursor, so small gains aren't worth it.
+    """
+    span = (window[1].date() - window[0].date()).days
+    narrower_span = (narrower[1].date() - narrower[0].date()).days
+    return span >= 2 and narrower_span * 2 <= span
+
+def record_request_outcome(stats, request, remaining, error=None, interrupted=False):
+    """
+    Attribute a request's results to its pages (targets returned by the API, errors, or
+    being cut short by the run's budget).
+    """
+    seen = {}
+    for info in request['ad_infos']:
+        if info['ad_id'] not in remaining:
+            seen[info['page_id']] = seen.get(info['page_id'], 0) + 1
+    for page_id in request['page_ids']:
+        stats.record_page_outcome(page_id, targets_seen=seen.get(page_id, 0), error=error, interrupted=interrupted)
+
+def describe_request(request):
+    page_ids = request['page_ids']
+    if len(page_ids) == 1:
+        return f"page {page_ids[0]}"
+    return f"{len(page_ids)} pages ({page_ids[0]}, ...)"
 
-def process_single_page(
+def process_request(
     country,
-    page_id,
-    ad_infos,
-    ad_ids_to_check,
+    request,
+    ad_pages,
     stats,
     thread_id
 ):
     """
-    Process a single page - designed to be called in parallel.
-    Each thread gets its own database connection.
+    Process one planned request (up to 10 pages sharing a date window) - designed to be
+    called in parallel. Each thread borrows its own connection from the shared pool.
     """
-    # Create a separate database connection for this thread
+    # Borrow a pooled connection for this request (no new connect/SET round trips)
     sql_inserter = SQLInserter(country)
+    label = describe_request(request)
+    ad_infos = request['ad_infos']
+    # Target ads the API hasn't returned yet; once empty there is nothing left to learn
+    remaining = {info['ad_id'] for info in ad_infos}
     
     try:
         if not ad_infos:
             return 0
-            
-        # Find date range for THIS page only
-        start_dates = [info['start_time'] for info in ad_infos]
-        oldest = min(start_dates)
-        newest = max(start_dates)
-        
-        page_ad_ids = {info['ad_id'] for info in ad_infos}
         
-        print(f"  [Thread {thread_id}] Processing page {page_id}: {len(page_ad_ids)} ads, range: {oldest.date()} to {newest.date()}")
+        if stats.budget_exhausted():
+            record_request_outcome(stats, request, remaining, interrupted=True)
+            return 0
         
-        collector = FbAdsLibraryTraversal(
-            api_key,
-            "id,ad_delivery_stop_time,impressions,spend",
-            ".",
-            country,
-            after_date=oldest.strftime('%Y-%m-%d'),
-            max_date=newest.strftime('%Y-%m-%d'),
-            page_limit=100,
-            api_version="v23.0",
-            search_page_ids=str(page_id),
-            ad_active_status="INACTIVE"
-        )
+        print(f"  [Thread {thread_id}] Processing {label}: {len(ad_infos)} ads, range: {request['start'].date()} to {request['end'].date()}")
         
-        daily_snapshots = []
         updated_in_thread = 0
+        window = (request['start'], request['end'])
+        interrupted = False
         
-        for ads_batch in collector.generate_ad_archives():
-            # Apply global rate limiting across all threads
-            rate_limited_api_call()
-            stats.increment_api_calls()
+        while remaining:
+            collector = FbAdsLibraryTraversal(
+                api_key,
+                "id,ad_delivery_stop_time,impressions,spend",
+                ".",
+                country,
+                after_date=window[0].strftime('%Y-%m-%d'),
+                max_date=window[1].strftime('%Y-%m-%d'),
+                page_limit=100,
+                api_version="v23.0",
+                search_page_ids=",".join(str(page_id) for page_id in request['page_ids']),
+                ad_active_status="INACTIVE",
+                transport=graph_transport
+            )
+            ad_archives = collector.generate_ad_archives()
+            narrowed = False
             
-            for ad in ads_batch:
-                stats.increment_ads_checked()
+            # API pacing across all threads is handled by the traversal's shared rate governor
+            for ads_batch in ad_archives:
+                updated_in_thread += handle_ads_batch(
+                    sql_inserter, ad_pages, ads_batch, stats, thread_id
+                )
                 
-                if ad['id'] in ad_ids_to_check:
-                    stop_time = ad.get("ad_delivery_stop_time")
-                    
-                    if stop_time:
-                        # Ad has stopped - update database
-                        try:
-                            # API doesn't return page_id when we search by page,
-                            # so we need to add it manually
-                            ad['page_id'] = page_id
-                            print(f"    [Thread {thread_id}] DEBUG: About to insert ad {ad['id']} with page_id={page_id}")
-                            sql_inserter.insert_ad(ad, auto_commit=True)
-                            print(f"    [Thread {thread_id}] DEBUG: insert_ad() completed, now committing...")
-                            sql_inserter.connection.commit()
-                            print(f"    [Thread {thread_id}] DEBUG: Manual commit completed")
-                            
-                            # Create snapshot for the STOP DATE, not today
-                            try:
-                                stop_date = datetime.fromisoformat(stop_time.replace('+00:00', '')).date()
-                            except:
-                                stop_date = date.today()
-                            
-                            daily_snapshots.append((
-                                ad['id'],
-                                stop_date,
-                                ad.get("impressions", {}).get("lower_bound"),
-                                ad.get("impressions", {}).get("upper_bound"),
-                                ad.get("spend", {}).get("lower_bound"),
-                                ad.get("spend", {}).get("upper_bound")
-                            ))
-                            
-                            stats.increment_ads_updated()
-                            updated_in_thread += 1
-                            print(f"    [Thread {thread_id}] ✅ Updated ad {ad['id']}: stopped on {stop_date}")
-                        except Exception as e:
-                            print(f"    [Thread {thread_id}] ❌ Failed to update ad {ad['id']}: {e}")
-                    else:
-                        stats.increment_ads_still_active()
-        
-        # Insert snapshots for this page
-        if daily_snapshots:
-            sql_inserter.bulk_insert_snapshots(daily_snapshots)
+                remaining -= {ad['id'] for ad in ads_batch}
+                if not remaining:
+                    stats.increment_requests_stopped_early()
+                    break
+                if stats.budget_exhausted():
+                    interrupted = True
+                    break
+                narrower = outstanding_window(ad_infos, remaining)
+                if should_narrow(window, narrower):
+                    print(f"    [Thread {thread_id}] Narrowing {label} to {narrower[0].date()} - {narrower[1].date()} ({len(remaining)} targets left)")
+                    window = narrower
+                    narrowed = True
+                    break
+            ad_archives.close()
+            
+            if not narrowed:
+                break
         
-        stats.increment_pages_processed()
-        print(f"    [Thread {thread_id}] Completed page {page_id}: {updated_in_thread} ads updated")
+        stats.increment_requests_processed()
+        record_request_outcome(stats, request, remaining, interrupted=interrupted)
+        print(f"    [Thread {thread_id}] {'Stopped' if interrupted else 'Completed'} {label}: {updated_in_thread} ads updated")
         
         return updated_in_thread
         
     except Exception as e:
-        print(f"    [Thread {thread_id}] ❌ Error processing page {page_id}: {e}")
+        print(f"    [Thread {thread_id}] ❌ Error processing {label}: {e}")
+        record_request_outcome(stats, request, remaining, error=str(e)[:500])
         import traceback
         traceback.print_exc()
         return 0
     finally:
-        # Clean up database connection
+        # Return the connection to the pool
         try:
-            sql_inserter.connection.close()
+            sql_inserter.close_db()
         except:
             pass
 
+async def process_request_async(
+    session,
+    db_executor,
+    sql_inserter,
+    country,
+    request,
+    ad_pages,
+    stats,
+    worker_id
+):
+    """
+    Async variant of process_request: the API traversal runs on the shared event loop,
+    while database writes are handed to the single DB writer thread.
+    """
+    loop = asyncio.get_running_loop()
+    label = describe_request(request)
+    ad_infos = request['ad_infos']
+    # Same early-stop / narrowing rules as process_request
+    remaining = {info['ad_id'] for info in ad_infos}
+    try:
+        if stats.budget_exhausted():
+            record_request_outcome(stats, request, remaining, interrupted=True)
+            return 0
+        
+        print(f"  [Task {worker_id}] Processing {label}: {len(ad_infos)} ads, range: {request['start'].date()} to {request['end'].date()}")
+        
+        updated = 0
+        window = (request['start'], request['end'])
+        interrupted = False
+        
+        while remaining:
+            collector = AsyncFbAdsLibraryTraversal(
+                session,
+                api_key,
+                "id,ad_delivery_stop_time,impressions,spend",
+                ".",
+                country,
+                after_date=window[0].strftime('%Y-%m-%d'),
+                before_date=window[1].strftime('%Y-%m-%d'),
+                cutoff_after_date=None,
+                page_limit=100,
+                api_version="v23.0",
+                search_page_ids=",".join(str(page_id) for page_id in request['page_ids']),
+                ad_active_status="INACTIVE"
+            )
+            ad_archives = collector.generate_ad_archives()
+            narrowed = False
+            
+            async for ads_batch in ad_archives:
+                updated += await loop.run_in_executor(
+                    db_executor, handle_ads_batch,
+                    sql_inserter, ad_pages, ads_batch, stats, worker_id
+                )
+                
+                remaining -= {ad['id'] for ad in ads_batch}
+                if not remaining:
+                    stats.increment_requests_stopped_early()
+                    break
+                if stats.budget_exhausted():
+                    interrupted = True
+                    break
+                narrower = outstanding_window(ad_infos, remaining)
+                if should_narrow(window, narrower):
+                    print(f"    [Task {worker_id}] Narrowing {label} to {narrower[0].date()} - {narrower[1].date()} ({len(remaining)} targets left)")
+                    window = narrower
+                    narrowed = True
+                    break
+            await ad_archives.aclose()
+            
+            if not narrowed:
+                break
+        
+        stats.increment_requests_processed()
+        record_request_outcome(stats, request, remaining, interrupted=interrupted)
+        print(f"    [Task {worker_id}] {'Stopped' if interrupted else 'Completed'} {label}: {updated} ads updated")
+        return updated
+        
+    except Exception as e:
+        print(f"    [Task {worker_id}] ❌ Error processing {label}: {e}")
+        record_request_outcome(stats, request, remaining, error=str(e)[:500])
+        import traceback
+        traceback.print_exc()
+        return 0
+
+async def process_api_batch_async(country, planned_requests, ad_pages, stats):
+    """
+    Process a batch of planned requests as concurrent tasks on one event loop and one pooled
+    HTTP session. psycopg2 is blocking, so all writes go through one dedicated DB thread and connection.
+    """
+    semaphore = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    db_executor = ThreadPoolExecutor(max_workers=1)
+    sql_inserter = await asyncio.get_running_loop().run_in_executor(db_executor, SQLInserter, country)
+    
+    async def run_request(idx, request):
+        async with semaphore:
+            return await process_request_async(
+                session, db_executor, sql_inserter, country, request, ad_pages, stats, idx + 1
+            )
+    
+    try:
+        async with create_session(max_connections=ASYNC_CONCURRENCY) as session:
+            await asyncio.gather(*(
+                run_request(idx, request) for idx, request in enumerate(planned_requests)
+            ))
+    finally:
+        db_executor.submit(sql_inserter.close_db)
+        db_executor.shutdown(wait=True)
+
 def process_api_batch_optimized(
     country, 
     page_batch_info,  # Dict: {page_id: [ad_info, ...]}
-    ad_ids_to_check, 
-    stats
+    stats,
+    cursor=None
 ):
     """
-    Process multiple pages in parallel using ThreadPoolExecutor.
-    Each page is processed independently in its own thread.
+    Plan packed multi-page requests for a batch of pages (see recollect_planner), then
+    process the requests in parallel using ThreadPoolExecutor (or asyncio with RECOLLECT_ASYNC=1).
+    `cursor` is used to estimate each page's result volume.
     """
     if not page_batch_info:
         return
 
-    page_ids = list(page_batch_info.keys())
-    print(f"\n  🚀 Processing {len(page_ids)} pages in parallel (max {MAX_WORKERS} workers)...")
-    
-    # Process pages in parallel
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Submit all page processing tasks
-        future_to_page = {
-            executor.submit(
-                process_single_page,
-                country,
-                page_id,
-                page_batch_info[page_id],
-                ad_ids_to_check,
-                stats,
-                idx + 1  # Thread ID for logging
-            ): page_id
-            for idx, page_id in enumerate(page_ids)
-        }
+    ad_pages = {
+        info['ad_id']: page_id
+        for page_id, ad_infos in page_batch_info.items()
+        for info in ad_infos
+    }
+    planned_requests = plan_requests(page_batch_info, cursor, max_span_days=MAX_DATE_RANGE_DAYS)
+
+    if USE_ASYNC:
+        print(f"\n  🚀 Processing {len(planned_requests)} requests on the event loop (max {ASYNC_CONCURRENCY} in flight)...")
+        asyncio.run(process_api_batch_async(country, planned_requests, ad_pages, stats))
+    else:
+        print(f"\n  🚀 Processing {len(planned_requests)} requests in parallel (max {MAX_WORKERS} workers)...")
+        
+        # Process requests in parallel
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Submit all request processing tasks
+            future_to_request = {
+                executor.submit(
+                    process_request,
+                    country,
+                    request,
+                    ad_pages,
+                    stats,
+                    idx + 1  # Thread ID for logging
+                ): request
+                for idx, request in enumerate(planned_requests)
+            }
+            
+            # Collect results as they complete
+            for future in as_completed(future_to_request):
+                request = future_to_request[future]
+                try:
+                    updates = future.result()
+                    # Result already logged in process_request
+                except Exception as e:
+                    print(f"  ❌ Exception for {describe_request(request)}: {e}")
+
+    stats.increment_pages_processed(len(page_batch_info))
+
+# Stale ads not updated recently, ordered so each page's rows arrive together
+# The stale ads of the next STALE_SCAN_PAGES pages after %(after)s, in page_id order
+STALE_AD_QUERY = f"""
+    WITH pages AS (
+        SELECT DISTINCT page_id
+        FROM meta_ads.ads
+        WHERE page_id IS NOT NULL AND {STALE_AD_CONDITION}
+            AND (%(first)s OR page_id > %(after)s)
+        ORDER BY page_id
+        LIMIT %(limit)s
+    )
+    SELECT a.page_id, a.ad_delivery_start_time, a.id
+    FROM meta_ads.ads a
+    JOIN pages p ON p.page_id = a.page_id
+    WHERE {STALE_AD_CONDITION}
+    ORDER BY a.page_id, a.ad_delivery_start_time;
+"""
+STALE_SCAN_PAGES = 1000  # Pages per keyset query
+
+def iter_stale_pages(connection, cutoff_date, skip_page_ids, stats):
+    """
+    Yield one (page_id, ad_infos) work item per page with stale ads, in page_id order.
+    The scan is read in keyset chunks of STALE_SCAN_PAGES pages, each in its own short
+    transaction, so no transaction (or cursor) stays open while pages are recollected.
+    """
+    cursor = connection.cursor()
+    last_page_id = None
+    try:
+        while True:
+            cursor.execute(STALE_AD_QUERY, {
+                'cutoff': cutoff_date, 'first': last_page_id is None, 'after': last_page_id, 'limit': STALE_SCAN_PAGES
+            })
+            rows = cursor.fetchall()
+            connection.commit()
+            if not rows:
+                return
+            stats.total_stale_ads += len(rows)
+            pages = {}
+            for page_id, ad_delivery_start_time, ad_id in rows:
+                pages.setdefault(page_id, []).append({
+                    'ad_id': str(ad_id), 
+                    'start_time': ad_delivery_start_time
+                })
+            last_page_id = rows[-1][0]
+            for page_id, ad_infos in pages.items():
+                if page_id not in skip_page_ids:
+                    yield page_id, ad_infos
+    finally:
+        cursor.close()
+
+def iter_page_batches(stale_pages, batch_size):
+    """Group streamed (page_id, ad_infos) items into {page_id: ad_infos} batches."""
+    batch = {}
+    for page_id, ad_infos in stale_pages:
+        batch[page_id] = ad_infos
+        if len(batch) >= batch_size:
+            yield batch
+            batch = {}
+    if batch:
+        yield batch
+
+def iter_priority_batches(connection, cursor, cutoff_date, skip_page_ids, stats, batch_size):
+    """
+    Yield {page_id: ad_infos} batches of pages, highest priority first (see
+    recollect_priority.py), loading each batch's stale ads with one short query.
+    """
+    def load(page_ids):
+        targets = load_page_targets(cursor, page_ids, cutoff_date)
+        connection.commit()
+        return targets
+
+    page_ids = []
+    for page_id, stale_ads, priority in rank_pages(connection, cutoff_date):
+        stats.total_stale_ads += stale_ads
+        if page_id in skip_page_ids:
+            continue
+        page_ids.append(page_id)
+        if len(page_ids) >= batch_size:
+            yield load(page_ids)
+            page_ids = []
+    if page_ids:
+        yield load(page_ids)
+
+def run_queue_worker(country, sql_inserter, cutoff_date, stats, args):
+    """
+    --queue / --populate mode: work through meta_ads.recollect_work (see recollect_queue.py)
+    until no claimable pages are left. Several workers, on any number of machines and API
+    keys, can run this against the same queue.
+    """
+    # The queue gets its own pooled connection, its lease heartbeats run in the background
+    queue_inserter = SQLInserter(country)
+    queue = RecollectQueue(queue_inserter.connection, worker_id=args.worker_id, lease_minutes=args.lease_minutes)
+    try:
+        if args.populate:
+            queued = queue.populate(cutoff_date)
+            print(f"📥 Queued {queued:,} pages with stale ads")
+        if not args.queue:
+            return
         
-        # Collect results as they complete
-        for future in as_completed(future_to_page):
-            page_id = future_to_page[future]
-            try:
-                updates = future.result()
-                # Result already logged in process_single_page
-            except Exception as e:
-                print(f"  ❌ Exception for page {page_id}: {e}")
-
-def main():
+        print(f"👷 Worker {queue.worker_id} claiming up to {BATCH_SIZE_PAGES} pages at a time...\n")
+        batch_num = 0
+        while not stats.budget_exhausted():
+            page_ids = queue.claim(BATCH_SIZE_PAGES)
+            if not page_ids:
+                print("✅ No claimable pages left in the queue.")
+                break
+            batch_num += 1
+            
+            batch_info = queue.load_targets(page_ids, cutoff_date)
+            stats.total_stale_ads += sum(len(ad_infos) for ad_infos in batch_info.values())
+            
+            print(f"\n{'='*60}")
+            print(f"BATCH {batch_num}: claimed {len(page_ids)} pages, {len(batch_info)} still have stale ads")
+            print(f"{'='*60}")
+            
+            with queue.hold(page_ids):
+                process_api_batch_optimized(
+                    country,
+                    batch_info,
+                    stats,
+                    cursor=sql_inserter.cursor
+                )
+            queue.complete(page_ids, batch_info, stats.pop_page_outcomes(page_ids))
+            
+            print(f"\n📊 Ads updated so far: {stats.ads_updated:,}")
+    finally:
+        queue_inserter.close_db()
+
+def main(args):
+    """Run one recollection. Returns False if it stopped on an error, True otherwise."""
+    global graph_transport
     country = "IN"
     print(f"\n{'='*60}")
     print(f"OPTIMIZED INACTIVE AD RECOLLECTION (PARALLEL)")
@@ -303,97 +679,90 @@ def main():
     print(f"{'='*60}\n")
     
     stats = RecollectionStats()
+    # Every traversal and the batch transport pace through the key's governor
+    stats.track_api_calls(get_governor(api_key))
+    stats.set_budget(args.max_api_calls, args.max_minutes)
+    if USE_GRAPH_BATCH and not USE_ASYNC:
+        # One transport per run; the daemon calls main() again for every run
+        graph_transport = GraphBatchTransport(api_key)
+    
+    # One pooled connection for the main thread and the work queue, plus one per worker
+    get_pool(MAX_WORKERS + 2)
     
     # Create main database connection (only for queries, not inserts)
     sql_inserter = SQLInserter(country)
     
-    # Load progress from previous run
-    processed_pages = load_progress()
-    if processed_pages:
-        print(f"📁 Resuming from previous run: {len(processed_pages)} pages already processed\n")
-    
     try:
-        # Query stale ads with optimized query (uses new index)
-        stale_ad_query = """
-            SELECT page_id, ad_delivery_start_time, id
-            FROM meta_ads.ads
-            WHERE bylines IS NOT NULL 
-                AND ad_delivery_stop_time IS NULL
-                AND updated_at < %s
-            ORDER BY page_id, ad_delivery_start_time;
-        """
-        
         cutoff_date = datetime.now() - timedelta(days=MIN_STALE_DAYS)
         print(f"🔍 Searching for ads not updated since: {cutoff_date}\n")
         
-        sql_inserter.cursor.execute(stale_ad_query, (cutoff_date,))
-        rows = sql_inserter.cursor.fetchall()
-        
-        if not rows:
-            print("✅ No stale ads found. Database is up to date!")
-            stats.print_summary()
-            return
-        
-        stats.total_stale_ads = len(rows)
-        print(f"Found {stats.total_stale_ads:,} potentially stale ads")
+        if args.queue or args.populate:
+            run_queue_worker(country, sql_inserter, cutoff_date, stats, args)
+            return True
         
-        # Group by page
-        pages_to_check = defaultdict(list)
-        for page_id, ad_delivery_start_time, ad_id in rows:
-            if page_id and page_id not in processed_pages:
-                pages_to_check[page_id].append({
-                    'ad_id': str(ad_id), 
-                    'start_time': ad_delivery_start_time
-                })
-        
-        if not pages_to_check:
-            print("✅ All pages already processed!")
-            stats.print_summary()
-            return
+        # Load progress from previous run
+        processed_pages = load_progress()
+        if processed_pages:
+            print(f"📁 Resuming from previous run: {len(processed_pages)} pages already processed\n")
+        print(f"Processing in batches of {BATCH_SIZE_PAGES} pages as the scan streams in...\n")
         
-        print(f"Grouped into {len(pages_to_check):,} unique pages")
-        print(f"Processing in batches of {BATCH_SIZE_PAGES} pages...\n")
-        
-        all_page_ids = list(pages_to_check.keys())
+        if args.page_order:
+            stale_pages = iter_stale_pages(sql_inserter.connection, cutoff_date, processed_pages, stats)
+            batches = iter_page_batches(stale_pages, BATCH_SIZE_PAGES)
+        else:
+            batches = iter_priority_batches(
+                sql_inserter.connection, sql_inserter.cursor, cutoff_date, processed_pages, stats, BATCH_SIZE_PAGES
+            )
+        batch_num = 0
         
         # Process in batches
-        for batch_num, i in enumerate(range(0, len(all_page_ids), BATCH_SIZE_PAGES), 1):
-            page_id_batch = all_page_ids[i:i+BATCH_SIZE_PAGES]
+        for batch_info in batches:
+            batch_num += 1
+            page_id_batch = list(batch_info.keys())
             
             print(f"\n{'='*60}")
-            print(f"BATCH {batch_num}/{(len(all_page_ids)-1)//BATCH_SIZE_PAGES + 1}")
+            print(f"BATCH {batch_num} (stale ads scanned so far: {stats.total_stale_ads:,})")
             print(f"Pages: {page_id_batch[:5]}{'...' if len(page_id_batch) > 5 else ''}")
             print(f"{'='*60}")
             
-            # Collect all ad IDs for this batch
-            batch_info = {}
-            all_ad_ids = set()
-            
-            for page_id in page_id_batch:
-                batch_info[page_id] = pages_to_check[page_id]
-                for ad_info in pages_to_check[page_id]:
-                    all_ad_ids.add(ad_info['ad_id'])
-            
-            # Process this batch (in parallel)
+            # Plan packed requests for this batch and process them (in parallel)
             process_api_batch_optimized(
                 country,
                 batch_info,
-                all_ad_ids,
-                stats
+                stats,
+                cursor=sql_inserter.cursor
             )
             
-            # Save progress
-            processed_pages.update(page_id_batch)
+            # Save progress; pages cut short by the budget or failed are picked up by the next run
+            outcomes = stats.pop_page_outcomes(page_id_batch)
+            processed_pages.update(
+                page_id for page_id in page_id_batch
+                if not outcomes.get(page_id, {}).get('interrupted')
+                and not outcomes.get(page_id, {}).get('error')
+            )
             save_progress(processed_pages)
             
             # Progress update
-            progress_pct = (len(processed_pages) / len(all_page_ids)) * 100
-            print(f"\n📊 Overall Progress: {len(processed_pages)}/{len(all_page_ids)} pages ({progress_pct:.1f}%)")
+            print(f"\n📊 Overall Progress: {len(processed_pages):,} pages done")
             print(f"   Ads updated so far: {stats.ads_updated:,}")
+            
+            if stats.budget_exhausted():
+                break
+        
+        if stats.budget_exhausted():
+            print("\n⏱️  Budget spent. Progress saved. Run again to continue with the next pages.")
+            return True
+        
+        if batch_num == 0:
+            if stats.total_stale_ads:
+                print("✅ All pages already processed!")
+            else:
+                print("✅ No stale ads found. Database is up to date!")
         
         # Clean up progress file on successful completion
         if os.path.exists(PROGRESS_FILE):
             os.remove(PROGRESS_FILE)
+        return True
             
     except KeyboardInterrupt:
         print("\n\n⚠️  Interrupted by user. Progress saved. Run again to resume.")
@@ -403,8 +772,37 @@ def main():
         print(f"\n❌ Error occurred: {e}")
         import traceback
         traceback.print_exc()
+        return False
     finally:
+        sql_inserter.close_db()
         stats.print_summary()
+        if graph_transport is not None:
+            graph_transport.close()
+            graph_transport = None
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Recollect stale inactive ads from the Meta Ad Library.")
+    parser.add_argument("--queue", action="store_true",
+                        help="Claim pages from the meta_ads.recollect_work queue instead of scanning locally. "
+                             "Any number of workers can share the queue.")
+    parser.add_argument("--populate", action="store_true",
+                        help="(Re)fill meta_ads.recollect_work from the stale-ad scan. Combine with --queue to also work on it.")
+    parser.add_argument("--worker-id", default=None,
+                        help="Name recorded on claims and outcome rows (default: hostname-pid).")
+    parser.add_argument("--lease-minutes", type=int, default=LEASE_MINUTES,
+                        help=f"How long a claim lasts without a heartbeat (default: {LEASE_MINUTES}).")
+    parser.add_argument("--max-api-calls", type=int, default=None,
+                        help="Stop cleanly after this many API calls.")
+    parser.add_argument("--max-minutes", type=float, default=None,
+                        help="Stop cleanly after this many minutes.")
+    parser.add_argument("--page-order", action="store_true",
+                        help="Work through pages in page_id order instead of by priority (local mode only).")
+    return parser
 
 if __name__ == "__main__":
-    main()
+    args = build_parser().parse_args()
+    if not api_key:
+        print("API key not set. Please set FACEBOOK_API_KEY_CLEANUP or FACEBOOK_API_KEY environment variable.")
+        sys.exit(1)
+    if not main(args):
+        sys.exit(1)
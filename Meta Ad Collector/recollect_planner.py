@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Request planner for stale-ad recollection.
+
+Recollecting one page per traversal costs at least one API call per page, even when the
+page only has a single stale ad. The planner packs pages into `search_page_ids` requests
+instead:
+
+1. Each page's stale targets are clustered by start_time: a gap of more than
+   CLUSTER_GAP_DAYS (or a span over max_span_days) starts a new cluster, so one request
+   never has to cover years of a page's history.
+2. Each cluster's expected result volume (ads the API will return, targets or not) is
+   estimated from the ads we already store for that page in that window.
+3. Clusters are bin-packed, in start_time order, into requests of at most 10 pages whose
+   combined window stays within max_span_days. A cluster joins the open request where it
+   adds the fewest expected API calls, and only if that is cheaper than a request of its own.
+
+A planned request is a dict:
+    {'page_ids': [...], 'start': datetime, 'end': datetime,
+     'ad_infos': [{'ad_id', 'start_time', 'page_id'}, ...], 'expected_ads': float}
+"""
+
+import os
+import math
+
+MAX_PAGES_PER_REQUEST = 10  # API limit for search_page_ids
+CLUSTER_GAP_DAYS = int(os.environ.get("RECOLLECT_CLUSTER_GAP_DAYS", "30"))
+REQUEST_VOLUME_BUDGET = int(os.environ.get("RECOLLECT_REQUEST_VOLUME_BUDGET", "1000"))  # expected ads per request
+
+
+def _days(start, end):
+    return (end.date() - start.date()).days + 1
+
+
+def expected_calls(expected_ads, page_limit=100):
+    return max(1, math.ceil(expected_ads / page_limit))
+
+
+def cluster_page_targets(page_id, ad_infos, max_span_days, gap_days=CLUSTER_GAP_DAYS):
+    """Split one page's targets into clusters of nearby start_times."""
+    clusters = []
+    for info in sorted(ad_infos, key=lambda info: info['start_time']):
+        info = dict(info, page_id=page_id)
+        current = clusters[-1] if clusters else None
+        if (
+            current is None
+            or (info['start_time'].date() - current['end'].date()).days > gap_days
+            or _days(current['start'], info['start_time']) > max_span_days
+        ):
+            clusters.append({
+                'page_id': page_id,
+                'start': info['start_time'],
+                'end': info['start_time'],
+                'ad_infos': [info],
+            })
+        else:
+            current['end'] = info['start_time']
+            current['ad_infos'].append(info)
+    return clusters
+
+
+def estimate_cluster_volumes(cursor, clusters):
+    """
+    Set each cluster's 'expected_ads' to the number of stored ads of its page that started
+    inside its window (one query for all clusters). Without a cursor, fall back to the
+    number of targets. Commits the cursor's connection, so it does not sit idle in a
+    transaction through the API work that follows.
+    """
+    for cluster in clusters:
+        cluster['expected_ads'] = len(cluster['ad_infos'])
+    if cursor is None or not clusters:
+        return clusters
+
+    cursor.execute(
+        """
+        SELECT c.idx, count(a.id)
+        FROM unnest(%s::int[], %s::bigint[], %s::timestamptz[], %s::timestamptz[]) AS c(idx, page_id, lo, hi)
+        JOIN meta_ads.ads a
+            ON a.page_id = c.page_id
+            AND a.ad_delivery_start_time >= date_trunc('day', c.lo)
+            AND a.ad_delivery_start_time < date_trunc('day', c.hi) + interval '1 day'
+        GROUP BY c.idx
+        """,
+        (
+            list(range(len(clusters))),
+            [int(cluster['page_id']) for cluster in clusters],
+            [cluster['start'] for cluster in clusters],
+            [cluster['end'] for cluster in clusters],
+        )
+    )
+    counts = cursor.fetchall()
+    cursor.connection.commit()
+    for idx, count in counts:
+        clusters[idx]['expected_ads'] = max(count, len(clusters[idx]['ad_infos']))
+    return clusters
+
+
+def _request_volume(members, start, end):
+    # Assume each page's ads are spread evenly over its cluster window, so widening the
+    # request window widens every member's share proportionally.
+    total_days = _days(start, end)
+    return sum(m['expected_ads'] * total_days / _days(m['start'], m['end']) for m in members)
+
+
+def pack_requests(clusters, max_span_days, max_pages=MAX_PAGES_PER_REQUEST, volume_budget=REQUEST_VOLUME_BUDGET):
+    """Greedy best-fit packing of clusters into multi-page requests."""
+    requests = []
+    for cluster in sorted(clusters, key=lambda cluster: cluster['start']):
+        standalone_calls = expected_calls(cluster['expected_ads'])
+        best = None
+        for request in requests:
+            members = request['members']
+            if len(members) >= max_pages or any(m['page_id'] == cluster['page_id'] for m in members):
+                continue
+            start = min(request['start'], cluster['start'])
+            end = max(request['end'], cluster['end'])
+            if _days(start, end) > max_span_days:
+                continue
+            volume = _request_volume(members + [cluster], start, end)
+            if volume > volume_budget:
+                continue
+            added_calls = expected_calls(volume) - expected_calls(request['expected_ads'])
+            if added_calls >= standalone_calls:
+                continue
+            key = (added_calls, volume - request['expected_ads'])
+            if best is None or key < best[0]:
+                best = (key, request, start, end, volume)
+
+        if best is None:
+            requests.append({
+                'members': [cluster],
+                'start': cluster['start'],
+                'end': cluster['end'],
+                'expected_ads': cluster['expected_ads'],
+            })
+        else:
+            _, request, start, end, volume = best
+            request['members'].append(cluster)
+            request['start'], request['end'], request['expected_ads'] = start, end, volume
+
+    return [
+        {
+            'page_ids': [m['page_id'] for m in request['members']],
+            'start': request['start'],
+            'end': request['end'],
+            'ad_infos': [info for m in request['members'] for info in m['ad_infos']],
+            'expected_ads': request['expected_ads'],
+        }
+        for request in requests
+    ]
+
+
+def plan_requests(page_batch_info, cursor=None, max_span_days=90):
+    """
+    Plan packed API requests for {page_id: [ad_info, ...]}. `cursor` (optional) is used to
+    estimate result volumes from the ads table.
+    """
+    clusters = []
+    for page_id, ad_infos in page_batch_info.items():
+        if ad_infos:
+            clusters.extend(cluster_page_targets(page_id, ad_infos, max_span_days))
+    estimate_cluster_volumes(cursor, clusters)
+    requests = pack_requests(clusters, max_span_days)
+
+    total_calls = sum(expected_calls(request['expected_ads']) for request in requests)
+    print(f"  🧮 Planned {len(requests)} packed requests for {len(page_batch_info)} pages "
+          f"({len(clusters)} date clusters, ~{total_calls} API calls expected)")
+    return requests
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Payoff-ordered scheduling for stale-ad recollection.
+
+Walking stale pages in page_id order spends the API budget on whatever sorts first. Instead
+each page gets a priority: the number of its stale ads we expect to find stopped, per API
+call we expect to spend on it. All features come from meta_ads.ads:
+
+    stop rate   share of the page's ads that have already stopped (smoothed, so pages with
+                little history sit near PRIOR_STOP_RATE)
+    age         days since each stale ad started delivering; saturates at AGE_SATURATION_DAYS
+    staleness   days since each stale ad was last updated; saturates at STALENESS_SATURATION_DAYS
+    cost        1 + stale ads / ADS_PER_CALL expected calls
+
+    priority = stop rate * sum(age factor * staleness factor) / cost
+
+Pages are worked on in descending priority, so a run cut short by --max-api-calls or
+--max-minutes has already resolved the pages most likely to pay off.
+"""
+
+import os
+
+AGE_SATURATION_DAYS = float(os.environ.get("RECOLLECT_AGE_SATURATION_DAYS", "30"))
+STALENESS_SATURATION_DAYS = float(os.environ.get("RECOLLECT_STALENESS_SATURATION_DAYS", "14"))
+PRIOR_STOP_RATE = 0.5
+PRIOR_ADS = 2  # Weight of the prior, in ads
+ADS_PER_CALL = 100  # page_limit of the recollection traversal
+
+# Same definition of "stale" everywhere recollection looks for work
+STALE_AD_CONDITION = """
+    bylines IS NOT NULL
+    AND ad_delivery_stop_time IS NULL
+    AND updated_at < %(cutoff)s
+"""
+
+# One row per page with stale ads: (page_id, stale_ads, oldest_start, newest_start, priority)
+PAGE_PRIORITY_SELECT = f"""
+    WITH stale AS (
+        SELECT
+            page_id,
+            count(*) AS stale_ads,
+            min(ad_delivery_start_time) AS oldest_start,
+            max(ad_delivery_start_time) AS newest_start,
+            sum(
+                least(1.0, extract(epoch FROM now() - ad_delivery_start_time) / 86400.0 / {AGE_SATURATION_DAYS})
+                * least(1.0, extract(epoch FROM now() - updated_at) / 86400.0 / {STALENESS_SATURATION_DAYS})
+            ) AS weighted_stale
+        FROM meta_ads.ads
+        WHERE page_id IS NOT NULL AND {STALE_AD_CONDITION}
+        GROUP BY page_id
+    ),
+    history AS (
+        SELECT a.page_id, count(*) AS ads, count(a.ad_delivery_stop_time) AS stopped
+        FROM meta_ads.ads a
+        JOIN stale s ON s.page_id = a.page_id
+        GROUP BY a.page_id
+    )
+    SELECT
+        s.page_id,
+        s.stale_ads,
+        s.oldest_start,
+        s.newest_start,
+        (
+            (h.stopped + {PRIOR_STOP_RATE * PRIOR_ADS}) / (h.ads + {float(PRIOR_ADS)})
+            * s.weighted_stale
+            / (1 + s.stale_ads / {float(ADS_PER_CALL)})
+        )::float8 AS priority
+    FROM stale s
+    JOIN history h ON h.page_id = s.page_id
+"""
+
+
+def rank_pages(connection, cutoff_date):
+    """
+    [(page_id, stale_ads, priority), ...] for every page with stale ads, highest priority
+    first. Fetched in one go (a few numbers per page) and committed, so no transaction stays
+    open on the connection while the pages are recollected.
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            f"{PAGE_PRIORITY_SELECT} ORDER BY priority DESC, s.page_id",
+            {"cutoff": cutoff_date}
+        )
+        ranked = [(page_id, stale_ads, priority) for page_id, stale_ads, _, _, priority in cursor.fetchall()]
+        connection.commit()
+        return ranked
+    finally:
+        cursor.close()
+
+
+def load_page_targets(cursor, page_ids, cutoff_date):
+    """The given pages' ads that are still stale, as {page_id: [ad_info, ...]}."""
+    page_batch_info = {}
+    cursor.execute(f"""
+        SELECT page_id, ad_delivery_start_time, id
+        FROM meta_ads.ads
+        WHERE page_id = ANY(%(page_ids)s) AND {STALE_AD_CONDITION}
+        ORDER BY page_id, ad_delivery_start_time;
+    """, {"page_ids": list(page_ids), "cutoff": cutoff_date})
+    for page_id, ad_delivery_start_time, ad_id in cursor.fetchall():
+        page_batch_info.setdefault(page_id, []).append({
+            'ad_id': str(ad_id),
+            'start_time': ad_delivery_start_time
+        })
+    return page_batch_info
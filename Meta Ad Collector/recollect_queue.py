@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Postgres-backed work queue for stale-ad recollection.
+
+Instead of a local progress file, pages to recollect live in meta_ads.recollect_work:
+
+    populate()  fills the queue from the stale-ad scan (server side, one statement), with
+                each page's priority (see recollect_priority.py)
+    claim()     hands a worker the highest-priority pages with FOR UPDATE SKIP LOCKED, under a lease
+    hold()      keeps the lease alive while the batch is being processed
+    complete()  records one meta_ads.recollect_outcomes row per page and releases it
+
+Any number of workers (machines, API keys) can claim from the same queue. A worker that
+dies simply lets its lease expire and the pages are claimed again, up to MAX_ATTEMPTS.
+
+The tables are created by migrations/add_recollect_queue.sql.
+"""
+
+import os
+import socket
+import threading
+from contextlib import contextmanager
+
+from psycopg2.extras import execute_values
+
+from recollect_priority import PAGE_PRIORITY_SELECT, load_page_targets
+
+LEASE_MINUTES = int(os.environ.get("RECOLLECT_LEASE_MINUTES", "30"))
+MAX_ATTEMPTS = int(os.environ.get("RECOLLECT_MAX_ATTEMPTS", "3"))
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class RecollectQueue:
+    def __init__(self, connection, worker_id=None, lease_minutes=LEASE_MINUTES, max_attempts=MAX_ATTEMPTS):
+        """
+        Args:
+            connection: psycopg2 connection used only by the queue (from the shared pool)
+            worker_id: name recorded on claims and outcomes, defaults to host-pid
+        """
+        self.connection = connection
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_minutes = lease_minutes
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+
+    def populate(self, cutoff_date):
+        """
+        Enqueue every page with stale ads. Pages already claimed are left alone; pending
+        pages get a fresh priority; finished or failed pages are queued again.
+        Returns the number of pages (re)queued or re-scored.
+        """
+        with self.lock, self.connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO meta_ads.recollect_work (page_id, stale_ads, oldest_start, newest_start, priority)
+                {PAGE_PRIORITY_SELECT}
+                ON CONFLICT (page_id) DO UPDATE SET
+                    stale_ads = EXCLUDED.stale_ads,
+                    oldest_start = EXCLUDED.oldest_start,
+                    newest_start = EXCLUDED.newest_start,
+                    priority = EXCLUDED.priority,
+                    status = 'pending',
+                    attempts = 0,
+                    claimed_by = NULL,
+                    claimed_at = NULL,
+                    lease_until = NULL,
+                    enqueued_at = now(),
+                    updated_at = now()
+                WHERE meta_ads.recollect_work.status IN ('pending', 'done', 'failed');
+            """, {"cutoff": cutoff_date})
+            queued = cursor.rowcount
+            self.connection.commit()
+            return queued
+
+    def claim(self, limit):
+        """Claim up to `limit` pages, highest priority first, under a fresh lease. Returns their page_ids."""
+        with self.lock, self.connection.cursor() as cursor:
+            # Expired leases that already used up their attempts are given up on
+            cursor.execute("""
+                UPDATE meta_ads.recollect_work
+                SET status = 'failed', lease_until = NULL, updated_at = now()
+                WHERE status = 'claimed' AND lease_until < now() AND attempts >= %s;
+            """, (self.max_attempts,))
+            cursor.execute("""
+                UPDATE meta_ads.recollect_work w SET
+                    status = 'claimed',
+                    claimed_by = %(worker)s,
+                    claimed_at = now(),
+                    lease_until = now() + %(lease)s * interval '1 minute',
+                    attempts = w.attempts + 1,
+                    updated_at = now()
+                WHERE w.page_id IN (
+                    SELECT page_id FROM meta_ads.recollect_work
+                    WHERE status = 'pending' OR (status = 'claimed' AND lease_until < now())
+                    ORDER BY priority DESC, page_id
+                    LIMIT %(limit)s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING w.page_id, w.priority;
+            """, {"worker": self.worker_id, "lease": self.lease_minutes, "limit": limit})
+            # RETURNING does not keep the subquery's order
+            page_ids = [row[0] for row in sorted(cursor.fetchall(), key=lambda row: -row[1])]
+            self.connection.commit()
+            return page_ids
+
+    def load_targets(self, page_ids, cutoff_date):
+        """The claimed pages' ads that are still stale, as {page_id: [ad_info, ...]}."""
+        with self.lock, self.connection.cursor() as cursor:
+            page_batch_info = load_page_targets(cursor, page_ids, cutoff_date)
+            self.connection.commit()
+        return page_batch_info
+
+    def renew(self, page_ids):
+        with self.lock, self.connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE meta_ads.recollect_work
+                SET lease_until = now() + %s * interval '1 minute', updated_at = now()
+                WHERE page_id = ANY(%s) AND claimed_by = %s AND status = 'claimed';
+            """, (self.lease_minutes, list(page_ids), self.worker_id))
+            self.connection.commit()
+
+    @contextmanager
+    def hold(self, page_ids):
+        """Renew the lease on `page_ids` in the background while the block runs."""
+        stop = threading.Event()
+        interval = max(30, self.lease_minutes * 60 / 3)
+
+        def heartbeat():
+            while not stop.wait(interval):
+                try:
+                    self.renew(page_ids)
+                except Exception as e:
+                    print(f"⚠️  Could not renew recollection lease: {e}")
+                    try:
+                        self.connection.rollback()
+                    except Exception:
+                        pass
+
+        thread = threading.Thread(target=heartbeat, name="recollect-lease", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, page_ids, page_batch_info, outcomes):
+        """
+        Record one outcome row per claimed page and release it: 'done' on success, back to
+        'pending' after a failure (or 'failed' once out of attempts). Pages cut short by the
+        run's budget ('interrupted') go back to 'pending' without using up an attempt.
+
+        outcomes: {page_id: {'targets_seen', 'ads_updated', 'error', 'interrupted'}} for pages processed
+        """
+        rows = []
+        for page_id in page_ids:
+            outcome = outcomes.get(page_id, {})
+            if outcome.get('error'):
+                status = 'failed'
+            elif outcome.get('interrupted'):
+                status = 'interrupted'
+            else:
+                status = 'done'
+            rows.append((
+                page_id,
+                self.worker_id,
+                status,
+                len(page_batch_info.get(page_id, [])),
+                outcome.get('targets_seen', 0),
+                outcome.get('ads_updated', 0),
+                outcome.get('error'),
+            ))
+        if not rows:
+            return
+
+        with self.lock, self.connection.cursor() as cursor:
+            # Only pages this worker still holds: once a lease has expired the page may have
+            # been claimed again, and that claim's status, attempts and outcome win
+            released = execute_values(cursor, f"""
+                UPDATE meta_ads.recollect_work w SET
+                    status = CASE
+                        WHEN v.status = 'done' THEN 'done'
+                        WHEN v.status = 'interrupted' THEN 'pending'
+                        WHEN w.attempts >= {int(self.max_attempts)} THEN 'failed'
+                        ELSE 'pending'
+                    END,
+                    attempts = CASE WHEN v.status = 'interrupted' THEN w.attempts - 1 ELSE w.attempts END,
+                    lease_until = NULL,
+                    updated_at = now()
+                FROM (VALUES %s) AS v(page_id, status, worker_id)
+                WHERE w.page_id = v.page_id AND w.claimed_by = v.worker_id AND w.status = 'claimed'
+                RETURNING w.page_id, w.claimed_at
+            """, [(row[0], row[2], self.worker_id) for row in rows], template="(%s::bigint, %s, %s)", fetch=True)
+            claimed_at = dict(released)
+            outcome_rows = [row + (claimed_at[row[0]],) for row in rows if row[0] in claimed_at]
+            if len(outcome_rows) < len(rows):
+                print(f"⚠️  {len(rows) - len(outcome_rows)} pages were no longer claimed by {self.worker_id} "
+                      f"(lease expired), their outcomes are not recorded")
+            if outcome_rows:
+                execute_values(cursor, """
+                    INSERT INTO meta_ads.recollect_outcomes
+                        (page_id, worker_id, status, stale_ads, targets_seen, ads_updated, error, claimed_at)
+                    VALUES %s
+                """, outcome_rows, template="(%s::bigint, %s, %s, %s::int, %s::int, %s::int, %s, %s)")
+            self.connection.commit()
@@ -16,6 +16,8 @@ from datetime import datetime
 import os
 from dotenv import load_dotenv
 
+import dirty_dates
+
 # Load environment variables
 load_dotenv()
 
@@ -238,6 +240,10 @@ class DataSyncer:
             rds_cursor.execute(merge_query)
             rows_affected = rds_cursor.rowcount
             
+            if table_name == 'meta_ads.ad_daily_snapshots':
+                # Daily spend on RDS has to be recomputed for the synced dates
+                rds_cursor.execute(dirty_dates.mark_sql(f"SELECT ad_id, snapshot_date FROM {temp_table}"))
+            
             self.rds_conn.commit()
             
             merge_elapsed = (datetime.now() - merge_start).total_seconds()
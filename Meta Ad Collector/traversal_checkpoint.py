@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Durable cursor checkpoints for ad-archive traversals.
+
+A traversal run (country + fields + page filter + date range) is made of one or more date
+windows. After each page is safely committed to the database, the collector records the
+window's `paging.next` cursor here, along with page and ad counts. With `--resume`, the next
+run picks every unfinished window up from its last cursor instead of from page one. The
+window a run resolved from its arguments (e.g. "the last 24 hours") is saved per country
+too, so a resumed run traverses the same dates even after the clock has moved on.
+
+It also keeps one watermark per country for `--incremental` runs: the start time of the
+last run that completed, so the next run only has to look at what was delivered since. And
+the ids of new ads a `--light` run could not fetch in full, to be retried by the next run.
+
+State is kept in a local SQLite file (COLLECTOR_CHECKPOINT_DB, default
+collector_checkpoints.sqlite3 next to this script). Access tokens are stripped from the
+stored cursors and re-added on resume.
+"""
+
+import os
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+DEFAULT_CHECKPOINT_DB = os.environ.get(
+    "COLLECTOR_CHECKPOINT_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "collector_checkpoints.sqlite3")
+)
+# Deferred ads still not found after this many retries are given up on
+MAX_DEFERRED_ATTEMPTS = 5
+
+
+def strip_access_token(url):
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k != "access_token"]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def restore_access_token(url, access_token):
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True) + [("access_token", access_token)]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class CheckpointStore:
+    def __init__(self, path=DEFAULT_CHECKPOINT_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS traversal_windows (
+                run_key TEXT NOT NULL,
+                window_start TEXT NOT NULL,
+                window_end TEXT NOT NULL,
+                next_url TEXT,
+                status TEXT NOT NULL DEFAULT 'open',
+                pages INTEGER NOT NULL DEFAULT 0,
+                ads INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (run_key, window_start, window_end)
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS collection_watermarks (
+                country TEXT PRIMARY KEY,
+                watermark TEXT NOT NULL,
+                run_key TEXT,
+                updated_at TEXT NOT NULL
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS run_windows (
+                country TEXT PRIMARY KEY,
+                args_key TEXT NOT NULL,
+                after_date TEXT NOT NULL,
+                before_date TEXT NOT NULL,
+                filter_start_time TEXT,
+                run_started TEXT,
+                updated_at TEXT NOT NULL
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS deferred_ads (
+                country TEXT NOT NULL,
+                ad_id TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (country, ad_id)
+            )
+        """)
+        self.connection.commit()
+
+    @staticmethod
+    def run_key(country, fields, search_page_ids, after_date, before_date):
+        raw = "|".join(str(part) for part in (country, fields, search_page_ids, after_date, before_date))
+        return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+    def start_run(self, run_key, windows, resume=False):
+        """
+        Return the windows still to traverse as [((start, end), next_url_or_None), ...].
+
+        With resume=True and an earlier run under the same key, that run's unfinished windows
+        (including any created by splitting) are returned with their saved cursors; a finished
+        run returns []. Otherwise previous state for the key is discarded and `windows` start fresh.
+        """
+        with self.lock:
+            if resume:
+                rows = self.connection.execute(
+                    "SELECT window_start, window_end, next_url, status, pages FROM traversal_windows "
+                    "WHERE run_key = ? ORDER BY window_start",
+                    (run_key,)
+                ).fetchall()
+                if rows:
+                    open_rows = [row for row in rows if row[3] == "open"]
+                    done_pages = sum(row[4] for row in rows)
+                    print(f"Resuming traversal {run_key}: {len(open_rows)}/{len(rows)} windows unfinished, "
+                          f"{done_pages} pages already committed")
+                    return [((start, end), next_url) for start, end, next_url, _, _ in open_rows]
+                print(f"No checkpoint found for traversal {run_key}, starting from the first page")
+
+            self.connection.execute("DELETE FROM traversal_windows WHERE run_key = ?", (run_key,))
+            self._insert_windows(run_key, windows)
+            self.connection.commit()
+            return [(window, None) for window in windows]
+
+    def _insert_windows(self, run_key, windows):
+        now = datetime.now().isoformat()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO traversal_windows (run_key, window_start, window_end, status, updated_at) "
+            "VALUES (?, ?, ?, 'open', ?)",
+            [(run_key, start, end, now) for start, end in windows]
+        )
+
+    def record_page(self, page, ads_count=None):
+        """
+        Mark an AdArchivePage as committed. Call only after its ads are in the database.
+        A page that ends a dense window's traversal also records the window's split.
+        """
+        checkpoint = getattr(page, "checkpoint", None)
+        if not checkpoint:
+            return
+        run_key, (start, end) = checkpoint
+        next_url = strip_access_token(page.next_url) if page.next_url else None
+        with self.lock:
+            self.connection.execute(
+                """
+                UPDATE traversal_windows SET
+                    next_url = ?,
+                    status = CASE WHEN status = 'split' THEN status WHEN ? IS NULL THEN 'done' ELSE 'open' END,
+                    pages = pages + 1,
+                    ads = ads + ?,
+                    updated_at = ?
+                WHERE run_key = ? AND window_start = ? AND window_end = ?
+                """,
+                (next_url, next_url, len(page) if ads_count is None else ads_count,
+                 datetime.now().isoformat(), run_key, start, end)
+            )
+            self.connection.commit()
+        if getattr(page, "split", None):
+            self.split_window(run_key, (start, end), page.split)
+
+    def split_window(self, run_key, window, halves):
+        """
+        Replace a window by the halves of its unread days; the halves are traversed from their
+        first page.
+        """
+        with self.lock:
+            self.connection.execute(
+                "UPDATE traversal_windows SET status = 'split', updated_at = ? "
+                "WHERE run_key = ? AND window_start = ? AND window_end = ?",
+                (datetime.now().isoformat(), run_key, window[0], window[1])
+            )
+            self._insert_windows(run_key, halves)
+            self.connection.commit()
+
+    def save_run_window(self, country, args_key, after_date, before_date, filter_start_time=None, run_started=None):
+        """
+        Remember the window a run resolved from its arguments (args_key), and when the run
+        started, until it completes.
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO run_windows "
+                "(country, args_key, after_date, before_date, filter_start_time, run_started, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (country, args_key, after_date, before_date,
+                 filter_start_time.isoformat() if filter_start_time else None,
+                 run_started.isoformat() if run_started else None, datetime.now().isoformat())
+            )
+            self.connection.commit()
+
+    def get_run_window(self, country, args_key):
+        """
+        (after_date, before_date, filter_start_time, run_started) of the unfinished run with
+        the same arguments, or None.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT after_date, before_date, filter_start_time, run_started FROM run_windows "
+                "WHERE country = ? AND args_key = ?",
+                (country, args_key)
+            ).fetchone()
+        if not row:
+            return None
+        return (row[0], row[1], datetime.fromisoformat(row[2]) if row[2] else None,
+                datetime.fromisoformat(row[3]) if row[3] else None)
+
+    def clear_run_window(self, country):
+        with self.lock:
+            self.connection.execute("DELETE FROM run_windows WHERE country = ?", (country,))
+            self.connection.commit()
+
+    def get_watermark(self, country):
+        """Start time of the last completed incremental run for `country`, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT watermark FROM collection_watermarks WHERE country = ?", (country,)
+            ).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def set_watermark(self, country, watermark, run_key=None):
+        """Advance the country's watermark; call only once a run has committed everything."""
+        with self.lock:
+            self.connection.execute(
+                """
+                INSERT INTO collection_watermarks (country, watermark, run_key, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (country) DO UPDATE SET
+                    watermark = excluded.watermark,
+                    run_key = excluded.run_key,
+                    updated_at = excluded.updated_at
+                WHERE excluded.watermark > collection_watermarks.watermark
+                """,
+                (country, watermark.isoformat(), run_key, datetime.now().isoformat())
+            )
+            self.connection.commit()
+
+    def add_deferred_ads(self, country, ad_ids):
+        """Remember new ads that could not be fetched in full, for the next run to retry."""
+        now = datetime.now().isoformat()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO deferred_ads (country, ad_id, updated_at) VALUES (?, ?, ?)",
+                [(country, str(ad_id), now) for ad_id in ad_ids]
+            )
+            self.connection.commit()
+
+    def deferred_ads(self, country):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT ad_id FROM deferred_ads WHERE country = ? ORDER BY updated_at", (country,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def settle_deferred_ads(self, country, written, failed):
+        """
+        Forget the deferred ads that were written; count another attempt for the ones that
+        failed again, giving up after MAX_DEFERRED_ATTEMPTS. Returns the ids given up on.
+        """
+        now = datetime.now().isoformat()
+        with self.lock:
+            self.connection.executemany(
+                "DELETE FROM deferred_ads WHERE country = ? AND ad_id = ?",
+                [(country, str(ad_id)) for ad_id in written]
+            )
+            self.connection.executemany(
+                "UPDATE deferred_ads SET attempts = attempts + 1, updated_at = ? WHERE country = ? AND ad_id = ?",
+                [(now, country, str(ad_id)) for ad_id in failed]
+            )
+            given_up = [row[0] for row in self.connection.execute(
+                "SELECT ad_id FROM deferred_ads WHERE country = ? AND attempts >= ?", (country, MAX_DEFERRED_ATTEMPTS)
+            ).fetchall()]
+            self.connection.execute(
+                "DELETE FROM deferred_ads WHERE country = ? AND attempts >= ?", (country, MAX_DEFERRED_ATTEMPTS)
+            )
+            self.connection.commit()
+        return given_up
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
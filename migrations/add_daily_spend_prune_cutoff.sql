@@ -0,0 +1,10 @@
+-- Prune cutoff of the partitioned daily spend tables
+-- Run this SQL on your database before using calculate_daily_spend.py --prune-older-than
+
+-- One row: the first snapshot date kept by the last prune. Backfills, --dirty and
+-- --incremental runs skip the dates before it instead of recreating their partitions.
+CREATE TABLE IF NOT EXISTS unified.daily_spend_prune_cutoff (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    pruned_before date NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
@@ -0,0 +1,41 @@
+-- Work queue for stale-ad recollection (see Meta Ad Collector/recollect_queue.py)
+-- Run this SQL on your database before using recollect_inactive_rds_optimized.py --queue / --populate
+
+-- One row per page to recollect, claimed by workers under a lease
+CREATE TABLE IF NOT EXISTS meta_ads.recollect_work (
+    page_id bigint PRIMARY KEY,
+    stale_ads integer NOT NULL,
+    oldest_start timestamptz,
+    newest_start timestamptz,
+    priority double precision NOT NULL DEFAULT 0,
+    status text NOT NULL DEFAULT 'pending',  -- pending / claimed / done / failed
+    attempts integer NOT NULL DEFAULT 0,
+    claimed_by text,
+    claimed_at timestamptz,
+    lease_until timestamptz,
+    enqueued_at timestamptz NOT NULL DEFAULT now(),
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- Queues created before pages were prioritized
+ALTER TABLE meta_ads.recollect_work ADD COLUMN IF NOT EXISTS priority double precision NOT NULL DEFAULT 0;
+
+-- Indexes for claiming pages in priority order
+CREATE INDEX IF NOT EXISTS idx_recollect_work_claimable ON meta_ads.recollect_work(status, lease_until);
+CREATE INDEX IF NOT EXISTS idx_recollect_work_priority ON meta_ads.recollect_work(priority DESC, page_id);
+
+-- One row per page a worker finished (or gave up on)
+CREATE TABLE IF NOT EXISTS meta_ads.recollect_outcomes (
+    id bigserial PRIMARY KEY,
+    page_id bigint NOT NULL,
+    worker_id text NOT NULL,
+    status text NOT NULL,  -- done / failed / interrupted
+    stale_ads integer,
+    targets_seen integer,
+    ads_updated integer,
+    error text,
+    claimed_at timestamptz,
+    finished_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_recollect_outcomes_page ON meta_ads.recollect_outcomes(page_id, finished_at);
@@ -0,0 +1,19 @@
+-- Dirty marks for the daily spend calculation (see Meta Ad Collector/dirty_dates.py)
+-- Run this SQL on your database before deploying the collectors that mark snapshot writes
+
+-- Dates whose daily spend needs recomputing (calculate_daily_spend.py --dirty)
+CREATE TABLE IF NOT EXISTS meta_ads.snapshot_dirty_dates (
+    snapshot_date date PRIMARY KEY,
+    marked_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- Ads whose daily spend rows need recomputing (calculate_daily_spend.py --incremental)
+CREATE TABLE IF NOT EXISTS meta_ads.snapshot_dirty_ads (
+    ad_id bigint NOT NULL,
+    snapshot_date date NOT NULL,
+    marked_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (ad_id, snapshot_date)
+);
+
+-- Index for draining the marks in date order
+CREATE INDEX IF NOT EXISTS idx_snapshot_dirty_ads_date ON meta_ads.snapshot_dirty_ads(snapshot_date);